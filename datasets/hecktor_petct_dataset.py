@@ -1,4 +1,4 @@
-import sys, random
+import sys, functools
 
 import numpy as np
 from scipy.ndimage import gaussian_filter
@@ -9,10 +9,14 @@ import SimpleITK as sitk
 # sys.path.append("../")
 from datautils.conversion import *
 import datautils.transforms as transforms
+from datautils.caching import VolumeCache
+from datautils.rng import get_rng
+from datautils.io import read_packed_volume, read_packed_metadata
 
 
 # Constants
 AUG_PROBABILITY = 0.5
+PACKED_VOLUME_NAMES_BY_SUFFIX = {'_pt': 'PET', '_ct': 'CT', '_ct_gtvt': 'GTV'}
 
 
 class HECKTORPETCTDataset(torch.utils.data.Dataset):
@@ -25,7 +29,7 @@ class HECKTORPETCTDataset(torch.utils.data.Dataset):
 		- CHUM -- 72
 		- CHUS -- 56
 	"""
-	def __init__(self, data_dir, patient_id_filepath, mode='training', preprocessor=None, input_representation='separate-volumes', augment_data=False):
+	def __init__(self, data_dir, patient_id_filepath, mode='training', preprocessor=None, input_representation='separate-volumes', augment_data=False, cache_dir=None, data_format='nifti', region_reads=False, augmentation_backend='torchio', rng=None):
 		"""
 		Parameters:
 			data_dir
@@ -34,8 +38,15 @@ class HECKTORPETCTDataset(torch.utils.data.Dataset):
 					  For cross validation: 'crossval-CHGJ-training', 'crossval-CHGJ-validation', ...
 			input_representation -- 'separate-volumes' or 'multichannel-volume'
 			augment_data -- True or False
+			cache_dir -- Directory to cache the smoothed volumes in, as uncompressed .npy. None disables caching
+			data_format -- 'nifti' (3 .nii.gz files per patient) or 'hdf5' (one packed .h5 file per patient, see tools/cli_pack_subjects.py)
+			region_reads -- If True, __getitem__ returns a lazy subject and the patch sampler reads only the patch regions from the
+			                packed file. Needs data_format='hdf5', no augmentation, no histogram mapping and the scipy smoothing backend
+			augmentation_backend -- 'torchio' or 'native' (datautils.transforms.SpatialAugmenter) for the spatial transforms
+			rng -- Seed or numpy Generator for the augmentation choices, see datautils/rng.py
 		"""
 		self.data_dir = data_dir
+		self.data_format = data_format
 		with open(patient_id_filepath, 'r') as pf:
 			self.patient_ids = [p_id for p_id in pf.read().split('\n') if p_id != '']
 
@@ -70,6 +81,7 @@ class HECKTORPETCTDataset(torch.utils.data.Dataset):
 
 		# Augmentation config
 		self.augment_data = augment_data
+		self.rng = get_rng(rng)
 		self.affine_matrix = np.array(      # Affine matrix representing the (1,1,3) spacing as scaling
 		                              [
 		                               [1,0,0,0],
@@ -80,8 +92,29 @@ class HECKTORPETCTDataset(torch.utils.data.Dataset):
                                      )
 		self.torchio_oneof_transform = None
 		self.PET_stretch_transform = None
+		self.spatial_augmenter = None
 		if self.augment_data:
 			self.torchio_oneof_transform, self.PET_stretch_transform = transforms.build_transforms()
+			if augmentation_backend == 'native':
+				spacing = (self.spacing_dict['xy-spacing'], self.spacing_dict['xy-spacing'], self.spacing_dict['slice-thickness'])  # (W,H,D)
+				self.spatial_augmenter = transforms.SpatialAugmenter(spacing=spacing, rng=self.rng)
+
+		# Region reads -- All preprocessing steps have to be computable on a region
+		self.region_reads = region_reads
+		if self.region_reads:
+			if self.data_format != 'hdf5':
+				raise ValueError("Region reads need data_format='hdf5'")
+			if self.augment_data:
+				raise ValueError("Region reads can't be combined with data augmentation, which transforms the full volumes")
+			if 'histogram-mapping' in [self.preprocessor.normalization_method[modality] for modality in ['PET', 'CT']]:
+				raise ValueError("Region reads can't be combined with histogram mapping, which needs full-volume percentiles")
+			if self.preprocessor.smoothing_backend == 'sitk-recursive':
+				raise ValueError("Region reads need smoothing_backend='scipy'. The recursive Gaussian has unbounded support, so a region can't be smoothed exactly from a finite margin")
+
+		# Preprocessed volume cache -- Stores the volumes as they are before the augmentation step
+		self.volume_cache = None
+		if cache_dir is not None:
+			self.volume_cache = VolumeCache(cache_dir)
 
 
 	def __len__(self):
@@ -91,29 +124,34 @@ class HECKTORPETCTDataset(torch.utils.data.Dataset):
 	def __getitem__(self, idx):
 		p_id = self.patient_ids[idx]
 
-		# Read data files into sitk images -- (W,H,D) format
-		PET_sitk = sitk.ReadImage(f"{self.data_dir}/{p_id}_pt.nii.gz")
-		CT_sitk = sitk.ReadImage(f"{self.data_dir}/{p_id}_ct.nii.gz")
-		target_labelmap_sitk = sitk.ReadImage(f"{self.data_dir}/{p_id}_ct_gtvt.nii.gz")
+		if self.region_reads:
+			return self._get_lazy_subject(p_id)
 
-		# Convert to ndarrays -- Keep the (W,H,D) dim ordering
-		PET_np = sitk2np(PET_sitk, keep_whd_ordering=True)
-		CT_np = sitk2np(CT_sitk, keep_whd_ordering=True)
-		target_labelmap_np = sitk2np(target_labelmap_sitk, keep_whd_ordering=True)
-
-		# Smooth PET and CT
-		PET_np = self.preprocessor.smoothing_filter(PET_np, modality='PET')
-		CT_np = self.preprocessor.smoothing_filter(CT_np, modality='CT')
+		# Read data files into ndarrays, keeping the (W,H,D) dim ordering. Smooth PET and CT -- concurrently, if the preprocessor uses multiple threads
+		file_suffixes = {'PET': '_pt', 'CT': '_ct'}
+		volumes_dict = self.preprocessor.run_per_modality(lambda modality: self._read_volume(p_id, file_suffixes[modality], modality=modality))
+		PET_np, CT_np = volumes_dict['PET'], volumes_dict['CT']
+		target_labelmap_np = self._read_volume(p_id, '_ct_gtvt')
 
 		# Data augmentation
+		is_augmented = False
 		if 'training' in self.mode and self.augment_data:
-			if random.random() < AUG_PROBABILITY:
+			if self.rng.random() < AUG_PROBABILITY:
 				PET_np, CT_np, target_labelmap_np = self.apply_transform(PET_np, CT_np, target_labelmap_np)
+				is_augmented = True
+
+		# Normalize the intensity values. Intensity statistics of unaugmented volumes are reused across epochs.
+		cache_key = None if is_augmented else f"{self.data_dir}/{p_id}"
+		volumes_dict = {'PET': PET_np, 'CT': CT_np}
+		volumes_dict = self.preprocessor.run_per_modality(lambda modality: self.preprocessor.normalize_intensity(volumes_dict[modality], modality=modality, cache_key=cache_key))
+		PET_np, CT_np = volumes_dict['PET'], volumes_dict['CT']
+
+		sample_dict = self._get_sample_dict(PET_np, CT_np, target_labelmap_np)
+		sample_dict['patient-id'] = p_id
+		return sample_dict
 
-		# Normalize the intensity values
-		PET_np = self.preprocessor.normalize_intensity(PET_np, modality='PET')
-		CT_np = self.preprocessor.normalize_intensity(CT_np, modality='CT')
 
+	def _get_sample_dict(self, PET_np, CT_np, target_labelmap_np):
 		# Construct the sample dict -- Convert to tensor and change dim ordering to (D,H,W)
 		if self.input_representation == 'separate-volumes':
 			# Provide PET and CT as 2 separate input tensors, each of shape (1,D,H,W). target mask will be of shape (D,H,W)
@@ -129,13 +167,97 @@ class HECKTORPETCTDataset(torch.utils.data.Dataset):
 			sample_dict = {'PET-CT': torch.stack([PET_tnsr, CT_tnsr], dim=0),
 	                       'target-labelmap': torch.from_numpy(target_labelmap_np).permute(2,1,0)
 						  }
+		return sample_dict
+
 
+	def _get_lazy_subject(self, p_id):
+		"""
+		Subject dict without any volume data, for region reads. The patch sampler calls the region reader with the list of
+		patch regions it needs.
+		"""
+		volume_size = read_packed_metadata(f"{self.data_dir}/{p_id}.h5")['volume-size']
+		sample_dict = {'patient-id': p_id,
+		               'volume-size': tuple(reversed(volume_size)),  # (D,H,W)
+		               'region-reader': functools.partial(self.read_regions, p_id)
+		              }
 		return sample_dict
 
 
+	def read_regions(self, p_id, regions):
+		"""
+		Read and preprocess regions of a patient's volumes from the packed file. Each region is read with a margin covering
+		the smoothing kernel, so the result equals the same region of the fully preprocessed volume.
+		Parameters:
+			p_id
+			regions -- List of (start_idx, end_idx) pairs in (D,H,W) ordering, end exclusive. Must lie within the volume
+		Returns:
+			List of sample dicts, one per region, with the same keys and dim ordering as __getitem__
+		"""
+		file_path = f"{self.data_dir}/{p_id}.h5"
+		volume_size = np.array(read_packed_metadata(file_path)['volume-size'])  # (W,H,D)
+
+		region_dicts = []
+		for start_idx, end_idx in regions:
+			start_idx, end_idx = np.array(start_idx)[::-1], np.array(end_idx)[::-1]  # Convert to (W,H,D)
+			volumes_dict = self.preprocessor.run_per_modality(lambda modality: self._read_preprocessed_region(file_path, modality, start_idx, end_idx, volume_size))
+			target_labelmap_np = read_packed_volume(file_path, 'GTV', region=_get_slices(start_idx, end_idx))
+			region_dicts.append(self._get_sample_dict(volumes_dict['PET'], volumes_dict['CT'], target_labelmap_np))
+		return region_dicts
+
+
+	def _read_preprocessed_region(self, file_path, modality, start_idx, end_idx, volume_size):
+		# Margin of the smoothing kernel, same as gaussian_filter's radius with its default truncate=4.0
+		sigma_mm = self.preprocessor.smooth_sigma_mm[modality]
+		spacing = (self.spacing_dict['xy-spacing'], self.spacing_dict['xy-spacing'], self.spacing_dict['slice-thickness'])
+		margin = np.array([0 if sigma_mm is None else int(4.0 * sigma_mm / spacing[i] + 0.5) for i in range(3)])
+
+		read_start = np.maximum(start_idx - margin, 0)
+		read_end = np.minimum(end_idx + margin, volume_size)
+		region_np = read_packed_volume(file_path, modality, region=_get_slices(read_start, read_end))
+		region_np = self.preprocessor.smoothing_filter(region_np, modality=modality)
+		region_np = region_np[_get_slices(start_idx - read_start, end_idx - read_start)]
+		return self.preprocessor.normalize_intensity(region_np, modality=modality)
+
+
+	def _read_volume(self, p_id, file_suffix, modality=None):
+		"""
+		Read a volume into an ndarray with (W,H,D) ordering. If a modality is given, the volume is also smoothed.
+		Served from the volume cache, if enabled.
+		"""
+		if self.data_format == 'hdf5':
+			file_path = f"{self.data_dir}/{p_id}.h5"
+			volume_name = PACKED_VOLUME_NAMES_BY_SUFFIX[file_suffix]
+		else:
+			file_path = f"{self.data_dir}/{p_id}{file_suffix}.nii.gz"
+			volume_name = None
+
+		def read_and_smooth():
+			if self.data_format == 'hdf5':
+				volume_np = read_packed_volume(file_path, volume_name, keep_whd_ordering=True)
+			else:
+				volume_np = sitk2np(sitk.ReadImage(file_path), keep_whd_ordering=True)
+			if modality is not None:
+				volume_np = self.preprocessor.smoothing_filter(volume_np, modality=modality)
+			return volume_np
+
+		if self.volume_cache is None:
+			return read_and_smooth()
+
+		if modality is not None:
+			sigma_mm, dtype = self.preprocessor.smooth_sigma_mm[modality], np.float32
+		else:
+			sigma_mm, dtype = None, None  # Labelmap -- Keep its original dtype
+		return self.volume_cache.fetch(p_id, file_path, sigma_mm, self.spacing_dict, read_and_smooth, dtype=dtype,
+		                               smoothing_backend=self.preprocessor.smoothing_backend, volume_name=volume_name)
+
+
 	def apply_transform(self, PET_np, CT_np, target_labelmap_np):
-		r = random.random()
-		if  r < 0.75:
+		r = self.rng.random()
+		if  r < 0.75 and self.spatial_augmenter is not None:
+			# Apply one of the 3 spatial transforms natively, with a coordinate map shared by all volumes
+			volumes_dict = self.spatial_augmenter({'PET': PET_np, 'CT': CT_np, 'target-labelmap': target_labelmap_np}, label_keys=['target-labelmap'])
+			PET_np, CT_np, target_labelmap_np = volumes_dict['PET'], volumes_dict['CT'], volumes_dict['target-labelmap']
+		elif  r < 0.75:
 			# Apply one of the 3 TorchIO spatial transforms. Need to pack the volumes into a TorchIO Subject for this.
 			subject_tio = self._create_torchio_subject(PET_np, CT_np, target_labelmap_np)
 			subject_tio = self.torchio_oneof_transform(subject_tio)
@@ -144,7 +266,8 @@ class HECKTORPETCTDataset(torch.utils.data.Dataset):
 			target_labelmap_np = subject_tio['target-labelmap'].numpy().squeeze()
 		else:
 			# PET intensity stretching
-			PET_np = self.PET_stretch_transform(PET_np)
+			# In place -- The volume is a private copy (fresh array or copy-on-write mapping of the cache)
+			PET_np = self.PET_stretch_transform(PET_np, inplace=PET_np.dtype.kind == 'f')
 		return PET_np, CT_np, target_labelmap_np
 
 	def _create_torchio_subject(self, PET_np, CT_np, target_labelmap_np):
@@ -157,6 +280,11 @@ class HECKTORPETCTDataset(torch.utils.data.Dataset):
 
 
 
+def _get_slices(start_idx, end_idx):
+	return tuple(slice(start_idx[i], end_idx[i]) for i in range(3))
+
+
+
 if __name__ == '__main__':
 
 	from data_utils.preprocessing import Preprocessor
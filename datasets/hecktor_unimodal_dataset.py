@@ -1,4 +1,4 @@
-import sys, random
+import sys, functools
 
 import numpy as np
 from scipy.ndimage import gaussian_filter
@@ -9,10 +9,14 @@ import SimpleITK as sitk
 # sys.path.append("../")
 from datautils.conversion import *
 import datautils.transforms as transforms
+from datautils.caching import VolumeCache
+from datautils.rng import get_rng
+from datautils.io import read_packed_volume, read_packed_metadata
 
 
 # Constants
 AUG_PROBABILITY = 0.5
+PACKED_VOLUME_NAMES_BY_SUFFIX = {'_pt': 'PET', '_ct': 'CT', '_ct_gtvt': 'GTV'}
 
 
 class HECKTORUnimodalDataset(torch.utils.data.Dataset):
@@ -25,7 +29,7 @@ class HECKTORUnimodalDataset(torch.utils.data.Dataset):
 		- CHUM -- 72
 		- CHUS -- 56
 	"""
-	def __init__(self, data_dir, patient_id_filepath, mode='training', preprocessor=None, input_modality='PET', augment_data=False):
+	def __init__(self, data_dir, patient_id_filepath, mode='training', preprocessor=None, input_modality='PET', augment_data=False, cache_dir=None, data_format='nifti', region_reads=False, augmentation_backend='torchio', rng=None):
 		"""
 		Parameters:
 			data_dir
@@ -34,8 +38,15 @@ class HECKTORUnimodalDataset(torch.utils.data.Dataset):
 					  For cross validation: 'crossval-CHGJ-training', 'crossval-CHGJ-validation', ...
 			input_modality -- 'PET' or 'CT'
 			augment_data -- True or False
+			cache_dir -- Directory to cache the smoothed volumes in, as uncompressed .npy. None disables caching
+			data_format -- 'nifti' (3 .nii.gz files per patient) or 'hdf5' (one packed .h5 file per patient, see tools/cli_pack_subjects.py)
+			region_reads -- If True, __getitem__ returns a lazy subject and the patch sampler reads only the patch regions from the
+			                packed file. Needs data_format='hdf5', no augmentation, no histogram mapping and the scipy smoothing backend
+			augmentation_backend -- 'torchio' or 'native' (datautils.transforms.SpatialAugmenter) for the spatial transforms
+			rng -- Seed or numpy Generator for the augmentation choices, see datautils/rng.py
 		"""
 		self.data_dir = data_dir
+		self.data_format = data_format
 		with open(patient_id_filepath, 'r') as pf:
 			self.patient_ids = [p_id for p_id in pf.read().split('\n') if p_id != '']
 
@@ -70,6 +81,7 @@ class HECKTORUnimodalDataset(torch.utils.data.Dataset):
 
 		# Augmentation config
 		self.augment_data = augment_data
+		self.rng = get_rng(rng)
 		self.affine_matrix = np.array(      # Affine matrix representing the (1,1,3) spacing as scaling
 		                              [
 		                               [1,0,0,0],
@@ -80,8 +92,29 @@ class HECKTORUnimodalDataset(torch.utils.data.Dataset):
                                      )
 		self.torchio_oneof_transform = None
 		self.PET_stretch_transform = None
+		self.spatial_augmenter = None
 		if self.augment_data:
 			self.torchio_oneof_transform, self.PET_stretch_transform = transforms.build_transforms()
+			if augmentation_backend == 'native':
+				spacing = (self.spacing_dict['xy-spacing'], self.spacing_dict['xy-spacing'], self.spacing_dict['slice-thickness'])  # (W,H,D)
+				self.spatial_augmenter = transforms.SpatialAugmenter(spacing=spacing, rng=self.rng)
+
+		# Region reads -- All preprocessing steps have to be computable on a region
+		self.region_reads = region_reads
+		if self.region_reads:
+			if self.data_format != 'hdf5':
+				raise ValueError("Region reads need data_format='hdf5'")
+			if self.augment_data:
+				raise ValueError("Region reads can't be combined with data augmentation, which transforms the full volumes")
+			if self.preprocessor.normalization_method[self.input_modality] == 'histogram-mapping':
+				raise ValueError("Region reads can't be combined with histogram mapping, which needs full-volume percentiles")
+			if self.preprocessor.smoothing_backend == 'sitk-recursive':
+				raise ValueError("Region reads need smoothing_backend='scipy'. The recursive Gaussian has unbounded support, so a region can't be smoothed exactly from a finite margin")
+
+		# Preprocessed volume cache -- Stores the volumes as they are before the augmentation step
+		self.volume_cache = None
+		if cache_dir is not None:
+			self.volume_cache = VolumeCache(cache_dir)
 
 
 	def __len__(self):
@@ -91,40 +124,127 @@ class HECKTORUnimodalDataset(torch.utils.data.Dataset):
 	def __getitem__(self, idx):
 		p_id = self.patient_ids[idx]
 
-		# Read data files into sitk images -- (W,H,D) format
+		if self.region_reads:
+			return self._get_lazy_subject(p_id)
+
+		# Read data files into ndarrays, keeping the (W,H,D) dim ordering. Smooth the input image
 		if self.input_modality == 'PET':
-			input_image_sitk = sitk.ReadImage(f"{self.data_dir}/{p_id}_pt.nii.gz")
+			input_image_np = self._read_volume(p_id, '_pt', modality='PET')
 		elif self.input_modality == 'CT':
-			input_image_sitk = sitk.ReadImage(f"{self.data_dir}/{p_id}_ct.nii.gz")
-		target_labelmap_sitk = sitk.ReadImage(f"{self.data_dir}/{p_id}_ct_gtvt.nii.gz")
-
-		# Convert to ndarrays -- Keep the (W,H,D) dim ordering
-		input_image_np = sitk2np(input_image_sitk, keep_whd_ordering=True)
-		target_labelmap_np = sitk2np(target_labelmap_sitk, keep_whd_ordering=True)
-
-		# Smooth PET and CT
-		input_image_np = self.preprocessor.smoothing_filter(input_image_np, modality=self.input_modality)
+			input_image_np = self._read_volume(p_id, '_ct', modality='CT')
+		target_labelmap_np = self._read_volume(p_id, '_ct_gtvt')
 
 		# Data augmentation
+		is_augmented = False
 		if 'training' in self.mode and self.augment_data:
-			if random.random() < AUG_PROBABILITY:
+			if self.rng.random() < AUG_PROBABILITY:
 				input_image_np, target_labelmap_np = self.apply_transform(input_image_np, target_labelmap_np)
+				is_augmented = True
+
+		# Normalize the intensity scale. Intensity statistics of unaugmented volumes are reused across epochs.
+		cache_key = None if is_augmented else f"{self.data_dir}/{p_id}"
+		input_image_np = self.preprocessor.normalize_intensity(input_image_np, modality=self.input_modality, cache_key=cache_key)
+
+		sample_dict = self._get_sample_dict(input_image_np, target_labelmap_np)
+		sample_dict['patient-id'] = p_id
+		return sample_dict
 
-		# Normalize the intensity scale
-		input_image_np = self.preprocessor.normalize_intensity(input_image_np, modality=self.input_modality)
 
+	def _get_sample_dict(self, input_image_np, target_labelmap_np):
 		# Construct the sample dict -- Convert to tensor and change dim ordering to (D,H,W).
 		# Input image will have shape (1,D,H,W). Target labelmap will have (D,H,W)
 		sample_dict = {self.input_modality: np2tensor(input_image_np).permute(2,1,0).unsqueeze(dim=0),
                        'target-labelmap': np2tensor(target_labelmap_np).permute(2,1,0).long()
 		              }
+		return sample_dict
+
 
+	def _get_lazy_subject(self, p_id):
+		"""
+		Subject dict without any volume data, for region reads. The patch sampler calls the region reader with the list of
+		patch regions it needs.
+		"""
+		volume_size = read_packed_metadata(f"{self.data_dir}/{p_id}.h5")['volume-size']
+		sample_dict = {'patient-id': p_id,
+		               'volume-size': tuple(reversed(volume_size)),  # (D,H,W)
+		               'region-reader': functools.partial(self.read_regions, p_id)
+		              }
 		return sample_dict
 
 
+	def read_regions(self, p_id, regions):
+		"""
+		Read and preprocess regions of a patient's input image and labelmap from the packed file. The input image is read
+		with a margin covering the smoothing kernel, so the result equals the same region of the fully preprocessed volume.
+		Parameters:
+			p_id
+			regions -- List of (start_idx, end_idx) pairs in (D,H,W) ordering, end exclusive. Must lie within the volume
+		Returns:
+			List of sample dicts, one per region, with the same keys and dim ordering as __getitem__
+		"""
+		file_path = f"{self.data_dir}/{p_id}.h5"
+		volume_size = np.array(read_packed_metadata(file_path)['volume-size'])  # (W,H,D)
+
+		# Margin of the smoothing kernel, same as gaussian_filter's radius with its default truncate=4.0
+		sigma_mm = self.preprocessor.smooth_sigma_mm[self.input_modality]
+		spacing = (self.spacing_dict['xy-spacing'], self.spacing_dict['xy-spacing'], self.spacing_dict['slice-thickness'])
+		margin = np.array([0 if sigma_mm is None else int(4.0 * sigma_mm / spacing[i] + 0.5) for i in range(3)])
+
+		region_dicts = []
+		for start_idx, end_idx in regions:
+			start_idx, end_idx = np.array(start_idx)[::-1], np.array(end_idx)[::-1]  # Convert to (W,H,D)
+
+			read_start = np.maximum(start_idx - margin, 0)
+			read_end = np.minimum(end_idx + margin, volume_size)
+			input_image_np = read_packed_volume(file_path, self.input_modality, region=_get_slices(read_start, read_end))
+			input_image_np = self.preprocessor.smoothing_filter(input_image_np, modality=self.input_modality)
+			input_image_np = input_image_np[_get_slices(start_idx - read_start, end_idx - read_start)]
+			input_image_np = self.preprocessor.normalize_intensity(input_image_np, modality=self.input_modality)
+
+			target_labelmap_np = read_packed_volume(file_path, 'GTV', region=_get_slices(start_idx, end_idx))
+			region_dicts.append(self._get_sample_dict(input_image_np, target_labelmap_np))
+		return region_dicts
+
+
+	def _read_volume(self, p_id, file_suffix, modality=None):
+		"""
+		Read a volume into an ndarray with (W,H,D) ordering. If a modality is given, the volume is also smoothed.
+		Served from the volume cache, if enabled.
+		"""
+		if self.data_format == 'hdf5':
+			file_path = f"{self.data_dir}/{p_id}.h5"
+			volume_name = PACKED_VOLUME_NAMES_BY_SUFFIX[file_suffix]
+		else:
+			file_path = f"{self.data_dir}/{p_id}{file_suffix}.nii.gz"
+			volume_name = None
+
+		def read_and_smooth():
+			if self.data_format == 'hdf5':
+				volume_np = read_packed_volume(file_path, volume_name, keep_whd_ordering=True)
+			else:
+				volume_np = sitk2np(sitk.ReadImage(file_path), keep_whd_ordering=True)
+			if modality is not None:
+				volume_np = self.preprocessor.smoothing_filter(volume_np, modality=modality)
+			return volume_np
+
+		if self.volume_cache is None:
+			return read_and_smooth()
+
+		if modality is not None:
+			sigma_mm, dtype = self.preprocessor.smooth_sigma_mm[modality], np.float32
+		else:
+			sigma_mm, dtype = None, None  # Labelmap -- Keep its original dtype
+		return self.volume_cache.fetch(p_id, file_path, sigma_mm, self.spacing_dict, read_and_smooth, dtype=dtype,
+		                               smoothing_backend=self.preprocessor.smoothing_backend, volume_name=volume_name)
+
+
 	def apply_transform(self, input_image_np, target_labelmap_np):
-		r = random.random()
-		if  r < 0.75:
+		r = self.rng.random()
+		if  r < 0.75 and self.spatial_augmenter is not None:
+			# Apply one of the 3 spatial transforms natively, with a coordinate map shared by both volumes
+			volumes_dict = self.spatial_augmenter({'input': input_image_np, 'target-labelmap': target_labelmap_np}, label_keys=['target-labelmap'])
+			input_image_np, target_labelmap_np = volumes_dict['input'], volumes_dict['target-labelmap']
+		elif  r < 0.75:
 			# Apply one of the 3 TorchIO spatial transforms. Need to pack the volumes into a TorchIO Subject for this.
 			subject_tio = self._create_torchio_subject(input_image_np, target_labelmap_np)
 			subject_tio = self.torchio_oneof_transform(subject_tio)
@@ -133,7 +253,8 @@ class HECKTORUnimodalDataset(torch.utils.data.Dataset):
 		else:
 			# PET intensity stretching
 			if self.input_modality == 'PET':
-				input_image_np = self.PET_stretch_transform(input_image_np)
+				# In place -- The volume is a private copy (fresh array or copy-on-write mapping of the cache)
+				input_image_np = self.PET_stretch_transform(input_image_np, inplace=input_image_np.dtype.kind == 'f')
 		return input_image_np, target_labelmap_np
 
 	def _create_torchio_subject(self, input_image_np, target_labelmap_np):
@@ -145,6 +266,11 @@ class HECKTORUnimodalDataset(torch.utils.data.Dataset):
 
 
 
+def _get_slices(start_idx, end_idx):
+	return tuple(slice(start_idx[i], end_idx[i]) for i in range(3))
+
+
+
 if __name__ == '__main__':
 
 	from data_utils.preprocessing import Preprocessor
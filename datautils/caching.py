@@ -0,0 +1,71 @@
+"""
+On-disk cache for the preprocessed (pre-augmentation) volumes of the datasets.
+
+Everything that happens before the augmentation step in the datasets' __getitem__ -- decoding the NIfTI files,
+reordering the dims and smoothing -- gives the same result every epoch. The cache stores this result once per
+volume as an uncompressed float32 .npy file in (D,H,W) ordering, which is then memory-mapped in the later epochs.
+"""
+
+import os
+import hashlib
+
+import numpy as np
+
+
+class VolumeCache():
+    """
+    Caches smoothed volumes keyed by (patient ID, source file mtime and size, smoothing sigma and backend, spacing).
+    A change to any of these leads to a new cache entry, so stale entries are never read.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def fetch(self, p_id, source_path, sigma_mm, spacing_dict, compute_fn, dtype=np.float32, smoothing_backend='scipy',
+              volume_name=None):
+        """
+        Args:
+            p_id: Patient ID
+            source_path: Path of the source image file
+            sigma_mm: Smoothing sigma used for this volume (None if not smoothed)
+            spacing_dict: Spacing dict of the dataset
+            compute_fn: Callable returning the volume as ndarray in (W,H,D) ordering. Called only on a cache miss
+            dtype: Dtype to store the volume in. None keeps the dtype returned by compute_fn
+            smoothing_backend: Smoothing backend used for this volume
+            volume_name: Name of the volume within the source file, for files holding several volumes
+        Returns:
+            volume_np: Copy-on-write memory-mapped ndarray in (W,H,D) ordering
+        """
+        cache_path = self._get_cache_path(p_id, source_path, sigma_mm, spacing_dict, smoothing_backend, volume_name)
+
+        if not os.path.exists(cache_path):
+            volume_np = compute_fn()
+            volume_np = np.ascontiguousarray(volume_np.transpose((2,1,0)), dtype=dtype)  # Store in (D,H,W)
+
+            # Write to a temporary file first, so that concurrent dataloader workers never read a partial file
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, volume_np)
+            os.replace(tmp_path, cache_path)
+
+        # Copy-on-write mapping -- the array stays writable without ever modifying the file
+        volume_np = np.load(cache_path, mmap_mode='c')
+        return volume_np.transpose((2,1,0))  # (W,H,D) view
+
+
+    def _get_cache_path(self, p_id, source_path, sigma_mm, spacing_dict, smoothing_backend, volume_name):
+        file_stat = os.stat(source_path)
+        key = (p_id,
+               os.path.basename(source_path),
+               volume_name,
+               file_stat.st_mtime_ns,
+               file_stat.st_size,
+               sigma_mm,
+               smoothing_backend,
+               tuple(sorted(spacing_dict.items())))
+        key_hash = hashlib.md5(repr(key).encode()).hexdigest()[:16]
+        file_name = os.path.basename(source_path).split('.')[0]
+        if volume_name is not None:
+            file_name = f"{file_name}_{volume_name}"
+        return f"{self.cache_dir}/{file_name}_{key_hash}.npy"
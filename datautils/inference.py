@@ -0,0 +1,40 @@
+"""
+Streaming sliding-window inference over a full volume, using PatchSampler3D and PatchAggregator3D.
+
+Patches are extracted from the sequential grid in batches, passed through the model and blended into the aggregator
+right away. Peak memory thus depends on the batch size and not on the total number of patches.
+"""
+
+import torch
+
+
+def sliding_window_inference(subject_dict, predictor, patch_sampler, patch_aggregator, batch_size=4, device='cpu'):
+    """
+    Args:
+        subject_dict: Dict of the subject's volumes, as returned by the datasets
+        predictor: Callable taking a batch dict of patches (on the given device) and returning the predicted
+                   probabilities as a tensor of shape (N,C,D,H,W). E.g. a wrapper around the model's forward pass
+        patch_sampler: PatchSampler3D instance. Its patch size, volume size, stride and padding must match the aggregator's
+        patch_aggregator: PatchAggregator3D instance, with the blending to be used
+        batch_size: Number of patches per forward pass
+        device: Device to move the patch batches to
+    Returns:
+        pred_labelmap: Tensor of shape (D,H,W)
+        pred_prob_volume: Tensor of shape (C,D,H,W)
+    """
+    if patch_sampler.patch_size != patch_aggregator.patch_size or patch_sampler.focal_point_stride != patch_aggregator.focal_point_stride:
+        raise ValueError("Patch sampler and patch aggregator use different patch sizes or focal point strides")
+    if patch_sampler.volume_size != patch_aggregator.volume_size or patch_sampler.padding != patch_aggregator.unpadding:
+        raise ValueError("Patch sampler and patch aggregator use different volume sizes or paddings")
+
+    patch_aggregator.reset()
+
+    with torch.no_grad():
+        for batch_dict in patch_sampler.get_sequential_batches(subject_dict, batch_size):
+            batch_dict = {key: value.to(device) for key, value in batch_dict.items()}
+            pred_prob_patches = predictor(batch_dict)
+            patch_aggregator.accumulate(pred_prob_patches)
+
+    pred_prob_volume = patch_aggregator.get_prob_volume()
+    pred_labelmap = pred_prob_volume.argmax(dim=0)
+    return pred_labelmap, pred_prob_volume
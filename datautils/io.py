@@ -80,4 +80,92 @@ def read_image(file_path, print_meta=True, print_stats=False):
                 \n Variance: {image_stats.GetVariance()} \n")
 
     print("\n")
-    return sitk_image
\ No newline at end of file
+    return sitk_image
+
+
+# Packed subject store -- One HDF5 file per patient, holding all modalities and the GTV mask
+PACKED_VOLUME_NAMES = ('PET', 'CT', 'GTV')
+
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is needed to read or write packed subject files -- Install it with 'pip install h5py'")
+    return h5py
+
+
+def write_packed_subject(file_path, volumes_dict, spacing, origin, bbox=None,
+                         image_dtype=np.float32, chunk_size=32, compression='gzip'):
+    """
+    Write a patient's volumes into a single chunked HDF5 file.
+    Parameters
+        file_path: Output .h5 file path
+        volumes_dict: Dict of ndarrays in (W,H,D) ordering, keyed by 'PET', 'CT' and 'GTV'. Missing keys are skipped
+        spacing, origin: Voxel spacing and origin of the volumes, in (x,y,z) order as given by sitk
+        bbox: Optional bounding box (x1,x2,y1,y2,z1,z2) in mm
+        image_dtype: Dtype to store PET and CT in -- np.float32 or np.float16. The GTV mask is always stored as uint8
+        chunk_size: Edge length of the cubic chunks. Reading a region decompresses only the chunks it overlaps
+        compression: HDF5 compression filter -- 'gzip', 'lzf' or None
+    """
+    h5py = _import_h5py()
+
+    with h5py.File(file_path, 'w') as f:
+        for name in PACKED_VOLUME_NAMES:
+            if name not in volumes_dict:
+                continue
+            dtype = np.uint8 if name == 'GTV' else image_dtype
+            volume_np = volumes_dict[name].transpose((2,1,0)).astype(dtype)  # Store in (D,H,W)
+            chunks = tuple(min(chunk_size, s) for s in volume_np.shape)
+            f.create_dataset(name, data=volume_np, chunks=chunks, compression=compression, shuffle=compression is not None)
+
+        f.attrs['spacing'] = np.asarray(spacing, dtype=np.float64)
+        f.attrs['origin'] = np.asarray(origin, dtype=np.float64)
+        if bbox is not None:
+            f.attrs['bbox'] = np.asarray(bbox, dtype=np.float64)
+
+
+def read_packed_volume(file_path, name, region=None, keep_whd_ordering=True):
+    """
+    Read one volume, or a sub-region of it, from a packed subject file. PET and CT are returned as float32.
+    Parameters
+        file_path: Packed subject .h5 file path
+        name: 'PET', 'CT' or 'GTV'
+        region: Optional tuple of 3 slices. Given in (W,H,D) order if keep_whd_ordering, else in (D,H,W)
+        keep_whd_ordering: Return the array in (W,H,D) ordering, same as sitk2np()
+    Returns
+        volume_np: ndarray
+    """
+    h5py = _import_h5py()
+
+    if region is None:
+        region = (slice(None),) * 3
+    if keep_whd_ordering:
+        region = tuple(reversed(region))
+
+    with h5py.File(file_path, 'r') as f:
+        volume_np = f[name][region]
+
+    if volume_np.dtype == np.float16:
+        volume_np = volume_np.astype(np.float32)
+    if keep_whd_ordering:
+        volume_np = volume_np.transpose((2,1,0))
+    return volume_np
+
+
+def read_packed_metadata(file_path):
+    """
+    Read the header of a packed subject file.
+    Returns
+        meta_dict: Python dictionary with the spacing, origin and bbox (None if not stored), as well as the
+                   volume size in (W,H,D) and the names of the stored volumes
+    """
+    h5py = _import_h5py()
+
+    with h5py.File(file_path, 'r') as f:
+        meta_dict = {'spacing': tuple(f.attrs['spacing'].tolist()),
+                     'origin': tuple(f.attrs['origin'].tolist()),
+                     'bbox': tuple(f.attrs['bbox'].tolist()) if 'bbox' in f.attrs else None,
+                     'volume-names': [name for name in PACKED_VOLUME_NAMES if name in f]}
+        meta_dict['volume-size'] = tuple(reversed(f[meta_dict['volume-names'][0]].shape))
+    return meta_dict
@@ -3,10 +3,15 @@ import torch
 
 
 class PatchAggregator3D():
-    def __init__(self, patch_size=[128,128,32], volume_size=[144,144,48], focal_point_stride=[5,5,5], overlap_handling=None, unpadding=[0,0,0]):
+    def __init__(self, patch_size=[128,128,32], volume_size=[144,144,48], focal_point_stride=[5,5,5], overlap_handling=None, unpadding=[0,0,0], blending='mean'):
 
         """
-        All arguments are apecified in (W,H,D) format
+        All size arguments are apecified in (W,H,D) format
+
+        Two ways to aggregate:
+            - aggregate(): From a list of labelmap patches, using overlap_handling (None or 'union')
+            - accumulate() + get_prob_volume() / get_labelmap(): From batches of probability patches, blended in place
+              into a running volume using blending ('max', 'mean' or 'gaussian')
         """
 
         self.patch_size = list(patch_size)
@@ -28,6 +33,11 @@ class PatchAggregator3D():
 
         self.valid_focal_points = self._get_valid_focal_points() # Valid focal points in volume coordinates
 
+        # Batched accumulation
+        self.blending = blending  # 'max', 'mean' or 'gaussian'
+        self.importance_map = self._get_importance_map() if self.blending == 'gaussian' else None
+        self.reset()
+
 
     def _get_valid_focal_points(self):
         patch_size = np.array(self.patch_size)
@@ -36,9 +46,9 @@ class PatchAggregator3D():
                             np.array(self.volume_size) - np.ceil(patch_size/2)
                            ]
 
-        z_range = np.arange(valid_indx_range[0][0], valid_indx_range[1][0] + 1, self.focal_point_stride[0]).astype(np.int)
-        y_range = np.arange(valid_indx_range[0][1], valid_indx_range[1][1] + 1, self.focal_point_stride[1]).astype(np.int)
-        x_range = np.arange(valid_indx_range[0][2], valid_indx_range[1][2] + 1, self.focal_point_stride[2]).astype(np.int)
+        z_range = np.arange(valid_indx_range[0][0], valid_indx_range[1][0] + 1, self.focal_point_stride[0]).astype(int)
+        y_range = np.arange(valid_indx_range[0][1], valid_indx_range[1][1] + 1, self.focal_point_stride[1]).astype(int)
+        x_range = np.arange(valid_indx_range[0][2], valid_indx_range[1][2] + 1, self.focal_point_stride[2]).astype(int)
         zs, ys, xs = np.meshgrid(z_range, y_range, x_range, indexing='ij')
         zs, ys, xs = zs.flatten(), ys.flatten(), xs.flatten()
 
@@ -62,7 +72,7 @@ class PatchAggregator3D():
 
             # Find the indices of the volume where the patch needs to be placed
             global_focal_point = np.array(self.valid_focal_points[i])
-            global_start_idxs = global_focal_point.astype(np.int) - np.floor(patch_size/2).astype(np.int)
+            global_start_idxs = global_focal_point.astype(int) - np.floor(patch_size/2).astype(int)
             z1, y1, x1 = global_start_idxs
             z2, y2, x2 = global_start_idxs + patch_size
 
@@ -71,9 +81,8 @@ class PatchAggregator3D():
                 full_volume[z1:z2, y1:y2, x1:x2] = patch
 
             elif self.overlap_handling == 'union':
-                full_volume_copy = full_volume.clone().detach()
-                full_volume[z1:z2, y1:y2, x1:x2] = patch.clone().detach()
-                full_volume = torch.max(full_volume, full_volume_copy)
+                # Only the patch region can change -- take the max there, in place
+                full_volume[z1:z2, y1:y2, x1:x2] = torch.max(full_volume[z1:z2, y1:y2, x1:x2], patch.to(full_volume.dtype))
 
         # If padding was used during patch sampling, remove it from the full volume
         if self.unpadding != [0,0,0]:
@@ -82,6 +91,89 @@ class PatchAggregator3D():
         return full_volume
 
 
+    def reset(self):
+        """
+        Clear the accumulated volumes, to start aggregating a new subject.
+        """
+        self.prob_volume = None    # Shape (C,D,H,W)
+        self.weight_volume = None  # Shape (D,H,W). Sum of the blending weights per voxel
+        self.num_accumulated_patches = 0
+
+
+    def accumulate(self, prob_patches):
+        """
+        Blend a batch of predicted probability patches into the running volume, in place.
+        Patches are matched with the focal points in sequential sampling order, continuing from the previous call.
+
+        Args:
+            prob_patches: Tensor of shape (N,C,D,H,W)
+        """
+        prob_patches = prob_patches.detach()
+        device = prob_patches.device
+
+        if self.prob_volume is None:
+            num_channels = prob_patches.shape[1]
+            self.prob_volume = torch.zeros([num_channels] + self.volume_size, device=device)
+            if self.blending != 'max':
+                self.weight_volume = torch.zeros(self.volume_size, device=device)
+                if self.blending == 'gaussian':
+                    self.importance_map = self.importance_map.to(device)
+
+        patch_size = np.array(self.patch_size)
+
+        for i in range(prob_patches.shape[0]):
+            global_focal_point = np.array(self.valid_focal_points[self.num_accumulated_patches])
+            z1, y1, x1 = global_focal_point.astype(int) - np.floor(patch_size/2).astype(int)
+            z2, y2, x2 = np.array([z1, y1, x1]) + patch_size
+
+            prob_region = self.prob_volume[:, z1:z2, y1:y2, x1:x2]
+            if self.blending == 'max':
+                torch.max(prob_region, prob_patches[i].to(prob_region.dtype), out=prob_region)
+            elif self.blending == 'mean':
+                prob_region += prob_patches[i]
+                self.weight_volume[z1:z2, y1:y2, x1:x2] += 1
+            elif self.blending == 'gaussian':
+                prob_region += prob_patches[i] * self.importance_map
+                self.weight_volume[z1:z2, y1:y2, x1:x2] += self.importance_map
+
+            self.num_accumulated_patches += 1
+
+
+    def get_prob_volume(self):
+        """
+        Returns:
+            prob_volume: Tensor of shape (C,D,H,W). Blended probabilities, with the padding removed
+        """
+        prob_volume = self.prob_volume
+        if self.blending != 'max':
+            prob_volume = prob_volume / self.weight_volume.clamp(min=1e-8)
+
+        # If padding was used during patch sampling, remove it
+        D, H, W = [self.volume_size[i] - self.unpadding[i] for i in range(3)]
+        return prob_volume[:, :D, :H, :W]
+
+
+    def get_labelmap(self):
+        """
+        Returns:
+            labelmap: Tensor of shape (D,H,W). Argmax over the blended probabilities
+        """
+        return self.get_prob_volume().argmax(dim=0)
+
+
+    def _get_importance_map(self, sigma_scale=0.125):
+        # Gaussian weights centred on the patch, so that predictions near the patch borders count less
+        axes = []
+        for size in self.patch_size:
+            coords = np.arange(size) - (size - 1) / 2
+            sigma = max(size * sigma_scale, 1e-3)
+            axes.append(np.exp(-coords**2 / (2 * sigma**2)))
+        importance_map = np.einsum('i,j,k->ijk', *axes)
+        importance_map = importance_map / importance_map.max()
+        importance_map = np.maximum(importance_map, 1e-3)  # Keep every voxel covered by a patch
+        return torch.from_numpy(importance_map.astype(np.float32))
+
+
 
 def get_pred_labelmap_patches_list(pred_prob_patches):
     """
@@ -3,17 +3,26 @@ The word "subject" used here doesn't mean any association with the TorchIO Subje
 The name is just convenient and hence is used here to define a set of volumes belonging to a single patient.
 """
 
-import random
+import math
+import queue
+import threading
+from collections import OrderedDict
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 from torch.utils.data import Dataset, DataLoader
 
+from datautils.rng import get_rng, spawn_seed_sequence, seed_components, get_worker_init_fn
+
+
+SAMPLING_MAP_CACHE_SIZE = 8  # Precomputed sampling maps kept in memory per sampler (and thus per worker), least recently used evicted
+
 
 class PatchSampler3D():
     """
     Samples 3D patches of specified size using the specified sampling method.
     """
-    def __init__(self, patch_size, volume_size=[144,144,48], sampling='random', focal_point_stride=[1,1,1], padding=[0,0,0]):
+    def __init__(self, patch_size, volume_size=[144,144,48], sampling='random', focal_point_stride=[1,1,1], padding=[0,0,0], sample_with_replacement=True, sampling_maps_dir=None, margin=[0,0,0], rng=None):
         self.patch_size = list(patch_size) # Specified in (W,H,D) order
         self.patch_size.reverse()    # Convert to (D,H,W) order
 
@@ -30,89 +39,182 @@ class PatchSampler3D():
         if self.padding != [0,0,0]:
             self.volume_size = [self.volume_size[i] + self.padding[i] for i in range(3)]
 
+        self.sample_with_replacement = sample_with_replacement # Used by the weighted sampling methods
+
+        # Directory of sampling maps precomputed using tools/cli_precompute_sampling_maps.py. Used by 'gtv-petfg-weighted-random'.
+        # Valid only when the subject volumes are not spatially augmented, since the maps are computed from the unaugmented volumes.
+        self.sampling_maps_dir = sampling_maps_dir
+        self.sampling_map_indices = OrderedDict()  # LRU cache of the loaded maps, per patient ID
+
+        # Extra context extracted on each side of the patches, for patch-level augmentation (see transforms.PatchAugmenter).
+        # The focal points are sampled as usual, based on the patch size alone.
+        self.margin = list(margin) # Specified in (W,H,D) order
+        self.margin.reverse() # Convert to (D,H,W) order
+
+        self.rng = get_rng(rng) # numpy Generator, see datautils/rng.py
+
 
     def get_samples(self, subject_dict, num_patches):
         # Sample valid focal points
         focal_points, sampling_prob_map = self._sample_valid_focal_points(num_patches, subject_dict)
 
+        # Lazy subject, holding a region reader instead of the volumes -- Read only the patch regions
+        if 'region-reader' in subject_dict:
+            return self._read_patches(subject_dict, focal_points), sampling_prob_map
+
+        # Get the volumes as ndarrays once per subject. The padding is not applied to them, but handled during patch extraction.
+        # The shape is (C,D,H,W) for PET and CT, and (D,H,W) for the labelmap.
+        volumes_dict = {key: subject_dict[key].numpy() for key in subject_dict.keys() if key in ['PET', 'CT', 'PET-CT', 'target-labelmap']}
+
         # Extract patches from the subject volumes
-        patch_size = np.array(self.patch_size)
         patches_list = []  # List of dicts
         for f_pt in focal_points:
+            start_idx, end_idx = self._get_patch_bounds(f_pt)
+
             patch = {}
-            f_pt = np.array(f_pt)
-            start_idx = f_pt.astype(np.int) - np.floor(patch_size/2).astype(np.int)
+            for key, volume in volumes_dict.items():
+                patch[key] = torch.from_numpy(self._extract_patch(volume, start_idx, end_idx))
+
+            patches_list.append(patch)
+
+        return patches_list, sampling_prob_map
+
+
+    def get_sequential_batches(self, subject_dict, batch_size):
+        """
+        Generator over all the patches of the sequential grid, in the same order as the 'sequential' sampling method.
+        Only one batch of patches is in memory at a time.
+
+        Yields:
+            batch_dict: Dict of tensors, each with a leading batch dim of size at most batch_size
+        """
+        valid_indx_range = get_valid_indx_range(self.patch_size, self.volume_size)
+        focal_points = self._get_sequential_focal_points(valid_indx_range)
+        volumes_dict = {key: subject_dict[key].numpy() for key in subject_dict.keys() if key in ['PET', 'CT', 'PET-CT', 'target-labelmap']}
+
+        patch_size = np.array(self.patch_size).astype(int)
+        for i in range(0, len(focal_points), batch_size):
+            batch_focal_points = focal_points[i : i + batch_size]
+            batch_dict = {}
+            for key, volume in volumes_dict.items():
+                # Copy the patches straight into the batch array
+                batch_np = np.empty((len(batch_focal_points),) + volume.shape[:-3] + tuple(patch_size), dtype=volume.dtype)
+                for j, f_pt in enumerate(batch_focal_points):
+                    start_idx = np.array(f_pt) - np.floor(patch_size/2).astype(int)
+                    batch_np[j] = self._extract_patch(volume, start_idx, start_idx + patch_size)
+                batch_dict[key] = torch.from_numpy(batch_np)
+            yield batch_dict
+
+
+    def _get_sequential_focal_points(self, valid_indx_range):
+        # Note: arange() takes exlusive range
+        z_range = np.arange(valid_indx_range[0][0], valid_indx_range[1][0] + 1, self.focal_point_stride[0]).astype(int)
+        y_range = np.arange(valid_indx_range[0][1], valid_indx_range[1][1] + 1, self.focal_point_stride[1]).astype(int)
+        x_range = np.arange(valid_indx_range[0][2], valid_indx_range[1][2] + 1, self.focal_point_stride[2]).astype(int)
+        zs, ys, xs = np.meshgrid(z_range, y_range, x_range, indexing='ij')
+        zs, ys, xs = zs.flatten(), ys.flatten(), xs.flatten()
+        focal_points = [(zs[i], ys[i], xs[i]) for i in range(zs.shape[0])]
+        return focal_points
+
+
+    def _extract_patch(self, volume, start_idx, end_idx):
+        """
+        Extract the region [start_idx, end_idx) along the last 3 dims (D,H,W) of the volume.
+        If the region lies within the volume, a view is returned and nothing is copied. Otherwise, only the patch is
+        allocated and the part of it outside the volume is zero-filled -- same result as slicing a zero-padded volume.
+        """
+        spatial_shape = np.array(volume.shape[-3:])
+        if np.all(start_idx >= 0) and np.all(end_idx <= spatial_shape):
             z1, y1, x1 = start_idx
-            end_idx = start_idx.astype(np.int) + patch_size.astype(np.int)
             z2, y2, x2 = end_idx
+            return volume[..., z1:z2, y1:y2, x1:x2]
 
-            for key in subject_dict.keys():
-                volume = subject_dict[key].numpy()
+        src_start, src_end = _clip_region(start_idx, end_idx, spatial_shape)
+        region = volume[..., src_start[0]:src_end[0], src_start[1]:src_end[1], src_start[2]:src_end[2]]
+        return _zero_pad_region(region, start_idx, end_idx, src_start)
 
-                if key == 'PET' or key == 'CT' or key == 'PET-CT': # The shape is (C,D,H,W) for PET and CT.
-                    if self.padding != [0,0,0]:    volume = np.pad(volume, pad_width=[(0,0), (0,self.padding[0]), (0,self.padding[1]), (0,self.padding[2])])
-                    patch[key] = volume[:, z1:z2, y1:y2, x1:x2]
 
-                elif key == 'target-labelmap':  # Labelmap has shape (D,H,W)
-                    if self.padding != [0,0,0]:   volume = np.pad(volume, pad_width=[(0,self.padding[0]), (0,self.padding[1]), (0,self.padding[2])])
-                    patch[key] = volume[z1:z2, y1:y2, x1:x2]
+    def _get_patch_bounds(self, focal_point):
+        # Region [start_idx, end_idx) of the patch around the focal point, including the margin
+        patch_size, margin = np.array(self.patch_size).astype(int), np.array(self.margin).astype(int)
+        start_idx = np.array(focal_point).astype(int) - np.floor(patch_size/2).astype(int) - margin
+        end_idx = start_idx + patch_size + 2 * margin
+        return start_idx, end_idx
 
-                patch[key] = torch.from_numpy(patch[key])
-                #subject_dict[key] = torch.from_numpy(subject_dict[key])
 
-            patches_list.append(patch)
+    def _read_patches(self, subject_dict, focal_points):
+        """
+        Read the patches of a lazy subject through its region reader, in a single call. Only the part of each patch
+        lying within the volume is read, the rest is zero-filled as in _extract_patch().
+        """
+        spatial_shape = np.array(subject_dict['volume-size'])
 
-        return patches_list, sampling_prob_map
+        patch_regions, read_regions = [], []
+        for f_pt in focal_points:
+            start_idx, end_idx = self._get_patch_bounds(f_pt)
+            src_start, src_end = _clip_region(start_idx, end_idx, spatial_shape)
+            patch_regions.append((start_idx, end_idx, src_start))
+            read_regions.append((src_start, src_end))
+
+        region_dicts = subject_dict['region-reader'](read_regions)
+
+        patches_list = []
+        for (start_idx, end_idx, src_start), region_dict in zip(patch_regions, region_dicts):
+            patch = {}
+            for key, region in region_dict.items():
+                if key not in ['PET', 'CT', 'PET-CT', 'target-labelmap']:
+                    continue
+                region = region.numpy()
+                if region.shape[-3:] != tuple(end_idx - start_idx):
+                    region = _zero_pad_region(region, start_idx, end_idx, src_start)
+                patch[key] = torch.from_numpy(region)
+            patches_list.append(patch)
+        return patches_list
 
 
     def _sample_valid_focal_points(self, num_patches, subject_dict):
         # Use the labelmap to determine volume shape
         #volume_shape = subject_dict['target-labelmap'].shape # (D,H,W)
-        patch_size = np.array(self.patch_size).astype(np.float)
+        patch_size = np.array(self.patch_size).astype(float)
 
         # Get valid index range for focal points - upper-bound inclusive
-        valid_indx_range = [
-                            np.zeros(3) + np.floor(patch_size/2),
-                            np.array(self.volume_size) - np.ceil(patch_size/2)
-                           ]
+        valid_indx_range = get_valid_indx_range(self.patch_size, self.volume_size)
+
+        sampling_prob_map = None  # Only used by the weighted sampling methods
 
         if self.sampling == 'random':
             # Uniform random over all valid focal points
             # Note: randint() takes inclusive range
-            zs = np.random.randint(valid_indx_range[0][0], valid_indx_range[1][0], num_patches)
-            ys = np.random.randint(valid_indx_range[0][1], valid_indx_range[1][1], num_patches)
-            xs = np.random.randint(valid_indx_range[0][2], valid_indx_range[1][2], num_patches)
+            zs = self.rng.integers(valid_indx_range[0][0], valid_indx_range[1][0], num_patches)
+            ys = self.rng.integers(valid_indx_range[0][1], valid_indx_range[1][1], num_patches)
+            xs = self.rng.integers(valid_indx_range[0][2], valid_indx_range[1][2], num_patches)
             focal_points = [(zs[i], ys[i], xs[i]) for i in range(num_patches)]
 
         elif self.sampling == 'sequential':
             '''
             Sequental sampling, used during inference
             '''
-            # Note: arange() takes exlusive range
-            z_range = np.arange(valid_indx_range[0][0], valid_indx_range[1][0] + 1, self.focal_point_stride[0]).astype(np.int)
-            y_range = np.arange(valid_indx_range[0][1], valid_indx_range[1][1] + 1, self.focal_point_stride[1]).astype(np.int)
-            x_range = np.arange(valid_indx_range[0][2], valid_indx_range[1][2] + 1, self.focal_point_stride[2]).astype(np.int)
-            zs, ys, xs = np.meshgrid(z_range, y_range, x_range, indexing='ij')
-            zs, ys, xs = zs.flatten(), ys.flatten(), xs.flatten()
-            focal_points = [(zs[i], ys[i], xs[i]) for i in range(num_patches)]
+            focal_points = self._get_sequential_focal_points(valid_indx_range)[:num_patches]
 
         elif self.sampling == 'strided-random':
             '''
             Uniform random sampling over spare valid focal points
             '''
-            z_range = np.arange(valid_indx_range[0][0], valid_indx_range[1][0] + 1, self.focal_point_stride[0]).astype(np.int)
-            y_range = np.arange(valid_indx_range[0][1], valid_indx_range[1][1] + 1, self.focal_point_stride[1]).astype(np.int)
-            x_range = np.arange(valid_indx_range[0][2], valid_indx_range[1][2] + 1, self.focal_point_stride[2]).astype(np.int)
+            z_range = np.arange(valid_indx_range[0][0], valid_indx_range[1][0] + 1, self.focal_point_stride[0]).astype(int)
+            y_range = np.arange(valid_indx_range[0][1], valid_indx_range[1][1] + 1, self.focal_point_stride[1]).astype(int)
+            x_range = np.arange(valid_indx_range[0][2], valid_indx_range[1][2] + 1, self.focal_point_stride[2]).astype(int)
             zs, ys, xs = np.meshgrid(z_range, y_range, x_range, indexing='ij')
             zs, ys, xs = zs.flatten(), ys.flatten(), xs.flatten()
             focal_points = [(zs[i], ys[i], xs[i]) for i in range(num_patches)]
-            random_indxs = np.random.choice(len(focal_points), size=num_patches, replace=False)
+            random_indxs = self.rng.choice(len(focal_points), size=num_patches, replace=False)
             focal_points = [focal_points[i] for i in random_indxs]
 
         elif self.sampling == 'suv-weighted-random':
             '''
             Random sampling, biased to high SUV regions in PET
             '''
+            if 'region-reader' in subject_dict:
+                raise ValueError("'suv-weighted-random' sampling needs the full PET volume, and can't be used with region reads")
             # Get the PET
             PET_volume = subject_dict['PET'][0].clone().detach().numpy()
             intensity_threshold = 0.1 * 20 # [0,1] range.
@@ -131,53 +233,64 @@ class PatchSampler3D():
             '''
             Random sampling from PET foreground, biased to patches containing GTV
             '''
-            # Get the PET foreground
-            PET_volume = subject_dict['PET'][0].clone().detach().numpy()
-            intensity_threshold = 0.1 # [0,1] range
-            PET_volume = (PET_volume > intensity_threshold).astype(np.float32) # Apply threshold to get foreground
-
-            # Get the GTV labelmap and create a high-probability zone around it
-            gtv_labelmap = subject_dict['target-labelmap'].clone().detach().numpy()
-            gtv_centre_of_mass = np.argwhere(gtv_labelmap == 1).mean(axis=0)
-            comz, comy, comx = tuple(gtv_centre_of_mass.astype(int))
-            high_prob_zone_map = gtv_labelmap.copy()
-            high_prob_zone_map[comz - math.ceil(patch_size[0]/2) : comz + math.floor(patch_size[0]/2),
-                               comy - math.ceil(patch_size[1]/2) : comy + math.floor(patch_size[1]/2),
-                               comx - math.ceil(patch_size[2]/2) : comx + math.floor(patch_size[2]/2)] = 1
-
-            # Compose the sampling probability map
-            sampling_prob_map = np.zeros_like(gtv_labelmap)
-            sampling_prob_map = PET_volume + 5 * high_prob_zone_map
-
-            # Normalize to form a true probability distribution
-            sampling_prob_map = sampling_prob_map / np.sum(sampling_prob_map)
-
-            # Sample focal points using this probability map
-            focal_points = self._sample_from_probability_map(num_patches, sampling_prob_map, valid_indx_range)
+            if self.sampling_maps_dir is not None:
+                # Reuse the precomputed map of the patient. It has to be on the subject's grid
+                volume_shape = subject_dict['volume-size'] if 'region-reader' in subject_dict else subject_dict['target-labelmap'].shape
+                if [volume_shape[i] + self.padding[i] for i in range(3)] != self.volume_size:
+                    raise ValueError(f"Volume of {subject_dict['patient-id']} doesn't match the sampler's volume size, so its precomputed sampling map doesn't apply")
+                focal_point_candidates, cumulative_weights = self._load_sampling_map_index(subject_dict['patient-id'])
+                focal_points = self._sample_from_sampling_map_index(num_patches, focal_point_candidates, cumulative_weights)
+            elif 'region-reader' in subject_dict:
+                raise ValueError("'gtv-petfg-weighted-random' sampling with region reads needs precomputed sampling maps")
+            else:
+                PET_volume = subject_dict['PET'][0].clone().detach().numpy()
+                gtv_labelmap = subject_dict['target-labelmap'].clone().detach().numpy()
+                sampling_prob_map = get_gtv_petfg_sampling_prob_map(PET_volume, gtv_labelmap, patch_size)
+
+                # Sample focal points using this probability map
+                focal_points = self._sample_from_probability_map(num_patches, sampling_prob_map, valid_indx_range)
 
         return focal_points, sampling_prob_map
 
 
     def _sample_from_probability_map(self, num_patches, sampling_prob_map, valid_indx_range):
-        relevant_coords = np.argwhere(sampling_prob_map > 0)
-        distribution = sampling_prob_map[sampling_prob_map > 0].flatten()
-
-        patch_counter = 0
-        sampled_indxs = []
-        while patch_counter < num_patches:
-            sample = np.random.choice(len(relevant_coords), size=1, p=distribution)[0]
-            sample_coord = relevant_coords[sample]
-            # Filter out invalid samples
-            if sample_coord[0] > valid_indx_range[0][0] and sample_coord[0] < valid_indx_range[1][0] \
-            and  sample_coord[1] > valid_indx_range[0][1] and sample_coord[1] < valid_indx_range[1][1] \
-            and sample_coord[2] > valid_indx_range[0][2] and sample_coord[2] < valid_indx_range[1][2]:
-                sampled_indxs.append(sample)
-                patch_counter += 1
-
-        focal_points = [tuple(relevant_coords[i]) for i in sampled_indxs]
+        """
+        Draw all the focal points in a single call, from the probability map restricted to the valid focal point region.
+        """
+        focal_point_candidates, cumulative_weights = get_sampling_map_index(sampling_prob_map, valid_indx_range)
+        return self._sample_from_sampling_map_index(num_patches, focal_point_candidates, cumulative_weights)
+
+
+    def _sample_from_sampling_map_index(self, num_patches, focal_point_candidates, cumulative_weights):
+        if self.sample_with_replacement:
+            # Inverse transform sampling -- Binary search in the cumulative weights, O(log n) per draw
+            draws = self.rng.random(num_patches) * cumulative_weights[-1]
+            sampled_indxs = np.searchsorted(cumulative_weights, draws, side='right')
+            sampled_indxs = np.minimum(sampled_indxs, len(cumulative_weights) - 1) # Guard against float round-off at the end
+        else:
+            distribution = np.diff(cumulative_weights, prepend=0)
+            distribution = distribution / np.sum(distribution)
+            sampled_indxs = self.rng.choice(len(cumulative_weights), size=num_patches, replace=False, p=distribution)
+
+        focal_points = [tuple(f_pt) for f_pt in focal_point_candidates[sampled_indxs].astype(int)]
         return focal_points
 
 
+    def _load_sampling_map_index(self, p_id):
+        if p_id in self.sampling_map_indices:
+            self.sampling_map_indices.move_to_end(p_id)
+            return self.sampling_map_indices[p_id]
+
+        sampling_map = np.load(f"{self.sampling_maps_dir}/{p_id}_sampling_map.npz")
+        # The candidates are only valid for the patch size and (padded) volume size they were computed for
+        if list(sampling_map['patch_size']) != self.patch_size or list(sampling_map['volume_size']) != self.volume_size:
+            raise ValueError(f"Sampling map of {p_id} was computed for a different patch size or volume size")
+        self.sampling_map_indices[p_id] = (sampling_map['focal_point_candidates'], sampling_map['cumulative_weights'])
+        if len(self.sampling_map_indices) > SAMPLING_MAP_CACHE_SIZE:
+            self.sampling_map_indices.popitem(last=False)
+        return self.sampling_map_indices[p_id]
+
+
 class PatchSampler2D():
     """
     Samples 2D axial slice patches of specified x-y size using the specified sampling method.
@@ -185,7 +298,7 @@ class PatchSampler2D():
     TODO: Old version. Make all the required changes based on PatchSampler3D.
 
     """
-    def __init__(self, patch_size, sampling='random', focal_point_stride=(1,1)):
+    def __init__(self, patch_size, sampling='random', focal_point_stride=(1,1), rng=None):
         self.patch_size = list(patch_size) # Specified in (W,H) order
         self.patch_size.reverse()    # Convert to (H,W) order
 
@@ -194,6 +307,8 @@ class PatchSampler2D():
         self.focal_point_stride = list(focal_point_stride)  # Useful while using sequential sampling. Specified in (W,H) order
         self.focal_point_stride.reverse()  # Convert to (H,W) order
 
+        self.rng = get_rng(rng) # numpy Generator, see datautils/rng.py
+
 
     def get_samples(self, subject_dict, num_patches):
         # Sample valid focal points
@@ -206,8 +321,8 @@ class PatchSampler2D():
             patch = {}
             f_pt = np.array(f_pt)
             z = f_pt[0]
-            xy_start_idx = (f_pt[1:] - np.floor(patch_size/2)).astype(np.int)
-            xy_end_idx = (f_pt[1:] + np.ceil(patch_size/2)).astype(np.int)
+            xy_start_idx = (f_pt[1:] - np.floor(patch_size/2)).astype(int)
+            xy_end_idx = (f_pt[1:] + np.ceil(patch_size/2)).astype(int)
 
             for key in subject_dict.keys():
                 if key == 'PET' or key == 'CT' or key == 'PET-CT': # The shape is (C,D,H,W) for PET and CT.
@@ -223,7 +338,7 @@ class PatchSampler2D():
     def _sample_valid_focal_points(self, subject_dict, num_patches):
         # Use the labelmap to determine volume shape
         volume_shape = subject_dict['target-labelmap'].shape # (D,H,W)
-        patch_size = np.array(self.patch_size).astype(np.float)
+        patch_size = np.array(self.patch_size).astype(float)
 
         # Get valid index range for focal points - upper-bound inclusive
         valid_indx_range = [
@@ -233,14 +348,14 @@ class PatchSampler2D():
 
         if self.sampling == 'random':
             # randint takes inclusive range
-            zs = np.random.randint(0, volume_shape[0]-1, num_patches)
-            ys = np.random.randint(valid_indx_range[0][0], valid_indx_range[1][0], num_patches)
-            xs = np.random.randint(valid_indx_range[0][1], valid_indx_range[1][1], num_patches)
+            zs = self.rng.integers(0, volume_shape[0]-1, num_patches)
+            ys = self.rng.integers(valid_indx_range[0][0], valid_indx_range[1][0], num_patches)
+            xs = self.rng.integers(valid_indx_range[0][1], valid_indx_range[1][1], num_patches)
         elif self.sampling == 'sequential':
             # arange takes exclusive range
-            z_range = np.arange(0, volume_shape[0]).astype(np.int)
-            y_range = np.arange(valid_indx_range[0][0], valid_indx_range[1][0] + 1, self.focal_point_stride[0]).astype(np.int)
-            x_range = np.arange(valid_indx_range[0][1], valid_indx_range[1][1] + 1, self.focal_point_stride[1]).astype(np.int)
+            z_range = np.arange(0, volume_shape[0]).astype(int)
+            y_range = np.arange(valid_indx_range[0][0], valid_indx_range[1][0] + 1, self.focal_point_stride[0]).astype(int)
+            x_range = np.arange(valid_indx_range[0][1], valid_indx_range[1][1] + 1, self.focal_point_stride[1]).astype(int)
             zs, ys, xs = np.meshgrid(z_range, y_range, x_range, indexing='ij')
             zs, ys, xs = zs.flatten(), ys.flatten(), xs.flatten()
 
@@ -251,7 +366,7 @@ class PatchSampler2D():
 
 class PatchQueue(Dataset):
 
-    def __init__(self, dataset, max_length, samples_per_volume, sampler, num_workers, shuffle_subjects=True, shuffle_patches=True):
+    def __init__(self, dataset, max_length, samples_per_volume, sampler, num_workers, shuffle_subjects=True, shuffle_patches=True, patch_transform=None, rng=None):
         self.dataset = dataset
         self.max_length = max_length
         self.samples_per_volume = samples_per_volume
@@ -259,6 +374,9 @@ class PatchQueue(Dataset):
         self.num_workers = num_workers
         self.shuffle_subjects = shuffle_subjects
         self.shuffle_patches = shuffle_patches
+        self.patch_transform = patch_transform  # Optional callable applied to each patch dict, e.g. transforms.PatchAugmenter
+        self.rng = get_rng(rng) # numpy Generator -- Drives the shuffling and the seeds of the subject loader's workers
+        _check_sampling_maps(dataset, sampler)
 
         # Additional attributes
         self.total_subjects = len(self.dataset)
@@ -292,7 +410,9 @@ class PatchQueue(Dataset):
         # Read the subjects, sample patches from the volumes and populate the queue
         for _ in range(num_subjects_for_queue):
             subject_sample = self._get_next_subject_sample()
-            patches = self.sampler.get_samples(subject_sample, self.samples_per_volume)
+            patches, _ = self.sampler.get_samples(subject_sample, self.samples_per_volume)
+            if self.patch_transform is not None:
+                patches = [self.patch_transform(patch) for patch in patches]
             self.patches_list.extend(patches)
 
             self.counter += 1
@@ -300,7 +420,7 @@ class PatchQueue(Dataset):
 
         # Shuffle the queue
         if self.shuffle_patches:
-            random.shuffle(self.patches_list)
+            self.rng.shuffle(self.patches_list)
 
     def _get_next_subject_sample(self):
         # A StopIteration exception is expected when the queue is empty
@@ -313,16 +433,334 @@ class PatchQueue(Dataset):
         return subject_sample
 
     def _get_subjects_iterable(self):
+        # Subject order and worker RNG streams are drawn from the queue's own generator, anew for every pass
+        subject_order = self.rng.permutation(self.total_subjects).tolist() if self.shuffle_subjects else None
         subjects_loader = DataLoader(self.dataset,
                                      num_workers=self.num_workers,
                                      collate_fn=lambda x: x[0],
-                                     shuffle=self.shuffle_subjects,
+                                     sampler=subject_order,
+                                     worker_init_fn=get_worker_init_fn(spawn_seed_sequence(self.rng)),
                                     )
         # print("subjects loader length:", len(subjects_loader))
         return iter(subjects_loader)
 
 
 
+class PrefetchPatchQueue(Dataset):
+    """
+    Patch queue where background worker processes continuously load subjects, sample patches from them and push the
+    patches into a shared bounded buffer. Subject loading thus overlaps with the training step, and __getitem__ never
+    waits for a full refill -- only for a single patch, if the workers have fallen behind.
+
+    Watermarks:
+        - High: The shared buffer holds at most max_length patches. Workers block once it is full.
+        - Low: When the local shuffle buffer drops to low_watermark patches, it is topped up with the patches that are
+               ready in the shared buffer.
+
+    With shared_memory_buffer=True, the shared buffer is a SharedPatchBuffer -- workers write the patches directly into
+    preallocated shared-memory slots and only slot indices are passed between processes.
+
+    The parallelism comes from the queue's own workers, so wrap this in a DataLoader with num_workers=0.
+    """
+    def __init__(self, dataset, max_length, samples_per_volume, sampler, num_workers, shuffle_subjects=True, shuffle_patches=True, low_watermark=None, shared_memory_buffer=False, patch_transform=None, rng=None):
+        self.dataset = dataset
+        self.max_length = max_length
+        self.samples_per_volume = samples_per_volume
+        self.sampler = sampler  # Instance of the custom PatchSampler() class
+        self.patch_transform = patch_transform  # Optional callable applied to each patch dict in the workers
+        self.rng = get_rng(rng) # numpy Generator -- Drives the shuffling, and the RNG streams of the feeder thread and the workers
+        _check_sampling_maps(dataset, sampler)
+        self.num_workers = max(num_workers, 1)
+        self.shuffle_subjects = shuffle_subjects
+        self.shuffle_patches = shuffle_patches
+        self.low_watermark = samples_per_volume if low_watermark is None else low_watermark
+        self.shared_memory_buffer = shared_memory_buffer
+
+        # Additional attributes
+        self.total_subjects = len(self.dataset)
+        self.iterations_per_epoch = self.total_subjects * self.samples_per_volume
+
+        # Data structures
+        self.patches_list = []  # List of dicts -- Local shuffle buffer
+
+        # Workers and shared buffers are created on the first __getitem__ call
+        self.workers = None
+        self.subject_indices_queue = None
+        self.patches_buffer = None
+        self.stop_event = None
+
+
+    def __len__(self):
+        return self.iterations_per_epoch
+
+
+    def __getitem__(self, _):
+        if self.workers is None:
+            self._start_workers()
+
+        if len(self.patches_list) <= self.low_watermark:
+            self._pull_patches()
+
+        sample_dict = self.patches_list.pop()
+        return sample_dict
+
+
+    def close(self):
+        if self.workers is None:
+            return
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.workers = None
+
+
+    def __del__(self):
+        self.close()
+
+
+    def _start_workers(self):
+        self.subject_indices_queue = mp.Queue(maxsize=2 * self.num_workers)
+        if self.shared_memory_buffer:
+            self.patches_buffer = SharedPatchBuffer(self.max_length, self._get_patch_spec())
+        else:
+            self.patches_buffer = mp.Queue(maxsize=self.max_length)
+        self.stop_event = threading.Event()
+
+        # Independent RNG streams for the feeder thread and each worker -- No duplicate focal points across workers
+        seed_sequences = spawn_seed_sequence(self.rng).spawn(self.num_workers + 1)
+
+        # Feed subject indices, one epoch after another, from a thread in the main process
+        feeder = threading.Thread(target=self._feed_subject_indices, args=(get_rng(seed_sequences[-1]),), daemon=True)
+        feeder.start()
+
+        self.workers = []
+        for worker_id in range(self.num_workers):
+            worker = mp.Process(target=_prefetch_patches,
+                                args=(self.dataset, self.sampler, self.samples_per_volume, self.patch_transform,
+                                      self.subject_indices_queue, self.patches_buffer, seed_sequences[worker_id]),
+                                daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def _get_patch_spec(self):
+        # Shapes and dtypes of the patch tensors, from a single patch of the first subject
+        subject_sample = self.dataset[0]
+        patches, _ = self.sampler.get_samples(subject_sample, 1)
+        if self.patch_transform is not None:
+            patches = [self.patch_transform(patches[0])]
+        patch_spec = {key: (tuple(value.shape), value.dtype) for key, value in patches[0].items()}
+        return patch_spec
+
+
+    def _feed_subject_indices(self, rng):
+        while not self.stop_event.is_set():
+            subject_indices = list(range(self.total_subjects))
+            if self.shuffle_subjects:
+                rng.shuffle(subject_indices)
+            for idx in subject_indices:
+                while not self.stop_event.is_set():
+                    try:
+                        self.subject_indices_queue.put(idx, timeout=1.0)
+                        break
+                    except queue.Full:
+                        continue
+
+
+    def _pull_patches(self):
+        # Block only until at least one patch is available
+        while len(self.patches_list) == 0:
+            try:
+                self.patches_list.append(self.patches_buffer.get(timeout=1.0))
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("All PrefetchPatchQueue workers have exited")
+
+        # Then take whatever else is ready, without waiting
+        while len(self.patches_list) < self.max_length:
+            try:
+                self.patches_list.append(self.patches_buffer.get_nowait())
+            except queue.Empty:
+                break
+
+        # Shuffle the local buffer
+        if self.shuffle_patches:
+            self.rng.shuffle(self.patches_list)
+
+
+def _prefetch_patches(dataset, sampler, samples_per_volume, patch_transform, subject_indices_queue, patches_buffer, seed_sequence):
+    """
+    Worker loop of PrefetchPatchQueue.
+    """
+    # Own RNG streams for the worker's copies of the dataset, sampler and patch transform
+    seed_components([component for component in [dataset, sampler, patch_transform] if component is not None], seed_sequence)
+
+    while True:
+        idx = subject_indices_queue.get()
+        subject_sample = dataset[idx]
+        patches, _ = sampler.get_samples(subject_sample, samples_per_volume)
+        for patch in patches:
+            if patch_transform is not None:
+                patch = patch_transform(patch)
+            if isinstance(patches_buffer, SharedPatchBuffer):
+                patches_buffer.put(patch)
+            else:
+                # Patches can be views of the subject volumes. Clone, so that only the patch is moved to shared memory.
+                patches_buffer.put({key: value.clone() for key, value in patch.items()})
+
+
+class SharedPatchBuffer():
+    """
+    Ring buffer of patch slots preallocated in shared memory, for passing patches from worker processes to the main process.
+    Writers copy a patch into a free slot and pass on the slot index. The reader copies the patch out and recycles the slot.
+    Memory is fixed at num_slots patches, independent of the number of workers, and no patch is ever pickled.
+    """
+    def __init__(self, num_slots, patch_spec):
+        """
+        Args:
+            num_slots: Number of patches the buffer can hold
+            patch_spec: Dict of the form {key: (shape, dtype)}, describing the tensors of a patch
+        """
+        self.slots = {key: torch.zeros((num_slots,) + tuple(shape), dtype=dtype).share_memory_()
+                      for key, (shape, dtype) in patch_spec.items()}
+
+        self.free_slots = mp.Queue()
+        self.filled_slots = mp.Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+
+    def put(self, patch):
+        # Blocks while all slots are filled
+        slot = self.free_slots.get()
+        for key, slot_tensors in self.slots.items():
+            slot_tensors[slot].copy_(patch[key])
+        self.filled_slots.put(slot)
+
+
+    def get(self, timeout=None):
+        slot = self.filled_slots.get(timeout=timeout)
+        return self._read_slot(slot)
+
+
+    def get_nowait(self):
+        slot = self.filled_slots.get_nowait()
+        return self._read_slot(slot)
+
+
+    def _read_slot(self, slot):
+        patch = {key: slot_tensors[slot].clone() for key, slot_tensors in self.slots.items()}
+        self.free_slots.put(slot)
+        return patch
+
+
+
+def _clip_region(start_idx, end_idx, spatial_shape):
+    """
+    Part of the region [start_idx, end_idx) lying within a volume of the given spatial shape.
+    """
+    src_start = np.maximum(start_idx, 0)
+    src_end = np.maximum(np.minimum(end_idx, spatial_shape), src_start)
+    return src_start, src_end
+
+
+def _zero_pad_region(region, start_idx, end_idx, src_start):
+    """
+    Place a region read from [src_start, src_start + region shape) into a zero-filled array spanning [start_idx, end_idx).
+    """
+    patch = np.zeros(region.shape[:-3] + tuple(end_idx - start_idx), dtype=region.dtype)
+    dst_start = src_start - start_idx
+    dst_end = dst_start + np.array(region.shape[-3:])
+    patch[..., dst_start[0]:dst_end[0], dst_start[1]:dst_end[1], dst_start[2]:dst_end[2]] = region
+    return patch
+
+
+def get_gtv_petfg_sampling_prob_map(PET_volume, gtv_labelmap, patch_size):
+    """
+    Sampling probability map of the 'gtv-petfg-weighted-random' method -- PET foreground, with a 5x higher weight
+    in a patch-sized zone around the GTV centre of mass.
+
+    Args:
+        PET_volume: ndarray of shape (D,H,W). Normalized PET
+        gtv_labelmap: ndarray of shape (D,H,W)
+        patch_size: Patch size in (D,H,W) ordering
+    Returns:
+        sampling_prob_map: ndarray of shape (D,H,W), summing to 1
+    """
+    # Get the PET foreground
+    intensity_threshold = 0.1 # [0,1] range
+    PET_foreground = (PET_volume > intensity_threshold).astype(np.float32) # Apply threshold to get foreground
+
+    # Create a high-probability zone around the GTV
+    gtv_centre_of_mass = np.argwhere(gtv_labelmap == 1).mean(axis=0)
+    comz, comy, comx = tuple(gtv_centre_of_mass.astype(int))
+    high_prob_zone_map = gtv_labelmap.copy()
+    high_prob_zone_map[max(comz - math.ceil(patch_size[0]/2), 0) : comz + math.floor(patch_size[0]/2),
+                       max(comy - math.ceil(patch_size[1]/2), 0) : comy + math.floor(patch_size[1]/2),
+                       max(comx - math.ceil(patch_size[2]/2), 0) : comx + math.floor(patch_size[2]/2)] = 1
+
+    # Compose the sampling probability map
+    sampling_prob_map = PET_foreground + 5 * high_prob_zone_map
+
+    # Normalize to form a true probability distribution
+    sampling_prob_map = sampling_prob_map / np.sum(sampling_prob_map)
+    return sampling_prob_map
+
+
+def _check_sampling_maps(dataset, sampler):
+    """
+    Precomputed sampling maps are computed from the unaugmented volumes, and don't apply to spatially augmented ones.
+    """
+    if getattr(sampler, 'sampling_maps_dir', None) is not None and getattr(dataset, 'augment_data', False):
+        raise ValueError("Precomputed sampling maps (sampling_maps_dir) can't be used with a dataset that augments the volumes. "
+                         "Use patch-level augmentation (patch_transform) instead")
+
+
+def get_sampling_map_index(sampling_prob_map, valid_indx_range):
+    """
+    Compress a sampling probability map into a sparse index -- the candidate focal points within the valid focal point
+    region that have a nonzero probability, and their cumulative weights.
+
+    Args:
+        sampling_prob_map: ndarray of shape (D,H,W)
+        valid_indx_range: Inclusive [lower, upper] bounds of the valid focal points, in (D,H,W) ordering
+    Returns:
+        focal_point_candidates: int16 ndarray of shape (N,3). Focal points in (D,H,W) volume coordinates
+        cumulative_weights: float64 ndarray of shape (N,). Normalized, i.e. the last value is 1
+    """
+    # Restrict the map to the valid focal point region upfront, so that no draw has to be rejected
+    region_start = np.array(valid_indx_range[0]).astype(int)
+    region_end = np.array(valid_indx_range[1]).astype(int) + 1
+    valid_region_map = np.ascontiguousarray(sampling_prob_map[region_start[0]:region_end[0],
+                                                              region_start[1]:region_end[1],
+                                                              region_start[2]:region_end[2]])
+
+    relevant_indxs = np.flatnonzero(valid_region_map)
+    if len(relevant_indxs) == 0:
+        raise ValueError("Sampling probability map is zero over the whole valid focal point region")
+
+    focal_point_candidates = np.stack(np.unravel_index(relevant_indxs, valid_region_map.shape), axis=1) + region_start
+    cumulative_weights = np.cumsum(valid_region_map.ravel()[relevant_indxs], dtype=np.float64)
+    # A NaN total (e.g. a map normalized by a zero sum) would make every draw land on the last candidate
+    if not np.isfinite(cumulative_weights[-1]) or cumulative_weights[-1] <= 0:
+        raise ValueError(f"Sampling probability map has an invalid total ({cumulative_weights[-1]}) over the valid focal point region")
+    cumulative_weights = cumulative_weights / cumulative_weights[-1]
+    return focal_point_candidates.astype(np.int16), cumulative_weights
+
+
+def get_valid_indx_range(patch_size, volume_size):
+    """
+    Inclusive range of the valid focal points. Both arguments in (D,H,W) ordering.
+    """
+    patch_size = np.array(patch_size).astype(float)
+    valid_indx_range = [
+                        np.zeros(3) + np.floor(patch_size/2),
+                        np.array(volume_size) - np.ceil(patch_size/2)
+                       ]
+    return valid_indx_range
+
+
 def _get_valid_grid_points():
     pass
 
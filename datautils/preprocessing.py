@@ -1,10 +1,18 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from scipy.ndimage import gaussian_filter
+import SimpleITK as sitk
 
 
 # Histogram related constants
 DEFAULT_QUANTILES_CUTOFF_SUV = (0, 0.999)
 DEFAULT_QUANTILES_CUTOFF_HU = (0, 0.999)
+DEFAULT_PERCENTILE_HISTOGRAM_BINS = 4096
+PERCENTILE_CACHE_SIZE = 1024  # Max number of (cache_key, modality) entries, least recently used ones are dropped first
 
 
 class Preprocessor():
@@ -13,12 +21,29 @@ class Preprocessor():
                  smooth_sigma_mm={'PET': 2.0, 'CT': 0.0},
                  normalization_method={'PET': 'clip-and-rescale', 'CT': 'clip-and-rescale'},
                  clipping_range={'PET': [0,20], 'CT': [-150,150]},
-                 histogram_landmarks_path={'PET': None, 'CT': None}
+                 histogram_landmarks_path={'PET': None, 'CT': None},
+                 percentile_method='exact',
+                 float32_mode=False,
+                 num_threads=1,
+                 smoothing_backend='scipy'
                  ):
+        """
+        smoothing_backend -- 'scipy' (scipy.ndimage.gaussian_filter) or 'sitk-recursive' (SimpleITK's recursive
+                             Gaussian -- multithreaded, and its cost does not grow with sigma. Differs slightly from
+                             'scipy' near the volume borders)
+        percentile_method -- Used by histogram mapping. 'exact' or 'histogram' (fixed-bin estimate, faster, with an
+                             error of at most (max-min)/DEFAULT_PERCENTILE_HISTOGRAM_BINS)
+        float32_mode -- If True, all computations are done in float32. Smoothing writes into a per-modality buffer that
+                        is reused across calls, so its output is only valid until the next call for the same modality.
+                        The buffer only grows, so region reads of varying shapes share it. The normalization always
+                        returns a new array, also when the modality has no normalization method.
+        num_threads -- Threads used by run_per_modality() to process PET and CT concurrently
+        """
 
         # Smoothing params
         self.spacing_dict = None
         self.smooth_sigma_mm = smooth_sigma_mm
+        self.smoothing_backend = smoothing_backend
 
         # Standardization params
         self.normalization_method = normalization_method
@@ -26,16 +51,57 @@ class Preprocessor():
         self.histogram_landmarks_path = histogram_landmarks_path
         self.landmarks_dict = {'PET': None, 'CT': None}
         self.quantiles_cutoff = {'PET': DEFAULT_QUANTILES_CUTOFF_SUV, 'CT': DEFAULT_QUANTILES_CUTOFF_HU}
+        self.percentile_method = percentile_method
+        self.percentile_values_cache = OrderedDict()  # {(cache_key, modality): percentile values}, in LRU order
+        self.percentile_cache_lock = threading.Lock()  # run_per_modality() may update the cache from several threads
 
         for key in ['PET', 'CT']:
             if normalization_method[key] == 'histogram-mapping':
                 self.landmarks_dict[key] = np.loadtxt(histogram_landmarks_path[key])
 
+        # Float32 mode and concurrency
+        self.float32_mode = float32_mode
+        self.num_threads = num_threads
+        self.smoothing_buffers = {}  # {modality: reusable flat output buffer}
+        self.executor = None  # Created on first use
+        self.executor_pid = None  # Process that created the executor
+
+
+    def __getstate__(self):
+        # Buffers, the lock and the thread pool are not copied to dataloader worker processes -- each creates its own
+        state = self.__dict__.copy()
+        state['smoothing_buffers'] = {}
+        state['percentile_cache_lock'] = None
+        state['executor'] = None
+        state['executor_pid'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.percentile_cache_lock = threading.Lock()
+
 
     def set_spacing(self, spacing_dict):
         self.spacing_dict = spacing_dict
 
 
+    def run_per_modality(self, fn, modalities=['PET', 'CT']):
+        """
+        Call fn(modality) for each modality and return the results as a dict. If num_threads > 1, the calls run
+        concurrently in a thread pool -- SimpleITK, scipy.ndimage and most numpy routines release the GIL.
+        """
+        if self.num_threads <= 1 or len(modalities) == 1:
+            return {modality: fn(modality) for modality in modalities}
+
+        # A forked child inherits the executor but not its threads -- submitting to it would block forever
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self.executor_pid = os.getpid()
+        futures = {modality: self.executor.submit(fn, modality) for modality in modalities}
+        return {modality: future.result() for modality, future in futures.items()}
+
+
     def smoothing_filter(self, image_np, modality):
         sigma_mm = self.smooth_sigma_mm[modality]
 
@@ -45,40 +111,84 @@ class Preprocessor():
         sigma = (sigma_mm / self.spacing_dict['xy-spacing'],
                  sigma_mm / self.spacing_dict['xy-spacing'],
                  sigma_mm / self.spacing_dict['slice-thickness'])
+
+        if self.smoothing_backend == 'sitk-recursive':
+            if self.float32_mode:
+                image_np = image_np.astype(np.float32, copy=False)
+            return recursive_gaussian_filter(image_np, sigma)
+
+        if self.float32_mode:
+            image_np = image_np.astype(np.float32, copy=False)
+            output_np = self._get_smoothing_buffer(modality, image_np.shape)
+            gaussian_filter(image_np, sigma=sigma, output=output_np)
+            return output_np
+
         image_np = gaussian_filter(image_np, sigma=sigma)
         return image_np
 
 
-    def normalize_intensity(self, image_np, modality):
+    def _get_smoothing_buffer(self, modality, shape):
+        # A contiguous view of the modality's flat buffer, which is only reallocated when a larger volume comes in
+        size = int(np.prod(shape))
+        if modality not in self.smoothing_buffers or self.smoothing_buffers[modality].size < size:
+            self.smoothing_buffers[modality] = np.empty(size, dtype=np.float32)
+        return self.smoothing_buffers[modality][:size].reshape(shape)
+
+
+    def normalize_intensity(self, image_np, modality, cache_key=None):
+        """
+        cache_key -- Optional key identifying the volume, e.g. the patient ID. If given, the percentiles used by
+                     histogram mapping are computed only once per key. Pass None for augmented volumes.
+                     The cache lives in the process that owns the Preprocessor, and holds at most
+                     PERCENTILE_CACHE_SIZE entries. It is not shared between dataloader workers: it pays off with
+                     num_workers=0 and in PrefetchPatchQueue's long-lived workers, but PatchQueue's subject loader
+                     starts new workers for every pass, which begin with the cache as it was in the main process.
+        """
         if self.normalization_method[modality] == 'clip-and-rescale':
             image_np = self._clip(image_np, modality)
             #image_np = (image_np - image_np.min()) / (image_np.max() - image_np.min()) # Min-max rescaling
 
         elif self.normalization_method[modality] == 'histogram-mapping':
-            image_np = self._histogram_transform(image_np, modality)
+            image_np = self._histogram_transform(image_np, modality, cache_key=cache_key)
+
+        elif self.float32_mode:
+            # The input may be the smoothing buffer, which the next smoothing_filter() call overwrites
+            image_np = np.array(image_np, dtype=np.float32)
 
         return image_np
 
     def _clip(self, image_np, modality):
         clipping_range = self.clipping_range[modality]
+        if self.float32_mode:
+            # Clip straight into a new float32 array, without a float64 intermediate
+            output_np = np.empty(image_np.shape, dtype=np.float32)
+            np.clip(image_np, clipping_range[0], clipping_range[1], out=output_np, casting='unsafe')
+            return output_np
         image_np = np.clip(image_np, clipping_range[0], clipping_range[1])
         return image_np
 
-    def _histogram_transform(self, image_np, modality, epsilon=1e-5):
+    def _histogram_transform(self, image_np, modality, cache_key=None, epsilon=1e-5):
         quantiles_cutoff = self.quantiles_cutoff[modality]
         mapping = self.landmarks_dict[modality]
         shape = image_np.shape
-        image_np = image_np.reshape(-1).astype(np.float32)
+        image_np = image_np.reshape(-1).astype(np.float32, copy=False)
 
         range_to_use = [0, 1, 2, 4, 5, 6, 7, 8, 10, 11, 12]
 
-        percentiles_cutoff = 100 * np.array(quantiles_cutoff)
-        percentiles = self._get_percentiles(percentiles_cutoff)
-        percentile_values = np.percentile(image_np, percentiles)
+        # Get the values of only the percentiles in use
+        range_perc = self._get_cached_percentile_values((cache_key, modality)) if cache_key is not None else None
+        if range_perc is None:
+            percentiles_cutoff = 100 * np.array(quantiles_cutoff)
+            percentiles = self._get_percentiles(percentiles_cutoff)
+            if self.percentile_method == 'exact':
+                range_perc = partition_percentiles(image_np, percentiles[range_to_use])
+            elif self.percentile_method == 'histogram':
+                range_perc = histogram_percentiles(image_np, percentiles[range_to_use])
+            if cache_key is not None:
+                self._set_cached_percentile_values((cache_key, modality), range_perc)
 
         # Apply linear histogram standardization
         range_mapping = mapping[range_to_use]
-        range_perc = percentile_values[range_to_use]
         diff_mapping = np.diff(range_mapping)
         diff_perc = np.diff(range_perc)
 
@@ -96,6 +206,15 @@ class Preprocessor():
         affine_map[1] = range_mapping[:-1] - affine_map[0] * range_perc[:-1]
 
         bin_id = np.digitize(image_np, range_perc[1:-1], right=False)
+
+        if self.float32_mode:
+            # Gather the slopes and intercepts as float32, and compute the result in place
+            affine_map = affine_map.astype(np.float32)
+            new_img = affine_map[0, bin_id]
+            new_img *= image_np
+            new_img += affine_map[1, bin_id]
+            return new_img.reshape(shape)
+
         lin_img = affine_map[0, bin_id]
         aff_img = affine_map[1, bin_id]
         new_img = lin_img * image_np + aff_img
@@ -103,6 +222,20 @@ class Preprocessor():
         new_img = new_img.astype(np.float32)
         return new_img
 
+    def _get_cached_percentile_values(self, key):
+        with self.percentile_cache_lock:
+            range_perc = self.percentile_values_cache.get(key)
+            if range_perc is not None:
+                self.percentile_values_cache.move_to_end(key)
+            return range_perc
+
+    def _set_cached_percentile_values(self, key, range_perc):
+        with self.percentile_cache_lock:
+            self.percentile_values_cache[key] = range_perc
+            self.percentile_values_cache.move_to_end(key)
+            while len(self.percentile_values_cache) > PERCENTILE_CACHE_SIZE:
+                self.percentile_values_cache.popitem(last=False)
+
     def _get_percentiles(self, percentiles_cutoff):
         quartiles = np.arange(25, 100, 25).tolist()
         deciles = np.arange(10, 100, 10).tolist()
@@ -112,6 +245,70 @@ class Preprocessor():
 
 
 
+def recursive_gaussian_filter(image_np, sigma):
+    """
+    Gaussian smoothing using SimpleITK's recursive (IIR) implementation. Matches gaussian_filter() away from the
+    borders, up to a small approximation error.
+
+    Args:
+        image_np: ndarray
+        sigma: Sigma in voxels, per ndarray axis
+    Returns:
+        Smoothed ndarray. Float32 for float32 input, float64 otherwise
+    """
+    if all(s == 0 for s in sigma):
+        return image_np
+
+    if image_np.dtype != np.float32:
+        image_np = image_np.astype(np.float64)
+
+    # Separable smoothing, one 1D recursive pass per axis. Axes with zero sigma are skipped, since
+    # SmoothingRecursiveGaussian rejects them. SimpleITK orders the axes in reverse w.r.t. numpy
+    image_sitk = sitk.GetImageFromArray(image_np)
+    recursive_filter = sitk.RecursiveGaussianImageFilter()
+    recursive_filter.SetOrder(sitk.RecursiveGaussianImageFilter.ZeroOrder)
+    recursive_filter.SetNormalizeAcrossScale(False)
+    for axis, s in enumerate(sigma):
+        if s == 0:
+            continue
+        recursive_filter.SetDirection(image_np.ndim - 1 - axis)
+        recursive_filter.SetSigma(float(s))
+        image_sitk = recursive_filter.Execute(image_sitk)
+    return sitk.GetArrayFromImage(image_sitk)
+
+
+def partition_percentiles(values, percentiles):
+    """
+    Percentiles with linear interpolation, as np.percentile's default method. Only the ranks needed for the
+    requested percentiles are selected, using a single np.partition call.
+    """
+    values = values.reshape(-1)
+    num_values = values.size
+    ranks = np.asarray(percentiles, dtype=np.float64) / 100 * (num_values - 1)
+    lower_ranks = np.floor(ranks).astype(np.int64)
+    upper_ranks = np.minimum(lower_ranks + 1, num_values - 1)
+
+    partitioned_values = np.partition(values, np.unique(np.concatenate([lower_ranks, upper_ranks])))
+    lower_values = partitioned_values[lower_ranks].astype(np.float64)
+    upper_values = partitioned_values[upper_ranks].astype(np.float64)
+    return lower_values + (upper_values - lower_values) * (ranks - lower_ranks)
+
+
+def histogram_percentiles(values, percentiles, num_bins=DEFAULT_PERCENTILE_HISTOGRAM_BINS):
+    """
+    Approximate percentiles from the CDF of a fixed-bin histogram, interpolated linearly within the bins.
+    The error is bounded by the bin width, (max-min)/num_bins.
+    """
+    values = values.reshape(-1)
+    min_value, max_value = float(values.min()), float(values.max())
+    if min_value == max_value:
+        return np.full(len(percentiles), min_value)
+
+    histogram, bin_edges = np.histogram(values, bins=num_bins, range=(min_value, max_value))
+    cdf = np.concatenate([[0], np.cumsum(histogram)]) / values.size
+    return np.interp(np.asarray(percentiles, dtype=np.float64) / 100, cdf, bin_edges)
+
+
 if __name__ == '__main__':
 
     pass
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Random number generation for the data pipeline.
+
+Every component that draws random numbers -- patch samplers, datasets, augmenters and patch queues -- takes an
+optional `rng` argument (a seed, a SeedSequence or a numpy Generator) and keeps a numpy Generator in its `rng`
+attribute. No component touches the global RNGs.
+
+Worker processes receive copies of these components, including the Generator states. Without reseeding, all workers
+would draw the same random numbers -- e.g. the same focal points for different subjects. The helpers here give every
+component in every worker its own independent stream, spawned from a SeedSequence.
+"""
+
+import types
+import random
+import functools
+
+import numpy as np
+import torch
+
+
+# Objects not searched for generators by seed_components()
+_SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType, functools.partial)
+
+
+def get_rng(rng=None):
+    """
+    Generator from a seed, SeedSequence or Generator. None gives a Generator seeded from OS entropy.
+    """
+    return np.random.default_rng(rng)
+
+
+def spawn_seed_sequence(rng):
+    """
+    New SeedSequence drawn from a Generator. Reproducible given the Generator's state.
+    """
+    return np.random.SeedSequence(int(rng.integers(2**63)))
+
+
+def seed_components(components, seed_sequence):
+    """
+    Give every object holding an `rng` Generator that is reachable from the components -- through attributes, lists,
+    tuples and dicts, at any depth (e.g. a queue's patch_transform.spatial_augmenter) -- its own Generator spawned from
+    the seed sequence. Also seeds the global random, numpy and torch RNGs of the process, for the code still using them
+    (e.g. TorchIO).
+    """
+    targets = _find_rng_owners(components)
+
+    child_seed_sequences = seed_sequence.spawn(len(targets) + 1)
+    for target, child_seed_sequence in zip(targets, child_seed_sequences):
+        target.rng = np.random.default_rng(child_seed_sequence)
+
+    global_seed = int(child_seed_sequences[-1].generate_state(1)[0])
+    np.random.seed(global_seed)
+    torch.manual_seed(global_seed)
+    random.seed(global_seed)
+
+
+def _find_rng_owners(components):
+    """
+    Objects with an `rng` Generator reachable from the components, in a deterministic depth-first order.
+    """
+    owners = []
+    visited = set()
+    stack = list(reversed(components))
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+
+        if isinstance(obj, (list, tuple)):
+            children = list(obj)
+        elif isinstance(obj, dict):
+            children = list(obj.values())
+        elif hasattr(obj, '__dict__') and not isinstance(obj, _SKIPPED_TYPES):
+            if isinstance(getattr(obj, 'rng', None), np.random.Generator):
+                owners.append(obj)
+            children = list(vars(obj).values())
+        else:
+            continue
+        stack.extend(reversed(children))
+    return owners
+
+
+def get_worker_init_fn(seed_sequence=None):
+    """
+    worker_init_fn for torch DataLoaders. Each worker reseeds the components of its dataset copy with a stream spawned
+    from the seed sequence, keyed by the worker ID. If no seed sequence is given, the base seed that torch draws for the
+    loader's workers is used -- which changes every epoch, and is reproducible under torch.manual_seed().
+    """
+    return functools.partial(_init_worker, seed_sequence=seed_sequence)
+
+
+def _init_worker(worker_id, seed_sequence=None):
+    worker_info = torch.utils.data.get_worker_info()
+    if seed_sequence is None:
+        seed_sequence = np.random.SeedSequence(worker_info.seed - worker_id)
+    worker_seed_sequence = np.random.SeedSequence(seed_sequence.entropy, spawn_key=seed_sequence.spawn_key + (worker_id,))
+    seed_components([worker_info.dataset], worker_seed_sequence)
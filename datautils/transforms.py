@@ -1,14 +1,21 @@
 import numpy as np
+from scipy.ndimage import map_coordinates
+import torch
 import torchio
 
+from datautils.preprocessing import partition_percentiles
+from datautils.rng import get_rng
+
 # TorchIO augmentation config
 ROTATION_RANGE = (-10, 10)
 SCALE_FACTOR_RANGE = (0.85,1.15)
 NUM_CONTROL_POINTS = (5,5,5)
 MAX_DISPLACEMENT = (20,20,20)
+LOCKED_BORDERS = 2
 
 # PET intensity stretching
 PET_PC95_INCREASE_FACTOR = 1.2
+PET_STRETCH_SLAB_VOXELS = 2**20  # Voxels mapped at a time
 
 
 
@@ -17,30 +24,266 @@ def build_transforms():
 		# TorchIO transforms
 		rotation_transform = torchio.RandomAffine(scales=(1,1), degrees=ROTATION_RANGE, translation=(0,0))
 		scaling_transform = torchio.RandomAffine(scales=SCALE_FACTOR_RANGE, degrees=(0,0), translation=(0,0))
-		elastic_transform = torchio.RandomElasticDeformation(num_control_points=NUM_CONTROL_POINTS, max_displacement=MAX_DISPLACEMENT, locked_borders=2)
+		elastic_transform = torchio.RandomElasticDeformation(num_control_points=NUM_CONTROL_POINTS, max_displacement=MAX_DISPLACEMENT, locked_borders=LOCKED_BORDERS)
 		transforms_dict = {rotation_transform: 0.33,
 		                    scaling_transform: 0.33,
 		                    elastic_transform: 0.33}
 		torchio_oneof_transform = torchio.transforms.OneOf(transforms_dict)
 
+		return torchio_oneof_transform, PET_stretch_transform
+
+
+
+# Intensity stretching for PET
+def PET_stretch_transform(PET_np, inplace=False):
+	"""
+	Stretch the contrast in the range between 30 percentile and 95 percentile, and squeeze it in the range between
+	95 percentile and max. Implemented as a single piecewise-linear map through the knots (min, pc30, pc95, max) ->
+	(min, pc30, 1.2*pc95, max), with all 4 knot values taken from a single partition of the volume.
+
+	Parameters:
+		PET_np -- ndarray
+		inplace -- If True, the result is written into PET_np, which must have a float dtype. The volume is mapped in
+		           slabs, so the float64 temporaries of np.interp stay small
+	Returns:
+		Stretched ndarray, of the same dtype as PET_np
+	"""
+	min_suv, pc30, pc95, max_suv = partition_percentiles(PET_np, [0, 30, 95, 100])
+	knots_in = np.array([min_suv, pc30, pc95, max_suv])
+	knots_out = np.array([min_suv, pc30, PET_PC95_INCREASE_FACTOR*pc95, max_suv])
+
+	# Merge coinciding knots (e.g. pc95 == max in a mostly flat volume), keeping the last one. np.interp needs them increasing
+	keep = np.append(np.diff(knots_in) > 0, True)
+	knots_in, knots_out = knots_in[keep], knots_out[keep]
+
+	PET_stretched_np = PET_np if inplace else np.empty_like(PET_np)
+	slab_size = max(1, PET_STRETCH_SLAB_VOXELS // max(1, PET_np[0].size))
+	for i in range(0, PET_np.shape[0], slab_size):
+		PET_stretched_np[i : i + slab_size] = np.interp(PET_np[i : i + slab_size], knots_in, knots_out)
+
+	return PET_stretched_np
+
+
+
+class SpatialAugmenter():
+	"""
+	Native alternative to the TorchIO OneOf(rotation, scaling, elastic) transform of build_transforms().
+	One of the 3 transforms is drawn per subject, and all the subject's volumes are resampled with a single shared map of
+	source coordinates using scipy's map_coordinates -- linear interpolation for images, nearest for labelmaps.
+
+	The coordinate map is built slab by slab along the first axis, so its memory footprint stays small. An output region
+	can be given, in which case only that part of the transformed volume is computed.
+	"""
+	def __init__(self, spacing=(1.0, 1.0, 3.0), rotation_range=ROTATION_RANGE, scale_factor_range=SCALE_FACTOR_RANGE,
+	             num_control_points=NUM_CONTROL_POINTS, max_displacement=MAX_DISPLACEMENT, locked_borders=LOCKED_BORDERS,
+	             slab_size=16, rng=None):
+		"""
+		Parameters:
+			spacing -- Voxel spacing in mm, in the same axis order as the volumes
+			rotation_range -- Range of the rotation angle about each axis, in degrees
+			scale_factor_range -- Range of the scaling factor along each axis
+			num_control_points -- Size of the elastic deformation's control point grid
+			max_displacement -- Max displacement of the control points along each axis, in mm
+			locked_borders -- 0, 1 or 2. Number of outer control point layers kept fixed
+			slab_size -- Number of planes along the first axis resampled at a time
+			rng -- Seed or numpy Generator, see datautils/rng.py
+		"""
+		self.spacing = np.array(spacing, dtype=np.float64)
+		self.rotation_range = rotation_range
+		self.scale_factor_range = scale_factor_range
+		self.num_control_points = tuple(num_control_points)
+		self.max_displacement = np.array(max_displacement, dtype=np.float64)
+		self.locked_borders = locked_borders
+		self.slab_size = slab_size
+		self.rng = get_rng(rng)
+
+
+	def __call__(self, volumes_dict, label_keys=('target-labelmap',), region=None):
+		"""
+		Parameters:
+			volumes_dict -- Dict of ndarrays of the same shape
+			label_keys -- Keys of the volumes to be resampled with nearest neighbour interpolation
+			region -- Optional (start_idx, end_idx) of the output region, end exclusive. None for the full volume
+		Returns:
+			Dict of transformed ndarrays, with the same keys and dtypes
+		"""
+		volume_size = next(iter(volumes_dict.values())).shape
+		transform_params = self.sample_transform(volume_size)
+		return self.apply(volumes_dict, transform_params, label_keys=label_keys, region=region)
+
+
+	def sample_transform(self, volume_size):
+		transform_type = self.rng.choice(['rotation', 'scaling', 'elastic'])
+
+		if transform_type == 'rotation':
+			angles = np.deg2rad(self.rng.uniform(self.rotation_range[0], self.rotation_range[1], size=3))
+			matrix = _get_rotation_matrix(angles)
+		elif transform_type == 'scaling':
+			matrix = np.diag(self.rng.uniform(self.scale_factor_range[0], self.scale_factor_range[1], size=3))
+
+		if transform_type in ['rotation', 'scaling']:
+			# About the volume centre, in physical space
+			center = (np.array(volume_size) - 1) / 2 * self.spacing
+			return {'type': 'affine', 'inverse-matrix': np.linalg.inv(matrix), 'center': center}
+
+		# Elastic -- Random control point displacements in mm, interpolated with a cubic spline
+		displacements = self.rng.uniform(-1, 1, size=(3,) + self.num_control_points)
+		displacements *= self.max_displacement.reshape(3, 1, 1, 1)
+		for i in range(self.locked_borders):
+			displacements[:, [i, -1-i], :, :] = 0
+			displacements[:, :, [i, -1-i], :] = 0
+			displacements[:, :, :, [i, -1-i]] = 0
+		return {'type': 'elastic', 'displacements': displacements}
+
+
+	def apply(self, volumes_dict, transform_params, label_keys=('target-labelmap',), region=None):
+		volume_size = next(iter(volumes_dict.values())).shape
+		if region is None:
+			region = ((0, 0, 0), volume_size)
+		start_idx, end_idx = np.array(region[0]), np.array(region[1])
+
+		# Padding value -- Volume minimum for images, 0 for labelmaps
+		fill_values = {key: 0 if key in label_keys else float(volume.min()) for key, volume in volumes_dict.items()}
+		outputs_dict = {key: np.empty(tuple(end_idx - start_idx), dtype=volume.dtype) for key, volume in volumes_dict.items()}
+
+		for slab_start in range(start_idx[0], end_idx[0], self.slab_size):
+			slab_end = min(slab_start + self.slab_size, end_idx[0])
+			slab_region = ((slab_start, start_idx[1], start_idx[2]), (slab_end, end_idx[1], end_idx[2]))
+			coordinate_map = self.get_coordinate_map(transform_params, volume_size, slab_region)
+
+			for key, volume in volumes_dict.items():
+				map_coordinates(volume, coordinate_map,
+				                output=outputs_dict[key][slab_start - start_idx[0] : slab_end - start_idx[0]],
+				                order=0 if key in label_keys else 1,
+				                mode='constant', cval=fill_values[key], prefilter=False)
+
+		return outputs_dict
+
+
+	def get_coordinate_map(self, transform_params, volume_size, region):
+		"""
+		Source voxel coordinates of each voxel of the output region, as a float32 array of shape (3, *region_shape).
+		"""
+		start_idx, end_idx = region
+		region_shape = tuple(end_idx[i] - start_idx[i] for i in range(3))
+		physical_axes = [np.arange(start_idx[i], end_idx[i]) * self.spacing[i] for i in range(3)]
+		broadcast_shapes = [(-1, 1, 1), (1, -1, 1), (1, 1, -1)]
+
+		coordinate_map = np.empty((3,) + region_shape, dtype=np.float32)
+
+		if transform_params['type'] == 'affine':
+			inverse_matrix, center = transform_params['inverse-matrix'], transform_params['center']
+			relative_axes = [(physical_axes[i] - center[i]).reshape(broadcast_shapes[i]) for i in range(3)]
+			for d in range(3):
+				source_coords = center[d] + inverse_matrix[d, 0] * relative_axes[0] + inverse_matrix[d, 1] * relative_axes[1] + inverse_matrix[d, 2] * relative_axes[2]
+				coordinate_map[d] = source_coords / self.spacing[d]
+
+		elif transform_params['type'] == 'elastic':
+			# Dense displacement field over the region, as the tensor product of per-axis spline weights
+			spline_weights = [_get_spline_weights(np.arange(start_idx[i], end_idx[i]), volume_size[i], self.num_control_points[i]) for i in range(3)]
+			for d in range(3):
+				displacement = np.einsum('ai,bj,ck,ijk->abc', *spline_weights, transform_params['displacements'][d], optimize=True)
+				coordinate_map[d] = (physical_axes[d].reshape(broadcast_shapes[d]) + displacement) / self.spacing[d]
+
+		return coordinate_map
+
+
+
+class PatchAugmenter():
+	"""
+	Patch-level augmentation, to be used as the patch_transform of PatchQueue or PrefetchPatchQueue instead of augmenting
+	the full volumes in the dataset. Expects patches sampled with a margin (PatchSampler3D's margin param) and crops them
+	to the final patch size. Augmentation choices follow the datasets' -- with the given probability, one of the 3 spatial
+	transforms (75%) or PET intensity stretching (25%). Spatial transforms compute only the final patch region, using
+	the margin as context.
+
+	Note that the transforms act on the patch instead of the volume: rotation and scaling are about the patch centre, the
+	elastic control point grid spans the patch and the PET stretching percentiles are those of the patch.
+	"""
+	def __init__(self, patch_size, margin, spacing=(1.0, 1.0, 3.0), probability=0.5, rng=None):
+		"""
+		Parameters:
+			patch_size -- Final patch size, in (W,H,D) order
+			margin -- Margin on each side of the sampled patches, in (W,H,D) order. Same as the patch sampler's
+			spacing -- Voxel spacing in mm, in (W,H,D) order
+			probability -- Probability of augmenting a patch
+			rng -- Seed or numpy Generator, see datautils/rng.py
+		"""
+		self.patch_size = np.array(list(reversed(patch_size)))  # Patches are in (D,H,W) order
+		self.margin = np.array(list(reversed(margin)))
+		self.probability = probability
+		self.rng = get_rng(rng)
+		self.spatial_augmenter = SpatialAugmenter(spacing=tuple(reversed(spacing)), rng=self.rng)
+
+
+	def __call__(self, patch):
+		"""
+		Parameters:
+			patch -- Dict of tensors of shape (C,D,H,W) or (D,H,W), including the margin. 'target-labelmap' is the labelmap
+		Returns:
+			Dict of tensors cropped to the final patch size
+		"""
+		region = (self.margin, self.margin + self.patch_size)
+		patch_np = {key: value.numpy() for key, value in patch.items()}
+
+		if self.rng.random() < self.probability:
+			if self.rng.random() < 0.75:
+				return self._apply_spatial_transform(patch_np, region)
+
+			# PET intensity stretching, within the final patch region
+			patch_np = {key: _crop(value, region) for key, value in patch_np.items()}
+			if 'PET' in patch_np:
+				patch_np['PET'] = PET_stretch_transform(patch_np['PET'], inplace=True)
+			elif 'PET-CT' in patch_np:
+				PET_stretch_transform(patch_np['PET-CT'][0], inplace=True)
+			return {key: torch.from_numpy(value) for key, value in patch_np.items()}
+
+		return {key: torch.from_numpy(_crop(value, region)) for key, value in patch_np.items()}
+
+
+	def _apply_spatial_transform(self, patch_np, region):
+		# Split multichannel volumes, so that all channels and the labelmap share one coordinate map
+		volumes_dict = {}
+		for key, value in patch_np.items():
+			if value.ndim == 4:
+				for c in range(value.shape[0]):
+					volumes_dict[(key, c)] = value[c]
+			else:
+				volumes_dict[(key, None)] = value
+
+		volumes_dict = self.spatial_augmenter(volumes_dict, label_keys=[('target-labelmap', None)], region=region)
+
+		augmented_patch = {}
+		for key, value in patch_np.items():
+			if value.ndim == 4:
+				augmented_patch[key] = torch.from_numpy(np.stack([volumes_dict[(key, c)] for c in range(value.shape[0])]))
+			else:
+				augmented_patch[key] = torch.from_numpy(volumes_dict[(key, None)])
+		return augmented_patch
+
 
-		# Intensity stretching for PET
-		def PET_stretch_transform(PET_np):
-			# Sstretch the contrast in the range between 30 percentile and 95 percentile
-			pc30 = np.percentile(PET_np, 30)
-			pc95 = np.percentile(PET_np, 95)
-			max_suv = PET_np.max()
-			PET_stretched_np = PET_np.copy()
 
-			# Stretch the contrast in range [pc30, pc95)
-			mask = (PET_np >= pc30) & (PET_np < pc95)
-			PET_stretched_np[mask] = (PET_np[mask]-pc30)/(pc95-pc30) * (PET_PC95_INCREASE_FACTOR*pc95-pc30) + pc30
+def _crop(volume, region):
+	# Copy of the region along the last 3 dims
+	start_idx, end_idx = region
+	return volume[..., start_idx[0]:end_idx[0], start_idx[1]:end_idx[1], start_idx[2]:end_idx[2]].copy()
 
-			# Squeeze the contrast in range [pc95, max]
-			mask = (PET_np >= pc95) & (PET_np <= max_suv)
-			PET_stretched_np[mask] = (PET_np[mask]-pc95)/(max_suv-pc95) * (max_suv-PET_PC95_INCREASE_FACTOR*pc95) + PET_PC95_INCREASE_FACTOR*pc95
 
-			return PET_stretched_np
+def _get_rotation_matrix(angles):
+	cx, cy, cz = np.cos(angles)
+	sx, sy, sz = np.sin(angles)
+	rotation_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+	rotation_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+	rotation_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+	return rotation_z @ rotation_y @ rotation_x
 
 
-		return torchio_oneof_transform, PET_stretch_transform
\ No newline at end of file
+def _get_spline_weights(indices, axis_size, num_control_points):
+	"""
+	Matrix W of shape (len(indices), num_control_points) such that W @ values gives the cubic spline through the values
+	at the control points -- spaced evenly from the first to the last voxel -- evaluated at the given indices.
+	"""
+	control_point_coords = indices * (num_control_points - 1) / max(axis_size - 1, 1)
+	identity = np.eye(num_control_points)
+	weights = [map_coordinates(identity[j], control_point_coords[np.newaxis], order=3, mode='nearest') for j in range(num_control_points)]
+	return np.stack(weights, axis=1)
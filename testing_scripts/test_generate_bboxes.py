@@ -0,0 +1,72 @@
+import os, sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+from cli_hktr_generate_bboxes import bbox_auto, find_brain, find_brain_downsampled
+
+
+SHAPE = (96, 96, 150)  # (x,y,z) -- z increases towards the head
+SPACING = (4.0, 4.0, 3.27)
+ORIGIN = (-192.0, -192.0, -500.0)
+
+
+def _add_blob(np_pt, centre, radii, value):
+    x, y, z = np.ogrid[:np_pt.shape[0], :np_pt.shape[1], :np_pt.shape[2]]
+    blob_mask = ((x - centre[0]) / radii[0])**2 + ((y - centre[1]) / radii[1])**2 + ((z - centre[2]) / radii[2])**2 < 1
+    np_pt[blob_mask] += value
+
+
+def _get_head_neck_phantom(seed, ambiguous=False):
+    """
+    Synthetic whole-body PET in (x,y,z) ordering. A bright brain at the top, a bladder, the heart and a few small hot
+    spots below. If ambiguous, the brain is replaced by two blobs of the same size and uptake, side by side.
+    """
+    rng = np.random.RandomState(seed)
+    np_pt = rng.gamma(2.0, 0.5, size=SHAPE).astype(np.float32)  # Noisy background, SUV ~1
+    if ambiguous:
+        radius = rng.randint(8, 11)
+        _add_blob(np_pt, (25, 48, rng.randint(120, 130)), (radius, radius, radius), 4.0)
+        _add_blob(np_pt, (70, 48, rng.randint(120, 130)), (radius, radius, radius), 4.0)
+    else:
+        _add_blob(np_pt, (rng.randint(40, 56), rng.randint(40, 56), rng.randint(120, 135)), (16, 18, 12), rng.uniform(6, 12))
+    _add_blob(np_pt, (48, 48, 15), (10, 12, 8), rng.uniform(10, 30))  # Bladder
+    _add_blob(np_pt, (48, 55, 70), (14, 14, 10), rng.uniform(3, 6))   # Heart
+    for _ in range(4):
+        _add_blob(np_pt, (rng.randint(0, 96), rng.randint(0, 96), rng.randint(0, 150)), (3, 3, 3), rng.uniform(2, 10))
+    return np_pt
+
+
+def test_find_brain_downsampled_matches_find_brain():
+    for seed in range(4):
+        np_pt = _get_head_neck_phantom(seed)
+        expected = find_brain(np_pt, 3, 'scipy')
+
+        for downsampling_factor in [2, 3]:
+            assert find_brain_downsampled(np_pt, 3, 'scipy', downsampling_factor) == expected
+
+        # bbox_auto() takes the PET in (z,y,x) ordering, as read by sitk
+        np_pt_zyx = np_pt.transpose((2,1,0))
+        for full_head_neck in [False, True]:
+            expected_bb = bbox_auto(np_pt_zyx, SPACING, ORIGIN, full_head_neck)
+            assert np.array_equal(bbox_auto(np_pt_zyx, SPACING, ORIGIN, full_head_neck, downsampling_factor=2), expected_bb)
+
+
+def test_find_brain_downsampled_falls_back_when_ambiguous():
+    for seed in range(4):
+        np_pt = _get_head_neck_phantom(seed, ambiguous=True)
+
+        # Two blobs of similar size -- The downsampled detection could pick the other one, so it leaves it to find_brain()
+        assert find_brain_downsampled(np_pt, 3, 'scipy', 2) is None
+        np_pt_zyx = np_pt.transpose((2,1,0))
+        assert np.array_equal(bbox_auto(np_pt_zyx, SPACING, ORIGIN, downsampling_factor=2), bbox_auto(np_pt_zyx, SPACING, ORIGIN))
+
+    # A crop's recursive smoothing differs from the full volume's
+    assert find_brain_downsampled(_get_head_neck_phantom(0), 3, 'sitk-recursive', 2) is None
+
+
+
+if __name__ == '__main__':
+
+    test_find_brain_downsampled_matches_find_brain()
+    test_find_brain_downsampled_falls_back_when_ambiguous()
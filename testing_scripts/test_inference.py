@@ -0,0 +1,55 @@
+import os, sys
+import pytest
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+from datautils.inference import sliding_window_inference
+from datautils.patch_sampling import PatchSampler3D
+from datautils.patch_aggregation import PatchAggregator3D
+
+
+PATCH_SIZE = [8, 8, 4]    # (W,H,D)
+VOLUME_SIZE = [16, 16, 8] # (W,H,D)
+STRIDE = [4, 4, 2]        # (W,H,D)
+PADDING = [0, 0, 2]       # (W,H,D)
+
+
+def _get_subject():
+    volume_size = [VOLUME_SIZE[2], VOLUME_SIZE[1], VOLUME_SIZE[0]]
+    PET = torch.rand(volume_size)
+    return {'PET': PET, 'target-labelmap': (PET > 0.5).long()}
+
+
+def _predictor(batch_dict):
+    PET_patches = batch_dict['PET'].unsqueeze(1)
+    return torch.cat([1 - PET_patches, PET_patches], dim=1)
+
+
+def test_sliding_window_inference_with_matching_aggregator():
+    subject_dict = _get_subject()
+    patch_sampler = PatchSampler3D(PATCH_SIZE, volume_size=VOLUME_SIZE, sampling='sequential', focal_point_stride=STRIDE, padding=PADDING)
+    patch_aggregator = PatchAggregator3D(patch_size=PATCH_SIZE, volume_size=VOLUME_SIZE, focal_point_stride=STRIDE, unpadding=PADDING)
+
+    pred_labelmap, pred_prob_volume = sliding_window_inference(subject_dict, _predictor, patch_sampler, patch_aggregator, batch_size=3)
+
+    assert tuple(pred_prob_volume.shape) == (2,) + tuple(subject_dict['PET'].shape)
+    assert torch.allclose(pred_prob_volume[1], subject_dict['PET'])
+    assert torch.equal(pred_labelmap, subject_dict['target-labelmap'])
+
+
+@pytest.mark.parametrize('aggregator_kwargs', [{'volume_size': [24, 16, 8], 'unpadding': PADDING},
+                                               {'volume_size': VOLUME_SIZE, 'unpadding': [0, 0, 0]}])
+def test_sliding_window_inference_rejects_mismatched_aggregator(aggregator_kwargs):
+    patch_sampler = PatchSampler3D(PATCH_SIZE, volume_size=VOLUME_SIZE, sampling='sequential', focal_point_stride=STRIDE, padding=PADDING)
+    patch_aggregator = PatchAggregator3D(patch_size=PATCH_SIZE, focal_point_stride=STRIDE, **aggregator_kwargs)
+
+    with pytest.raises(ValueError):
+        sliding_window_inference(_get_subject(), _predictor, patch_sampler, patch_aggregator)
+
+
+
+if __name__ == '__main__':
+
+    test_sliding_window_inference_with_matching_aggregator()
+    test_sliding_window_inference_rejects_mismatched_aggregator({'volume_size': [24, 16, 8], 'unpadding': PADDING})
+    test_sliding_window_inference_rejects_mismatched_aggregator({'volume_size': VOLUME_SIZE, 'unpadding': [0, 0, 0]})
@@ -0,0 +1,100 @@
+import os, sys, tempfile
+from argparse import Namespace
+import numpy as np
+import pytest
+import h5py
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+from datautils.io import write_packed_subject, read_packed_volume, read_packed_metadata
+from cli_pack_subjects import pack_patient
+
+
+VOLUME_SIZE = (40, 36, 20)  # (W,H,D)
+SPACING = (1.0, 1.0, 3.0)
+ORIGIN = (-61.3, -112.7, -480.25)
+
+
+def _get_volumes_dict(seed=0):
+    rng = np.random.RandomState(seed)
+    PET_np = rng.gamma(2.0, 2.0, size=VOLUME_SIZE).astype(np.float32)
+    return {'PET': PET_np,
+            'CT': rng.normal(0.0, 100.0, size=VOLUME_SIZE).astype(np.float32),
+            'GTV': (PET_np > 8.0).astype(np.uint8)}
+
+
+@pytest.mark.parametrize('image_dtype', [np.float32, np.float16])
+def test_packed_subject_round_trip(tmp_path, image_dtype):
+    file_path = str(tmp_path / "P001.h5")
+    volumes_dict = _get_volumes_dict()
+    bbox = (10.0, 50.0, -20.0, 16.0, -400.0, -340.0)
+    write_packed_subject(file_path, volumes_dict, SPACING, ORIGIN, bbox=bbox, image_dtype=image_dtype, chunk_size=16)
+
+    # Storage -- (D,H,W) ordering, dtype and chunking
+    with h5py.File(file_path, 'r') as f:
+        for name in ['PET', 'CT', 'GTV']:
+            assert f[name].shape == tuple(reversed(VOLUME_SIZE))
+            assert f[name].dtype == (np.uint8 if name == 'GTV' else image_dtype)
+            assert f[name].chunks == (16, 16, 16)
+
+    meta_dict = read_packed_metadata(file_path)
+    assert meta_dict['spacing'] == SPACING and meta_dict['origin'] == ORIGIN and meta_dict['bbox'] == bbox
+    assert meta_dict['volume-size'] == VOLUME_SIZE
+    assert meta_dict['volume-names'] == ['PET', 'CT', 'GTV']
+
+    # Full and region reads, in both orderings. PET and CT come back as float32
+    region = (slice(5, 30), slice(12, 36), slice(3, 11))  # (W,H,D)
+    for name, volume_np in volumes_dict.items():
+        expected = volume_np.astype(image_dtype).astype(np.float32) if name != 'GTV' else volume_np
+        result = read_packed_volume(file_path, name)
+        assert result.dtype == expected.dtype
+        assert np.array_equal(result, expected)
+
+        assert np.array_equal(read_packed_volume(file_path, name, region=region), expected[region])
+        result = read_packed_volume(file_path, name, region=tuple(reversed(region)), keep_whd_ordering=False)
+        assert np.array_equal(result, expected[region].transpose((2,1,0)))
+
+    # No bbox given
+    write_packed_subject(file_path, {'CT': volumes_dict['CT']}, SPACING, ORIGIN, chunk_size=64)
+    meta_dict = read_packed_metadata(file_path)
+    assert meta_dict['bbox'] is None and meta_dict['volume-names'] == ['CT']
+    with h5py.File(file_path, 'r') as f:
+        assert f['CT'].chunks == tuple(reversed(VOLUME_SIZE))  # Chunks are capped at the volume size
+
+
+def test_pack_patient_without_PET(tmp_path):
+    args = Namespace(source_dir=str(tmp_path), target_dir=str(tmp_path), image_dtype='float32', chunk_size=16, compression='gzip')
+    volumes_dict = _get_volumes_dict()
+    for name, file_suffix in [('CT', '_ct'), ('GTV', '_ct_gtvt')]:
+        image_sitk = sitk.GetImageFromArray(volumes_dict[name].transpose((2,1,0)))
+        image_sitk.SetSpacing(SPACING)
+        image_sitk.SetOrigin(ORIGIN)
+        sitk.WriteImage(image_sitk, str(tmp_path / f"P001{file_suffix}.nii.gz"))
+
+    # The metadata comes from the volumes present
+    assert pack_patient(('P001', args, None)) == 'P001'
+    meta_dict = read_packed_metadata(str(tmp_path / "P001.h5"))
+    assert np.allclose(meta_dict['spacing'], SPACING) and np.allclose(meta_dict['origin'], ORIGIN)
+    assert meta_dict['volume-names'] == ['CT', 'GTV']
+    assert np.array_equal(read_packed_volume(str(tmp_path / "P001.h5"), 'CT'), volumes_dict['CT'])
+
+    # A volume off the patient's grid, or no volume at all
+    image_sitk = sitk.GetImageFromArray(volumes_dict['PET'].transpose((2,1,0)))
+    image_sitk.SetSpacing((2.0, 2.0, 3.0))
+    sitk.WriteImage(image_sitk, str(tmp_path / "P001_pt.nii.gz"))
+    with pytest.raises(ValueError):
+        pack_patient(('P001', args, None))
+    with pytest.raises(FileNotFoundError):
+        pack_patient(('P002', args, None))
+
+
+
+if __name__ == '__main__':
+
+    import pathlib
+    for image_dtype in [np.float32, np.float16]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_packed_subject_round_trip(pathlib.Path(tmp_dir), image_dtype)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_pack_patient_without_PET(pathlib.Path(tmp_dir))
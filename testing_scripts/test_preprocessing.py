@@ -0,0 +1,71 @@
+import os, sys, pickle, tempfile
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+from datautils import preprocessing
+from datautils.preprocessing import Preprocessor
+
+
+def _get_histogram_preprocessor(landmarks_dir):
+    landmarks_path = os.path.join(landmarks_dir, "PET_landmarks.txt")
+    np.savetxt(landmarks_path, np.linspace(0, 100, 13))
+    return Preprocessor(normalization_method={'PET': 'histogram-mapping', 'CT': 'clip-and-rescale'},
+                        histogram_landmarks_path={'PET': landmarks_path, 'CT': None})
+
+
+def test_percentile_values_cache_is_bounded(tmp_path):
+    cache_size = preprocessing.PERCENTILE_CACHE_SIZE
+    preprocessing.PERCENTILE_CACHE_SIZE = 3
+    try:
+        _check_percentile_values_cache(tmp_path)
+    finally:
+        preprocessing.PERCENTILE_CACHE_SIZE = cache_size
+
+
+def _check_percentile_values_cache(tmp_path):
+    preprocessor = _get_histogram_preprocessor(str(tmp_path))
+    rng = np.random.RandomState(0)
+    volumes = {f"P{i:03d}": rng.gamma(2.0, 0.5, size=(16, 16, 8)).astype(np.float32) for i in range(5)}
+
+    for p_id in ['P000', 'P001', 'P002', 'P000', 'P003', 'P004']:
+        expected = preprocessor.normalize_intensity(volumes[p_id], 'PET')
+        result = preprocessor.normalize_intensity(volumes[p_id], 'PET', cache_key=p_id)
+        assert np.array_equal(result, expected)
+
+    # P000 was used again before P003 and P004 were added, so P001 and P002 were dropped
+    assert list(preprocessor.percentile_values_cache.keys()) == [('P000', 'PET'), ('P003', 'PET'), ('P004', 'PET')]
+
+    # The cache is copied to worker processes, each with its own lock
+    preprocessor_copy = pickle.loads(pickle.dumps(preprocessor))
+    assert list(preprocessor_copy.percentile_values_cache.keys()) == list(preprocessor.percentile_values_cache.keys())
+    assert preprocessor_copy.percentile_cache_lock is not preprocessor.percentile_cache_lock
+
+
+def test_float32_mode_outputs_are_independent():
+    preprocessor = Preprocessor(smooth_sigma_mm={'PET': 2.0, 'CT': 0.0},
+                                normalization_method={'PET': None, 'CT': 'clip-and-rescale'},
+                                float32_mode=True)
+    preprocessor.set_spacing({'xy-spacing': 1.0, 'slice-thickness': 3.0})
+    rng = np.random.RandomState(0)
+
+    outputs = []
+    for shape in [(32, 32, 16), (24, 20, 12), (24, 20, 12)]:
+        PET_np = rng.gamma(2.0, 0.5, size=shape).astype(np.float32)
+        smoothed_np = preprocessor.smoothing_filter(PET_np, 'PET')
+        output_np = preprocessor.normalize_intensity(smoothed_np, 'PET')
+        outputs.append((output_np, output_np.copy()))
+
+    # Later calls do not overwrite earlier outputs
+    for output_np, expected_np in outputs:
+        assert output_np.dtype == np.float32
+        assert np.array_equal(output_np, expected_np)
+
+    # Smaller volumes, e.g. region reads, reuse the buffer allocated for the largest one
+    assert preprocessor.smoothing_buffers['PET'].size == 32 * 32 * 16
+
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_percentile_values_cache_is_bounded(tmp_dir)
+    test_float32_mode_outputs_are_independent()
@@ -0,0 +1,77 @@
+import os, sys, tempfile
+import numpy as np
+import pytest
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+from datasets.hecktor_petct_dataset import HECKTORPETCTDataset
+from datasets.hecktor_unimodal_dataset import HECKTORUnimodalDataset
+from datautils.preprocessing import Preprocessor
+from datautils.patch_sampling import PatchSampler3D
+from datautils.io import write_packed_subject
+
+
+VOLUME_SIZE = (40, 36, 20)  # (W,H,D)
+PATCH_SIZE = (16, 16, 8)    # (W,H,D)
+PADDING = (0, 0, 4)         # (W,H,D) -- Patches near the bottom stick out of the volume
+PATIENT_IDS = ['CHGJ001', 'CHUS002']
+
+
+def _write_packed_dataset(data_dir):
+    rng = np.random.RandomState(0)
+    for p_id in PATIENT_IDS:
+        PET_np = rng.gamma(2.0, 2.0, size=VOLUME_SIZE).astype(np.float32)
+        CT_np = rng.normal(0.0, 100.0, size=VOLUME_SIZE).astype(np.float32)
+        GTV_np = (PET_np > 8.0).astype(np.uint8)
+        write_packed_subject(f"{data_dir}/{p_id}.h5", {'PET': PET_np, 'CT': CT_np, 'GTV': GTV_np},
+                             spacing=(1.0, 1.0, 3.0), origin=(0.0, 0.0, 0.0), chunk_size=8)
+
+    patient_id_filepath = f"{data_dir}/patient_IDs.txt"
+    with open(patient_id_filepath, 'w') as pf:
+        pf.write('\n'.join(PATIENT_IDS))
+    return patient_id_filepath
+
+
+def _get_datasets(data_dir, dataset_kwargs):
+    patient_id_filepath = _write_packed_dataset(data_dir)
+    datasets = []
+    for region_reads in [False, True]:
+        preprocessor = Preprocessor(smooth_sigma_mm={'PET': 2.0, 'CT': 1.0})
+        dataset_class = HECKTORUnimodalDataset if 'input_modality' in dataset_kwargs else HECKTORPETCTDataset
+        datasets.append(dataset_class(data_dir, patient_id_filepath, mode='training', preprocessor=preprocessor,
+                                      data_format='hdf5', region_reads=region_reads, **dataset_kwargs))
+    return datasets
+
+
+@pytest.mark.parametrize('margin', [(0, 0, 0), (3, 2, 1)])
+@pytest.mark.parametrize('dataset_kwargs', [{'input_representation': 'separate-volumes'},
+                                            {'input_representation': 'multichannel-volume'},
+                                            {'input_modality': 'PET'},
+                                            {'input_modality': 'CT'}])
+def test_region_reads_match_full_volumes(tmp_path, margin, dataset_kwargs):
+    full_dataset, lazy_dataset = _get_datasets(str(tmp_path), dataset_kwargs)
+
+    for idx in range(len(full_dataset)):
+        patches = []
+        for dataset in [full_dataset, lazy_dataset]:
+            sampler = PatchSampler3D(PATCH_SIZE, volume_size=VOLUME_SIZE, sampling='random', padding=PADDING, margin=margin, rng=idx)
+            patches.append(sampler.get_samples(dataset[idx], num_patches=12)[0])
+
+        full_patches, lazy_patches = patches
+        assert len(full_patches) == len(lazy_patches) == 12
+        for full_patch, lazy_patch in zip(full_patches, lazy_patches):
+            assert full_patch.keys() == lazy_patch.keys()
+            for key in full_patch.keys():
+                assert full_patch[key].shape == lazy_patch[key].shape
+                assert full_patch[key].dtype == lazy_patch[key].dtype
+                assert torch.allclose(full_patch[key], lazy_patch[key], atol=1e-5)
+
+
+
+if __name__ == '__main__':
+
+    for margin in [(0, 0, 0), (3, 2, 1)]:
+        for dataset_kwargs in [{'input_representation': 'separate-volumes'}, {'input_representation': 'multichannel-volume'},
+                               {'input_modality': 'PET'}, {'input_modality': 'CT'}]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                test_region_reads_match_full_volumes(tmp_dir, margin, dataset_kwargs)
@@ -0,0 +1,232 @@
+import os, sys
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from scipy.ndimage import affine_transform
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+from hktr_resampling_utils import resample_np_binary_volume, resample_np_volume, resample_sitk_volume, grid_from_spacing
+from hktr_resampling_utils import get_sitk_volume_from_np, get_np_volume_from_sitk
+from hktr_resampling_utils import resample_and_crop, resample_and_crop_levels, get_grid_strides
+
+
+
+def resample_np_binary_volume_reference(np_volume, origin, current_pixel_spacing,
+                                        resampling_px_spacing, bounding_box):
+    """
+    The original meshgrid + RegularGridInterpolator implementation, kept as the reference.
+    """
+    x_old = grid_from_spacing(origin[0], current_pixel_spacing[0], np_volume.shape[0])
+    y_old = grid_from_spacing(origin[1], current_pixel_spacing[1], np_volume.shape[1])
+    z_old = grid_from_spacing(origin[2], current_pixel_spacing[2], np_volume.shape[2])
+
+    output_shape = (np.ceil([
+        bounding_box[3] - bounding_box[0],
+        bounding_box[4] - bounding_box[1],
+        bounding_box[5] - bounding_box[2],
+    ]) / resampling_px_spacing).astype(int)
+
+    x_new = grid_from_spacing(bounding_box[0], resampling_px_spacing[0], output_shape[0])
+    y_new = grid_from_spacing(bounding_box[1], resampling_px_spacing[1], output_shape[1])
+    z_new = grid_from_spacing(bounding_box[2], resampling_px_spacing[2], output_shape[2])
+    interpolator = RegularGridInterpolator((x_old, y_old, z_old),
+                                           np_volume,
+                                           method='nearest',
+                                           bounds_error=False,
+                                           fill_value=0)
+    x, y, z = np.meshgrid(x_new, y_new, z_new, indexing='ij')
+    pts = np.array(list(zip(x.flatten(), y.flatten(), z.flatten())))
+
+    return interpolator(pts).reshape(output_shape)
+
+
+
+def test_binary_resampling_matches_reference():
+    rng = np.random.RandomState(0)
+
+    # (dtype, source spacing, target spacing, bbox offset from origin in mm) -- Includes bboxes extending past the volume
+    cases = [
+             (np.uint8, (0.9765625, 0.9765625, 3.27), (1.0, 1.0, 3.0), (20.3, 11.7, 30.0)),
+             (np.float32, (1.0, 1.0, 3.0), (1.0, 1.0, 3.0), (0.0, 0.0, 0.0)),
+             (np.float64, (1.171875, 1.171875, 2.0), (2.0, 2.0, 2.0), (-15.5, 40.25, 7.0)),
+             (np.int16, (0.5, 0.5, 1.5), (1.0, 1.0, 3.0), (60.0, 60.0, 60.0)),
+            ]
+
+    for dtype, current_spacing, new_spacing, bbox_offset in cases:
+        np_volume = (rng.rand(60, 55, 40) > 0.7).astype(dtype)
+        origin = (-61.3, -112.7, -480.25)
+        bounding_box = [origin[i] + bbox_offset[i] for i in range(3)]
+        bounding_box += [bounding_box[i] + 50.0 for i in range(3)]
+        new_spacing = np.asarray(new_spacing)
+
+        expected = resample_np_binary_volume_reference(np_volume, origin, current_spacing, new_spacing, bounding_box)
+        result = resample_np_binary_volume(np_volume, origin, current_spacing, new_spacing, bounding_box)
+
+        assert result.dtype == expected.dtype
+        assert result.shape == expected.shape
+        assert np.array_equal(result, expected)
+
+
+
+def resample_np_volume_reference(np_volume, origin, current_pixel_spacing, resampling_px_spacing, bounding_box, order=3):
+    """
+    The original implementation, interpolating over the full uncropped volume.
+    """
+    zooming_matrix = np.diag(np.asarray(resampling_px_spacing) / np.asarray(current_pixel_spacing))
+    offset = [(bounding_box[i] - origin[i]) / current_pixel_spacing[i] for i in range(3)]
+    output_shape = np.ceil([bounding_box[i+3] - bounding_box[i] for i in range(3)]) / resampling_px_spacing
+    return affine_transform(np_volume, zooming_matrix, offset=offset, mode='mirror', order=order,
+                            output_shape=output_shape.astype(int))
+
+
+
+def test_spline_resampling_matches_reference():
+    rng = np.random.RandomState(0)
+    np_volume = rng.rand(160, 150, 120).astype(np.float32) * 1000
+    origin = (-250.3, -240.1, -900.5)
+    current_spacing = (0.9765625, 0.9765625, 2.0)
+    new_spacing = np.asarray((1.0, 1.0, 3.0))
+
+    # bbox offset from origin in mm -- Inside the volume, touching the start, and extending past the end
+    for bbox_offset in [(40.0, 35.5, 60.2), (0.0, 10.0, 0.0), (100.0, 90.0, 150.0)]:
+        bounding_box = [origin[i] + bbox_offset[i] for i in range(3)]
+        bounding_box += [bounding_box[i] + 50.0 for i in range(3)]
+
+        for order in [1, 3]:
+            expected = resample_np_volume_reference(np_volume, origin, current_spacing, new_spacing, bounding_box, order=order)
+            result = resample_np_volume(np_volume, origin, current_spacing, new_spacing, bounding_box, order=order)
+
+            assert result.shape == expected.shape
+            assert np.allclose(result, expected, rtol=1e-5, atol=1e-3)
+
+
+
+def test_sitk_backend_matches_scipy():
+    rng = np.random.RandomState(0)
+    np_volume = rng.rand(120, 110, 50).astype(np.float32) * 1000
+    np_mask = (rng.rand(120, 110, 50) > 0.7).astype(np.uint8)
+    origin = (-61.3, -112.7, -480.25)
+    current_spacing = (0.9765625, 0.9765625, 3.27)
+    new_spacing = np.asarray((1.0, 1.0, 3.0))
+
+    # bbox inside the source image -- Outside it, the backends fill differently
+    bounding_box = [origin[0] + 20.3, origin[1] + 11.7, origin[2] + 30.0]
+    bounding_box += [bounding_box[0] + 80.0, bounding_box[1] + 80.0, bounding_box[2] + 90.0]
+
+    for order in [1, 3]:
+        expected = resample_np_volume(np_volume, origin, current_spacing, new_spacing, bounding_box, order=order)
+        sitk_volume = resample_sitk_volume(get_sitk_volume_from_np(np_volume, current_spacing, origin),
+                                           new_spacing, bounding_box, order=order, num_threads=2)
+        result, spacing, result_origin = get_np_volume_from_sitk(sitk_volume)
+
+        assert result.shape == expected.shape
+        assert np.allclose(spacing, new_spacing) and np.allclose(result_origin, bounding_box[:3])
+        assert np.abs(result - expected).max() < 1e-5 * (expected.max() - expected.min())
+
+    expected = resample_np_binary_volume(np_mask, origin, current_spacing, new_spacing, bounding_box)
+    sitk_volume = resample_sitk_volume(get_sitk_volume_from_np(np_mask, current_spacing, origin),
+                                       new_spacing, bounding_box, order=0)
+    result = get_np_volume_from_sitk(sitk_volume)[0]
+
+    assert result.dtype == np.uint8
+    assert np.array_equal(result, expected)
+
+
+
+def _get_synthetic_volumes(shape, pixel_spacing, origin):
+    # Smooth "PET-like" blobs on a low background, and the mask of the hottest one
+    x, y, z = [origin[i] + pixel_spacing[i] * np.arange(shape[i]) for i in range(3)]
+    x, y, z = np.meshgrid(x, y, z, indexing='ij')
+    centres = [(origin[0] + 40.0, origin[1] + 45.0, origin[2] + 60.0), (origin[0] + 75.0, origin[1] + 30.0, origin[2] + 100.0)]
+    np_volume = np.full(shape, 0.5, dtype=np.float32)
+    for (cx, cy, cz), amplitude in zip(centres, [10.0, 4.0]):
+        np_volume += amplitude * np.exp(-((x - cx)**2 + (y - cy)**2 + (z - cz)**2) / (2 * 12.0**2))
+    np_mask = ((x - centres[0][0])**2 + (y - centres[0][1])**2 + (z - centres[0][2])**2 < 15.0**2).astype(np.uint8)
+    return np_volume, np_mask
+
+
+
+def test_resample_and_crop_backends_match(tmp_path):
+    from cli_compare_resampling_backends import get_source_overlap_mask
+
+    origin = (-61.3, -112.7, -480.25)
+    current_spacing = (0.9765625, 0.9765625, 3.27)
+    np_volume, np_mask = _get_synthetic_volumes((100, 90, 50), current_spacing, origin)
+    input_files = {'_pt': get_sitk_volume_from_np(np_volume, current_spacing, origin),
+                   '_ct_gtvt': get_sitk_volume_from_np(np_mask, current_spacing, origin)}
+    new_spacing = (1.0, 1.0, 3.0)
+
+    # bbox offset from origin in mm -- Inside the volume, and extending past its end along every axis
+    for bbox_offset, is_inside in [((10.3, 11.7, 30.0), True), ((45.0, 40.0, 90.0), False)]:
+        bounding_box = [origin[i] + bbox_offset[i] for i in range(3)]
+        bounding_box += [bounding_box[0] + 70.0, bounding_box[1] + 60.0, bounding_box[2] + 90.0]
+
+        for file_suffix, sitk_image in input_files.items():
+            input_file = str(tmp_path / f"P001{file_suffix}.nii.gz")
+            sitk.WriteImage(sitk_image, input_file)
+
+            outputs = {}
+            for backend in ['scipy', 'sitk']:
+                output_file = str(tmp_path / f"{backend}{file_suffix}.nii.gz")
+                resample_and_crop(input_file, output_file, bounding_box, resampling=new_spacing, backend=backend, num_threads=2)
+                outputs[backend] = sitk.ReadImage(output_file)
+
+            assert outputs['sitk'].GetSize() == outputs['scipy'].GetSize()
+            assert np.allclose(outputs['sitk'].GetSpacing(), outputs['scipy'].GetSpacing())
+            assert np.allclose(outputs['sitk'].GetOrigin(), outputs['scipy'].GetOrigin())
+
+            # Outside the source image, scipy mirrors it and sitk fills in its minimum -- Compare within it only
+            expected, result = [get_np_volume_from_sitk(outputs[backend])[0] for backend in ['scipy', 'sitk']]
+            overlap_mask = get_source_overlap_mask(sitk.ReadImage(input_file), bounding_box, expected.shape, new_spacing)
+            assert overlap_mask.all() if is_inside else 0 < overlap_mask.mean() < 1
+            if file_suffix == '_ct_gtvt':
+                assert np.array_equal(result[overlap_mask], expected[overlap_mask])
+            else:
+                max_error = np.abs(result[overlap_mask] - expected[overlap_mask]).max()
+                assert max_error < 1e-4 * (expected.max() - expected.min())
+
+
+
+def test_resampling_levels_match_single_resampling(tmp_path):
+    rng = np.random.RandomState(0)
+    origin = (-61.3, -112.7, -480.25)
+    input_files = {'_ct': get_sitk_volume_from_np(rng.rand(90, 80, 40).astype(np.float32) * 1000, (0.9765625, 0.9765625, 3.27), origin),
+                   '_ct_gtvt': get_sitk_volume_from_np((rng.rand(90, 80, 40) > 0.7).astype(np.uint8), (0.9765625, 0.9765625, 3.27), origin)}
+    bounding_box = [origin[0] + 10.3, origin[1] + 11.7, origin[2] + 30.0]
+    bounding_box += [bounding_box[0] + 61.0, bounding_box[1] + 50.0, bounding_box[2] + 90.0]
+
+    # The coarser levels are strided from finer ones, except (1.5, 1.5, 3.0)
+    resamplings = [(2.0, 2.0, 6.0), (1.0, 1.0, 3.0), (0.5, 0.5, 1.5), (1.5, 1.5, 3.0)]
+    assert get_grid_strides((1.0, 1.0, 3.0), (2.0, 2.0, 6.0)) == [2, 2, 2]
+    assert get_grid_strides((1.0, 1.0, 3.0), (1.5, 1.5, 3.0)) is None
+
+    for backend in ['scipy', 'sitk']:
+        for file_suffix, sitk_image in input_files.items():
+            input_file = str(tmp_path / f"P001{file_suffix}.nii.gz")
+            sitk.WriteImage(sitk_image, input_file)
+            output_files = [str(tmp_path / f"level{i}{file_suffix}.nii.gz") for i in range(len(resamplings))]
+            resample_and_crop_levels(input_file, output_files, bounding_box, resamplings, backend=backend)
+
+            for output_file, resampling in zip(output_files, resamplings):
+                expected_file = str(tmp_path / f"expected{file_suffix}.nii.gz")
+                resample_and_crop(input_file, expected_file, bounding_box, resampling=resampling, backend=backend)
+                expected, result = sitk.ReadImage(expected_file), sitk.ReadImage(output_file)
+
+                assert result.GetSize() == expected.GetSize()
+                assert np.allclose(result.GetSpacing(), expected.GetSpacing())
+                assert np.allclose(result.GetOrigin(), expected.GetOrigin())
+                assert np.array_equal(sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(expected))
+
+
+
+if __name__ == '__main__':
+
+    test_binary_resampling_matches_reference()
+    test_spline_resampling_matches_reference()
+    test_sitk_backend_matches_scipy()
+
+    import tempfile, pathlib
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_resampling_levels_match_single_resampling(pathlib.Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_resample_and_crop_backends_match(pathlib.Path(tmp_dir))
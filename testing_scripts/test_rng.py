@@ -0,0 +1,66 @@
+import os, sys
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+from datautils.rng import seed_components, get_worker_init_fn
+from datautils.transforms import PatchAugmenter, SpatialAugmenter
+
+
+class _QueueLike(Dataset):
+    """
+    Mimics a patch queue: the generators are nested, as in PatchQueue.patch_transform.spatial_augmenter and
+    PatchQueue.dataset.spatial_augmenter.
+    """
+    def __init__(self, rng=0):
+        self.rng = np.random.default_rng(rng)
+        self.patch_transform = PatchAugmenter(patch_size=(8, 8, 8), margin=(2, 2, 2), rng=self.rng)
+        self.dataset = type('Dataset', (), {})()
+        self.dataset.spatial_augmenter = SpatialAugmenter(spacing=(3.0, 1.0, 1.0), rng=self.rng)
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, _):
+        return torch.tensor([self.rng.random(),
+                             self.patch_transform.rng.random(),
+                             self.patch_transform.spatial_augmenter.rng.random(),
+                             self.dataset.spatial_augmenter.rng.random()])
+
+
+def _draw(queue):
+    return [queue.rng.random(),
+            queue.patch_transform.rng.random(),
+            queue.patch_transform.spatial_augmenter.rng.random(),
+            queue.dataset.spatial_augmenter.rng.random()]
+
+
+def test_seed_components_reaches_nested_generators():
+    queues = [_QueueLike(), _QueueLike(), _QueueLike()]
+    seed_components([queues[0]], np.random.SeedSequence(0, spawn_key=(0,)))
+    seed_components([queues[1]], np.random.SeedSequence(0, spawn_key=(1,)))
+    seed_components([queues[2]], np.random.SeedSequence(0, spawn_key=(0,)))
+
+    draws = [_draw(queue) for queue in queues]
+
+    # Every generator, nested or not, gets its own stream -- per component and per worker -- reproducible per seed
+    assert len(set(draws[0])) == 4
+    assert all(draw_0 != draw_1 for draw_0, draw_1 in zip(draws[0], draws[1]))
+    assert draws[0] == draws[2]
+
+
+def test_worker_init_fn_seeds_nested_generators():
+    loader = DataLoader(_QueueLike(), batch_size=None, num_workers=2,
+                        worker_init_fn=get_worker_init_fn(np.random.SeedSequence(0)))
+    draws = [draw.tolist() for draw in loader]
+
+    assert len(draws) == 2
+    assert all(draw_0 != draw_1 for draw_0, draw_1 in zip(draws[0], draws[1]))
+
+
+
+if __name__ == '__main__':
+
+    test_seed_components_reaches_nested_generators()
+    test_worker_init_fn_seeds_nested_generators()
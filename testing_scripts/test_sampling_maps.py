@@ -0,0 +1,95 @@
+import os, sys
+import numpy as np
+import pytest
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+from datautils.patch_sampling import PatchSampler3D, PatchQueue, get_sampling_map_index, get_valid_indx_range
+from datautils.patch_sampling import SAMPLING_MAP_CACHE_SIZE
+
+
+VOLUME_SIZE = (32, 32, 16)  # (W,H,D)
+PATCH_SIZE = (8, 8, 4)
+
+
+def _get_subject(PET_value, volume_size=VOLUME_SIZE, p_id='P000'):
+    shape = tuple(reversed(volume_size))
+    return {'patient-id': p_id,
+            'PET': torch.full((1,) + shape, PET_value, dtype=torch.float32),
+            'CT': torch.zeros((1,) + shape, dtype=torch.float32),
+            'target-labelmap': torch.zeros(shape, dtype=torch.long)}
+
+
+def _write_sampling_maps(maps_dir, p_ids):
+    # Same format as tools/cli_precompute_sampling_maps.py, with a uniform map
+    patch_size, volume_size = list(reversed(PATCH_SIZE)), list(reversed(VOLUME_SIZE))
+    focal_point_candidates, cumulative_weights = get_sampling_map_index(np.ones(volume_size),
+                                                                        get_valid_indx_range(patch_size, volume_size))
+    for p_id in p_ids:
+        np.savez(f"{maps_dir}/{p_id}_sampling_map.npz",
+                 focal_point_candidates=focal_point_candidates,
+                 cumulative_weights=cumulative_weights,
+                 patch_size=np.array(patch_size),
+                 volume_size=np.array(volume_size))
+
+
+def test_sampling_map_index_rejects_invalid_totals():
+    valid_indx_range = [np.zeros(3), np.array([15, 31, 31])]
+
+    nan_map = np.full((16, 32, 32), np.nan, dtype=np.float32)
+    with pytest.raises(ValueError):
+        get_sampling_map_index(nan_map, valid_indx_range)
+
+    negative_map = -np.ones((16, 32, 32), dtype=np.float32)
+    with pytest.raises(ValueError):
+        get_sampling_map_index(negative_map, valid_indx_range)
+
+    focal_point_candidates, cumulative_weights = get_sampling_map_index(np.ones((16, 32, 32)), valid_indx_range)
+    assert len(focal_point_candidates) == 16 * 32 * 32
+    assert cumulative_weights[-1] == 1
+
+
+def test_suv_weighted_sampling_without_foreground():
+    sampler = PatchSampler3D(PATCH_SIZE, volume_size=VOLUME_SIZE, sampling='suv-weighted-random', rng=0)
+
+    # PET below the intensity threshold everywhere -- The normalized map is 0/0
+    with pytest.raises(ValueError):
+        sampler.get_samples(_get_subject(1.0), num_patches=4)
+
+    patches, _ = sampler.get_samples(_get_subject(5.0), num_patches=4)
+    assert len(patches) == 4
+
+
+
+def test_precomputed_sampling_maps_are_bounded_and_checked(tmp_path):
+    p_ids = [f"P{i:03d}" for i in range(SAMPLING_MAP_CACHE_SIZE + 4)]
+    _write_sampling_maps(tmp_path, p_ids)
+    sampler = PatchSampler3D(PATCH_SIZE, volume_size=VOLUME_SIZE, sampling='gtv-petfg-weighted-random',
+                             sampling_maps_dir=str(tmp_path), rng=0)
+
+    # Only the most recently used maps stay loaded
+    for p_id in p_ids:
+        patches, _ = sampler.get_samples(_get_subject(5.0, p_id=p_id), num_patches=2)
+        assert len(patches) == 2
+    assert list(sampler.sampling_map_indices.keys()) == p_ids[-SAMPLING_MAP_CACHE_SIZE:]
+
+    # A subject on another grid than the map's
+    with pytest.raises(ValueError):
+        sampler.get_samples(_get_subject(5.0, volume_size=(32, 32, 20)), num_patches=2)
+
+    # A dataset augmenting the volumes moves them off the maps' grid
+    augmenting_dataset = [_get_subject(5.0)]
+    augmenting_dataset = type('Dataset', (list,), {'augment_data': True})(augmenting_dataset)
+    with pytest.raises(ValueError):
+        PatchQueue(augmenting_dataset, max_length=4, samples_per_volume=2, sampler=sampler, num_workers=0)
+
+
+
+if __name__ == '__main__':
+
+    test_sampling_map_index_rejects_invalid_totals()
+    test_suv_weighted_sampling_without_foreground()
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_precomputed_sampling_maps_are_bounded_and_checked(tmp_dir)
@@ -0,0 +1,65 @@
+import os, sys
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../"))
+from datautils.preprocessing import Preprocessor, recursive_gaussian_filter
+
+
+# The recursive filter approximates the Gaussian kernel, and handles the borders differently than scipy's 'reflect'
+# mode. So the outputs are compared away from the borders, with a tolerance relative to the intensity range
+RELATIVE_TOLERANCE = 0.01
+
+
+def _get_synthetic_PET(shape=(120, 110, 60), seed=0):
+    rng = np.random.RandomState(seed)
+    PET_np = rng.gamma(2.0, 0.5, size=shape).astype(np.float32)  # Noisy background
+    PET_np[40:70, 30:60, 35:50] += 15.0  # "Brain"
+    PET_np[50:58, 70:80, 10:20] += 8.0  # "Tumour"
+    return PET_np
+
+
+def _get_interior(sigma):
+    return tuple(slice(int(np.ceil(4 * s)), -int(np.ceil(4 * s)) or None) for s in sigma)
+
+
+def test_recursive_gaussian_matches_scipy():
+    PET_np = _get_synthetic_PET()
+
+    for sigma in [(2.0, 2.0, 2.0), (3.0, 3.0, 3.0), (2.0, 2.0, 1.0), (2.0, 2.0, 0.0), (0.0, 3.0, 0.0)]:
+        expected = gaussian_filter(PET_np, sigma=sigma)
+        result = recursive_gaussian_filter(PET_np, sigma)
+
+        assert result.shape == expected.shape
+        assert result.dtype == np.float32
+        interior = _get_interior(sigma)
+        max_error = np.abs(result[interior] - expected[interior]).max()
+        assert max_error < RELATIVE_TOLERANCE * (expected.max() - expected.min())
+
+
+def test_preprocessor_smoothing_backends():
+    PET_np = _get_synthetic_PET()
+    spacing_dict = {'xy-spacing': 1.0, 'slice-thickness': 3.0}
+    smooth_sigma_mm = {'PET': 6.0, 'CT': 0.0}
+
+    outputs = {}
+    for backend in ['scipy', 'sitk-recursive']:
+        preprocessor = Preprocessor(smooth_sigma_mm=smooth_sigma_mm, smoothing_backend=backend)
+        preprocessor.set_spacing(spacing_dict)
+        outputs[backend] = preprocessor.smoothing_filter(PET_np, modality='PET')
+
+    interior = _get_interior((6.0, 6.0, 2.0))
+    max_error = np.abs(outputs['sitk-recursive'][interior] - outputs['scipy'][interior]).max()
+    assert max_error < RELATIVE_TOLERANCE * (outputs['scipy'].max() - outputs['scipy'].min())
+
+    # Zero sigma leaves the volume as it is
+    preprocessor = Preprocessor(smooth_sigma_mm=smooth_sigma_mm, smoothing_backend='sitk-recursive')
+    preprocessor.set_spacing(spacing_dict)
+    assert np.array_equal(preprocessor.smoothing_filter(PET_np, modality='CT'), PET_np)
+
+
+
+if __name__ == '__main__':
+
+    test_recursive_gaussian_matches_scipy()
+    test_preprocessor_smoothing_backends()
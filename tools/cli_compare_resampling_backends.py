@@ -0,0 +1,143 @@
+"""
+
+Accuracy and timing report comparing the 'scipy' and 'sitk' backends of hktr_resampling_utils.resample_and_crop().
+
+Each NIfTI file in the source dir is cropped to its patient's bbox and resampled with both backends, in memory. The
+outputs are compared on the voxels that lie within the source image -- outside it, scipy mirrors the image while sitk
+fills in the image minimum, so differences there are expected. For the GTV masks, the mismatching voxels are counted.
+
+"""
+
+import os, glob, time, argparse
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from hktr_resampling_utils import resample_np_volume, resample_np_binary_volume, resample_sitk_volume
+from hktr_resampling_utils import get_np_volume_from_sitk
+
+
+# Constants
+DEFAULT_SOURCE_DIR = "../notebooks/sample data"
+DEFAULT_BB_FILEPATH = "../hecktor_meta/default_small_crop/crS_train-bboxes.csv"
+DEFAULT_NEW_SPACING = [1.0, 1.0, 3.0]  # (W,H,D) format
+DEFAULT_ORDER = 3
+DEFAULT_NUM_THREADS = os.cpu_count()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--source_dir",
+                        type=str,
+                        default=DEFAULT_SOURCE_DIR,
+                        help="Directory containing patient folders"
+                        )
+
+    parser.add_argument("--bbox_filepath",
+                        type=str,
+                        default=DEFAULT_BB_FILEPATH,
+                        help="CSV file that contains bbox coordinates"
+                        )
+
+    parser.add_argument("--new_spacing",
+                        type=float,
+                        nargs=3,
+                        default=DEFAULT_NEW_SPACING,
+                        help="Voxel spacing the output images in mm -- (W,H,D) format"
+                        )
+
+    parser.add_argument("--order",
+                        type=int,
+                        default=DEFAULT_ORDER,
+                        help="Order of the spline interpolation used to resample"
+                        )
+
+    parser.add_argument("--num_threads",
+                        type=int,
+                        default=DEFAULT_NUM_THREADS,
+                        help="Number of threads for the sitk backend"
+                        )
+
+    parser.add_argument("--output_filepath",
+                        type=str,
+                        default=None,
+                        help="Optional CSV file to write the report to"
+                        )
+
+    args = parser.parse_args()
+    return args
+
+
+def get_source_overlap_mask(sitk_image, bounding_box, output_shape, resampling_px_spacing):
+    """
+    Mask of the output voxels, in (W,H,D) ordering, whose centres lie within the source image's voxel centres.
+    """
+    axis_masks = []
+    for axis in range(3):
+        output_coords = bounding_box[axis] + np.arange(output_shape[axis]) * resampling_px_spacing[axis]
+        source_indxs = (output_coords - sitk_image.GetOrigin()[axis]) / sitk_image.GetSpacing()[axis]
+        axis_masks.append((source_indxs >= 0) & (source_indxs <= sitk_image.GetSize()[axis] - 1))
+    return axis_masks[0][:, None, None] & axis_masks[1][None, :, None] & axis_masks[2][None, None, :]
+
+
+def compare_backends(input_file, bounding_box, resampling, order, num_threads):
+    sitk_image = sitk.ReadImage(input_file)
+    np_volume, pixel_spacing, origin = get_np_volume_from_sitk(sitk_image)
+    is_binary = 'gtv' in input_file or 'GTV' in input_file
+
+    start_time = time.time()
+    if is_binary:
+        scipy_volume = resample_np_binary_volume(np_volume, origin, pixel_spacing, resampling, bounding_box)
+    else:
+        scipy_volume = resample_np_volume(np_volume, origin, pixel_spacing, resampling, bounding_box, order=order)
+    scipy_seconds = time.time() - start_time
+
+    start_time = time.time()
+    sitk_volume = resample_sitk_volume(sitk_image, resampling, bounding_box,
+                                       order=0 if is_binary else order, num_threads=num_threads)
+    sitk_seconds = time.time() - start_time
+    sitk_volume = get_np_volume_from_sitk(sitk_volume)[0]
+
+    overlap_mask = get_source_overlap_mask(sitk_image, bounding_box, scipy_volume.shape, resampling)
+    abs_diff = np.abs(scipy_volume[overlap_mask].astype(np.float64) - sitk_volume[overlap_mask].astype(np.float64))
+    intensity_range = float(scipy_volume.max() - scipy_volume.min())
+
+    row = {'file': os.path.basename(input_file),
+           'scipy_seconds': scipy_seconds,
+           'sitk_seconds': sitk_seconds,
+           'overlap_fraction': overlap_mask.mean(),
+           'max_abs_diff': abs_diff.max() if abs_diff.size > 0 else 0.0,
+           'mean_abs_diff': abs_diff.mean() if abs_diff.size > 0 else 0.0,
+           'max_rel_diff': abs_diff.max() / intensity_range if abs_diff.size > 0 and intensity_range > 0 else 0.0,
+           'mismatching_voxels': int(np.count_nonzero(abs_diff)) if is_binary else None}
+    return row
+
+
+def main(args):
+
+    resampling = np.asarray(args.new_spacing, dtype=float)
+    bb_df = pd.read_csv(args.bbox_filepath).set_index('PatientID')
+
+    rows = []
+    for input_file in sorted(glob.glob(args.source_dir + '/**/*.nii.gz', recursive=True)):
+        patient_name = input_file.split('/')[-1].split('_')[0]
+        if patient_name not in bb_df.index:
+            print(f"No bbox found for {patient_name}. Skipping")
+            continue
+        bounding_box = tuple(bb_df.loc[patient_name, ['x1', 'y1', 'z1', 'x2', 'y2', 'z2']].astype(float))
+        rows.append(compare_backends(input_file, bounding_box, resampling, args.order, args.num_threads))
+
+    report_df = pd.DataFrame(rows)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(report_df)
+
+    if args.output_filepath is not None:
+        report_df.to_csv(args.output_filepath, index=False)
+
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
@@ -10,6 +10,15 @@ Adapted from github.com/voreille/hecktor
         resampled with spline interpolation
         of degree --order (default=3) and the segmentation are resampled
         by nearest neighbor interpolation.
+        With --backend sitk, the resampling runs on sitk's multithreaded
+        filter instead of scipy's single-threaded one. Each of the --cores
+        worker processes then uses --num_threads threads -- e.g. few cores
+        with many threads each for the large whole-body scans.
+        Several spacings can be given to --new_spacing (3 values each). Each
+        source file is then read once and resampled to every spacing, and
+        each level is written to its own sub-directory of OUTPUT_FOLDER,
+        e.g. rs1x1x3/ and rs2x2x6/. Levels whose spacing is an integer
+        multiple of a finer level's are taken from that level by striding.
         INPUT_FOLDER is the path of the folder containing the NIFTI to
         resample.
         OUTPUT_FOLDER is the path of the folder where to store the
@@ -22,17 +31,19 @@ Adapted from github.com/voreille/hecktor
 import os
 from multiprocessing import Pool
 import glob
+import json
+import time
 import argparse
 import logging
+import traceback
 
 import pandas as pd
-import numpy as np
-from scipy.ndimage import affine_transform
-from scipy.interpolate import RegularGridInterpolator
+from tqdm import tqdm
 import SimpleITK as sitk
 
 
-from hktr_resampling_utils import Resampler, get_sitk_volume_from_np, get_np_volume_from_sitk
+from hktr_resampling_utils import Resampler, resample_and_crop_levels
+from hktr_resampling_utils import RESAMPLING_BACKENDS
 
 # Constants
 DEFAULT_SOURCE_DIR = "../../../Datasets/HECKTOR/hecktor_train/hecktor_nii"
@@ -41,6 +52,11 @@ DEFAULT_BB_FILEPATH = "../hecktor_meta/default_small_crop/crS_train-bboxes.csv"
 DEFAULT_NEW_SPACING = [1.0, 1.0, 3.0]  # New spacing to resample to in mm -- (W,H,D) format
 DEFAULT_CORES = 24
 DEFAULT_ORDER = 3
+DEFAULT_RETRIES = 1
+DEFAULT_BACKEND = 'scipy'
+
+MANIFEST_FILENAME = "crop_and_resample_manifest.json"  # Sidecar in the target dir, recording the parameters of each output
+LOG_FILENAME = "crop_and_resample.log"
 
 
 def get_args():
@@ -67,9 +83,10 @@ def get_args():
 
     parser.add_argument("--new_spacing",
                         type=float,
-                        nargs=3,
+                        nargs='+',
                         default=DEFAULT_NEW_SPACING,
-                        help="Voxel spacing the output images in mm -- (W,H,D) format"
+                        help="Voxel spacing the output images in mm -- (W,H,D) format. "
+                             "Multiple (W,H,D) triplets for a multi-resolution output, e.g. 1 1 3 2 2 6"
                         )
 
     parser.add_argument("--cores",
@@ -84,24 +101,196 @@ def get_args():
                         help="Order of the spline interpolation used to resample"
                         )
 
+    parser.add_argument("--backend",
+                        type=str,
+                        default=DEFAULT_BACKEND,
+                        choices=RESAMPLING_BACKENDS,
+                        help="Resampling backend -- 'scipy' (single-threaded) or 'sitk' (multithreaded)"
+                        )
+
+    parser.add_argument("--num_threads",
+                        type=int,
+                        default=None,
+                        help="Threads per worker for the sitk backend. Default: the CPU threads split evenly among the workers"
+                        )
+
+    parser.add_argument("--retries",
+                        type=int,
+                        default=DEFAULT_RETRIES,
+                        help="Number of times a failed file is retried before the patient is logged as failed"
+                        )
+
+    parser.add_argument("--overwrite",
+                        action='store_true',
+                        help="Redo all outputs, even if they exist with matching parameters"
+                        )
+
 
     args = parser.parse_args()
     return args
 
 
+def get_patient_files(source_dir):
+    """
+    Group the source NIfTI files (CT, PET, GTV) by patient ID.
+    """
+    files_list = sorted(glob.glob(source_dir + '/**/*.nii.gz', recursive=True))
+    patient_files = {}
+    for f in files_list:
+        patient_name = f.split('/')[-1].split('_')[0]
+        patient_files.setdefault(patient_name, []).append(f)
+    return patient_files
+
+
+def get_spacing_levels(new_spacing):
+    """
+    Split the --new_spacing values into (W,H,D) spacings, one per resolution level.
+    """
+    if len(new_spacing) % 3 != 0:
+        raise ValueError(f"--new_spacing takes 3 values per spacing, got {len(new_spacing)} values")
+    return [list(new_spacing[i:i+3]) for i in range(0, len(new_spacing), 3)]
+
+
+def get_level_name(spacing):
+    return "rs" + "x".join(f"{s:g}" for s in spacing)
+
+
+def get_manifest_entry(input_file, bb, new_spacing, args):
+    file_stat = os.stat(input_file)
+    entry = {'source': os.path.abspath(input_file),
+             'source_mtime_ns': file_stat.st_mtime_ns,
+             'source_size': file_stat.st_size,
+             'bbox': [float(c) for c in bb],
+             'new_spacing': [float(s) for s in new_spacing],
+             'order': args.order}
+    # Recorded only for non-default backends, so that the entries written before the backend choice stay valid
+    if args.backend != DEFAULT_BACKEND:
+        entry['backend'] = args.backend
+    return entry
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as mf:
+        return json.load(mf)
+
+
+def write_manifest(manifest, manifest_path):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as mf:
+        json.dump(manifest, mf, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def init_worker(num_threads):
+    # Split the CPU threads among the worker processes, each running multithreaded sitk filters
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def process_patient(task):
+    """
+    Crop and resample all the pending files of a patient, sharing the patient's bbox. Each file is read once and
+    written to all its pending levels. Errors are caught and returned, so that a failing patient never takes down the pool.
+    """
+    patient_name, file_tasks, bb, order, backend, retries = task
+    results = []
+    for input_file, output_files, new_spacings in file_tasks:
+        for attempt in range(retries + 1):
+            start_time = time.time()
+            try:
+                resample_and_crop_levels(input_file, output_files, bb, new_spacings, order=order, backend=backend)
+                status, error = 'done', None
+                break
+            except Exception:
+                status, error = 'failed', traceback.format_exc()
+        seconds = time.time() - start_time
+        for output_file, new_spacing in zip(output_files, new_spacings):
+            results.append({'input_file': input_file, 'output_file': output_file, 'new_spacing': new_spacing,
+                            'status': status, 'seconds': seconds, 'attempts': attempt + 1,
+                            'error': error})
+    return patient_name, results
+
+
 def main(args):
 
     if not os.path.exists(args.target_dir):
         os.mkdir(args.target_dir)
-    print("Resampling to spacing:", args.new_spacing)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s",
+                        handlers=[logging.FileHandler(os.path.join(args.target_dir, LOG_FILENAME)), logging.StreamHandler()])
+    logger = logging.getLogger(__name__)
+
+    new_spacings = get_spacing_levels(args.new_spacing)
+    print("Resampling to spacing(s):", new_spacings)
     bb_df = pd.read_csv(args.bbox_filepath)
     bb_df = bb_df.set_index('PatientID')
-    files_list = [
-        f for f in glob.glob(args.source_dir + '/**/*.nii.gz', recursive=True)
-    ]
-    resampler = Resampler(bb_df, args.target_dir, args.order, resampling=args.new_spacing)
-    with Pool(args.cores) as p:
-        p.map(resampler, files_list)
+    resampler = Resampler(bb_df, args.target_dir, args.order, resampling=new_spacings[0], backend=args.backend)
+
+    # A single spacing is written directly into the target dir, multiple ones into a sub-directory per level
+    if len(new_spacings) == 1:
+        level_dirs = [args.target_dir]
+    else:
+        level_dirs = [os.path.join(args.target_dir, get_level_name(new_spacing)) for new_spacing in new_spacings]
+        for level_dir in level_dirs:
+            os.makedirs(level_dir, exist_ok=True)
+
+    manifest_path = os.path.join(args.target_dir, MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_path)
+
+    # One task per patient, containing only the outputs that are missing or were made with other parameters.
+    # Manifest keys are the output paths relative to the target dir
+    tasks = []
+    num_skipped = 0
+    missing_bbox_patients = []
+    for patient_name, files in get_patient_files(args.source_dir).items():
+        if patient_name not in bb_df.index:
+            logger.warning(f"No bbox found for {patient_name}. Skipping")
+            missing_bbox_patients.append(patient_name)
+            continue
+        bb = resampler.get_bounding_box(patient_name)
+        file_tasks = []
+        for input_file in files:
+            output_files, file_new_spacings = [], []
+            for level_dir, new_spacing in zip(level_dirs, new_spacings):
+                output_file = os.path.join(level_dir, input_file.split('/')[-1])
+                entry = get_manifest_entry(input_file, bb, new_spacing, args)
+                output_key = os.path.relpath(output_file, args.target_dir)
+                if not args.overwrite and os.path.exists(output_file) and manifest.get(output_key) == entry:
+                    num_skipped += 1
+                    continue
+                output_files.append(output_file)
+                file_new_spacings.append(new_spacing)
+            if len(output_files) > 0:
+                file_tasks.append((input_file, output_files, file_new_spacings))
+        if len(file_tasks) > 0:
+            tasks.append((patient_name, file_tasks, bb, args.order, args.backend, args.retries))
+
+    logger.info(f"Patients to process: {len(tasks)}. Up-to-date files skipped: {num_skipped}. "
+                f"Patients without a bbox skipped: {len(missing_bbox_patients)}")
+
+    failed_patients = []
+    num_threads = args.num_threads if args.num_threads is not None else max(1, os.cpu_count() // args.cores)
+    with Pool(args.cores, initializer=init_worker, initargs=(num_threads,)) as p:
+        for patient_name, results in tqdm(p.imap_unordered(process_patient, tasks, chunksize=1), total=len(tasks)):
+            bb = resampler.get_bounding_box(patient_name)
+            for result in results:
+                output_name = os.path.relpath(result['output_file'], args.target_dir)
+                if result['status'] == 'done':
+                    manifest[output_name] = get_manifest_entry(result['input_file'], bb, result['new_spacing'], args)
+                    logger.info(f"{output_name} -- {result['seconds']:.1f} s")
+                else:
+                    manifest.pop(output_name, None)
+                    logger.error(f"{output_name} failed after {result['attempts']} attempt(s):\n{result['error']}")
+            if any(result['status'] == 'failed' for result in results):
+                failed_patients.append(patient_name)
+
+            # Record progress after every patient, so that an interrupted run can be resumed
+            write_manifest(manifest, manifest_path)
+
+    if len(failed_patients) > 0:
+        logger.error(f"Failed patients: {sorted(failed_patients)}")
 
 
 
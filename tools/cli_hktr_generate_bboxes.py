@@ -5,19 +5,27 @@ brain segmentation in PET using SUV thresholding.
 
 Modified to contain full head (FH).
 
+Patients are processed in parallel. The brain is first detected on a block-averaged PET (--downsampling_factor), and
+then segmented again at full resolution within a crop around that detection. Whenever the downsampled detection could
+pick a different blob than the full-resolution search -- e.g. two blobs of similar size compete -- the full-resolution
+search is used instead. If a reference bbox file is given, the generated bboxes are compared against it.
+
 Adapted from github.com/voreille/hecktor
 
 """
 
-import os, argparse
+import os, sys, argparse
+from multiprocessing import Pool
 
 from tqdm import tqdm
 
 import numpy as np
 import pandas as pd
 import SimpleITK as sitk
-from scipy.ndimage import gaussian_filter
-from scipy.ndimage.measurements import label
+from scipy.ndimage import gaussian_filter, label, find_objects
+
+sys.path.append("../")
+from datautils.preprocessing import recursive_gaussian_filter
 
 
 # Constants
@@ -27,6 +35,13 @@ DEFAULT_BB_FILEPATH = "../hecktor_meta/default_small_crop/crS_train-bboxes.csv"
 DEFAULT_FULL_HEAD_NECK = 0   # 0-True, 1-False
 DEFAULT_FULL_HN_SIZE = (450.0, 450.0, 300.0) # Physical size in mm -- (W,H,D) format
 DEFAULT_SMALL_SIZE = (144.0, 144.0, 144.0) # Physical size in mm -- (W,H,D) format
+DEFAULT_SMOOTHING_BACKEND = 'scipy'
+DEFAULT_DOWNSAMPLING_FACTOR = 2
+DEFAULT_CORES = 1
+
+SMOOTHING_SIGMA = 3  # In full-resolution PET voxels
+MAX_RUNNER_UP_RATIO = 0.5  # Downsampled search is used only if the 2nd biggest blob is at most this fraction of the biggest
+BBOX_COLUMNS = ['x1', 'x2', 'y1', 'y2', 'z1', 'z2']
 
 
 def get_args():
@@ -45,12 +60,36 @@ def get_args():
                         )
 
     parser.add_argument("--full_head_neck",
-                        type=str,
+                        type=int,
                         default=DEFAULT_FULL_HEAD_NECK,
                         required=True,
                         help="1-Yes, 0-No"
                         )
 
+    parser.add_argument("--smoothing_backend",
+                        type=str,
+                        default=DEFAULT_SMOOTHING_BACKEND,
+                        help="Backend for smoothing the whole-body PET -- 'scipy' or 'sitk-recursive' (multithreaded, cost independent of sigma)"
+                        )
+
+    parser.add_argument("--downsampling_factor",
+                        type=int,
+                        default=DEFAULT_DOWNSAMPLING_FACTOR,
+                        help="Block size for the downsampled brain detection. 1 processes the full-resolution PET directly"
+                        )
+
+    parser.add_argument("--cores",
+                        type=int,
+                        default=DEFAULT_CORES,
+                        help="Number of patients processed in parallel. The CPU threads are split evenly among them"
+                        )
+
+    parser.add_argument("--reference_bbox_filepath",
+                        type=str,
+                        default=None,
+                        help="Optional CSV file with reference bboxes (e.g. crS_train-bboxes.csv) to validate the output against"
+                        )
+
     args = parser.parse_args()
     return args
 
@@ -60,7 +99,9 @@ def bbox_auto(np_pt,
               px_spacing_pt,
               px_origin_pt,
               full_head_neck=False,
-              th=3):
+              th=3,
+              smoothing_backend='scipy',
+              downsampling_factor=1):
     """Find a bounding box automatically based on the SUV
     Arguments:
         vol_pt {numpy array} -- The PET volume on which to compute the bounding box
@@ -69,6 +110,8 @@ def bbox_auto(np_pt,
     Keyword Arguments:
         shape {tuple} -- The ouput size of the bounding box in millimeters
         th {float} -- [description] (default: {3})
+        smoothing_backend {str} -- 'scipy' or 'sitk-recursive' (default: {'scipy'})
+        downsampling_factor {int} -- Block size for detecting the brain on a downsampled PET first (default: {1})
     Returns:
         [type] -- [description]
     """
@@ -80,37 +123,22 @@ def bbox_auto(np_pt,
     np_pt = np_pt.transpose((2,1,0)) # Custom hack
 
     output_shape_pt = tuple(e1 / e2 for e1, e2 in zip(output_shape, px_spacing_pt))
-    # Gaussian smooth
-    np_pt_gauss = gaussian_filter(np_pt, sigma=3)
-    # auto_th: based on max SUV value in the top of the PET scan
-    #auto_th = np.max(np_pt[:, :, np.int(np_pt.shape[2] * 2 // 3):]) / 4
-    #print('auto_th = ', auto_th)
-    # OR fixed threshold
-    np_pt_thgauss = np.where(np_pt_gauss > th, 1, 0)
-    # Find brain as biggest blob AND not in lowest third of the scan
-    labeled_array, _ = label(np_pt_thgauss)
-    try:
-        np_pt_brain = labeled_array == np.argmax(
-            np.bincount(labeled_array[:,:,np_pt.shape[2] * 2 // 3:].flat)[1:]) + 1
-    except:
-        tqdm.write('th too high?')
-        # Quick fix just to pass for all cases
-        th = 0.1
-        np_pt_thgauss = np.where(np_pt_gauss > th, 1, 0)
-        labeled_array, _ = label(np_pt_thgauss)
-        np_pt_brain = labeled_array == np.argmax(
-            np.bincount(labeled_array[:,:,np_pt.shape[2] * 2 // 3:].flat)[1:]) + 1
+
+    # Brain segmentation's extent, as slices along (x,y,z)
+    brain_slices = None
+    if downsampling_factor > 1:
+        brain_slices = find_brain_downsampled(np_pt, th, smoothing_backend, downsampling_factor)
+    if brain_slices is None:
+        brain_slices = find_brain(np_pt, th, smoothing_backend)
 
     # Find lowest voxel of the brain and box containing the brain
     if full_head_neck:
-        z = np.max(np.argwhere(np.sum(np_pt_brain, axis=(0, 1))))  # Altered to find the *highest* voxel of the brain instead
+        z = brain_slices[2].stop - 1  # Altered to find the *highest* voxel of the brain instead
     else:
-        z = np.min(np.argwhere(np.sum(np_pt_brain, axis=(0, 1))))  # Default - take the lowest voxel of the brain segmentation
+        z = brain_slices[2].start  # Default - take the lowest voxel of the brain segmentation
 
-    y1 = np.min(np.argwhere(np.sum(np_pt_brain, axis=(0, 2))))
-    y2 = np.max(np.argwhere(np.sum(np_pt_brain, axis=(0, 2))))
-    x1 = np.min(np.argwhere(np.sum(np_pt_brain, axis=(1, 2))))
-    x2 = np.max(np.argwhere(np.sum(np_pt_brain, axis=(1, 2))))
+    y1, y2 = brain_slices[1].start, brain_slices[1].stop - 1
+    x1, x2 = brain_slices[0].start, brain_slices[0].stop - 1
 
     # Center bb based on this brain segmentation
     zshift = 30 // px_spacing_pt[2]
@@ -122,18 +150,18 @@ def bbox_auto(np_pt,
         zbb = (z - (output_shape_pt[2] - zshift), z + zshift)
 
     yshift = 30 // px_spacing_pt[1]
-    if np.int((y2 + y1) / 2 - yshift - np.int(output_shape_pt[1] / 2)) < 0:
+    if int((y2 + y1) / 2 - yshift - int(output_shape_pt[1] / 2)) < 0:
         ybb = (0, output_shape_pt[1])
-    elif np.int((y2 + y1) / 2 - yshift -
-                np.int(output_shape_pt[1] / 2)) > np_pt.shape[1]:
+    elif int((y2 + y1) / 2 - yshift -
+             int(output_shape_pt[1] / 2)) > np_pt.shape[1]:
         ybb = np_pt.shape[1] - output_shape_pt[1], np_pt.shape[1]
     else:
         ybb = ((y2 + y1) / 2 - yshift - output_shape_pt[1] / 2,
                (y2 + y1) / 2 - yshift + output_shape_pt[1] / 2)
 
-    if np.int((x2 + x1) / 2 - np.int(output_shape_pt[0] / 2)) < 0:
+    if int((x2 + x1) / 2 - int(output_shape_pt[0] / 2)) < 0:
         xbb = (0, output_shape_pt[0])
-    elif np.int((x2 + x1) / 2 - np.int(output_shape_pt[0] / 2)) > np_pt.shape[0]:
+    elif int((x2 + x1) / 2 - int(output_shape_pt[0] / 2)) > np_pt.shape[0]:
         xbb = np_pt.shape[0] - output_shape_pt[0], np_pt.shape[0]
     else:
         xbb = ((x2 + x1) / 2 - output_shape_pt[0] / 2,
@@ -152,35 +180,154 @@ def bbox_auto(np_pt,
     return bb
 
 
+def find_brain(np_pt, th, smoothing_backend, sigma=SMOOTHING_SIGMA):
+    """
+    Segment the brain in the (x,y,z) PET volume as the biggest blob of the thresholded and smoothed PET, counting only
+    the voxels in the top third of the scan. Returns the slices of the brain segmentation's extent.
+    """
+    # Gaussian smooth
+    np_pt_gauss = _smooth(np_pt, sigma, smoothing_backend)
+    # auto_th: based on max SUV value in the top of the PET scan
+    #auto_th = np.max(np_pt[:, :, np.int(np_pt.shape[2] * 2 // 3):]) / 4
+    #print('auto_th = ', auto_th)
+    # OR fixed threshold
+    brain_slices = _find_biggest_blob(np_pt_gauss > th, np_pt.shape[2] * 2 // 3)
+    if brain_slices is None:
+        tqdm.write('th too high?')
+        # Quick fix just to pass for all cases
+        th = 0.1
+        brain_slices = _find_biggest_blob(np_pt_gauss > th, np_pt.shape[2] * 2 // 3)
+    return brain_slices
+
+
+def find_brain_downsampled(np_pt, th, smoothing_backend, downsampling_factor, sigma=SMOOTHING_SIGMA):
+    """
+    find_brain(), but the full-resolution PET is only smoothed and labelled around the brain.
+
+    The brain is first detected on the PET averaged over blocks of downsampling_factor^3 voxels. The full-resolution
+    segmentation is then done on a crop around it -- padded by the Gaussian kernel's radius for the smoothing, so that
+    the crop's smoothed values equal the full volume's. Returns None, for the caller to fall back on find_brain(), where
+    the result could differ from it: if either step finds no clear winner (no blob, or a runner-up bigger than
+    MAX_RUNNER_UP_RATIO of the biggest), if the brain reaches the crop's border, or with the 'sitk-recursive' backend,
+    whose smoothing of a crop isn't that of the full volume.
+    """
+    if smoothing_backend == 'sitk-recursive':
+        return None
+
+    f = downsampling_factor
+    top_third_start = np_pt.shape[2] * 2 // 3
+
+    # Detection on the block-averaged PET
+    coarse_shape = [s // f for s in np_pt.shape]
+    if min(coarse_shape) < 2:
+        return None
+    np_pt_coarse = np_pt[:coarse_shape[0] * f, :coarse_shape[1] * f, :coarse_shape[2] * f]
+    np_pt_coarse = np_pt_coarse.reshape(coarse_shape[0], f, coarse_shape[1], f, coarse_shape[2], f).mean(axis=(1, 3, 5))
+    coarse_slices = _find_biggest_blob(_smooth(np_pt_coarse, sigma / f, smoothing_backend) > th, top_third_start // f,
+                                       max_runner_up_ratio=MAX_RUNNER_UP_RATIO)
+    if coarse_slices is None:
+        return None
+
+    # Crop around the detection, with a margin of 2 blocks for the blob's boundary shifting with the resolution
+    inner_region = [(max(0, (sl.start - 2) * f), min(np_pt.shape[axis], (sl.stop + 2) * f))
+                    for axis, sl in enumerate(coarse_slices)]
+    smoothing_margin = int(4 * sigma + 0.5)  # gaussian_filter's kernel radius
+    outer_region = [(max(0, start - smoothing_margin), min(np_pt.shape[axis], stop + smoothing_margin))
+                    for axis, (start, stop) in enumerate(inner_region)]
+
+    np_pt_gauss = _smooth(np_pt[tuple(slice(start, stop) for start, stop in outer_region)], sigma, smoothing_backend)
+    np_pt_gauss = np_pt_gauss[tuple(slice(inner_start - outer_start, inner_stop - outer_start)
+                                    for (inner_start, inner_stop), (outer_start, _) in zip(inner_region, outer_region))]
+    brain_slices = _find_biggest_blob(np_pt_gauss > th, max(0, top_third_start - inner_region[2][0]),
+                                      max_runner_up_ratio=MAX_RUNNER_UP_RATIO)
+    if brain_slices is None:
+        return None
+
+    # A brain touching the crop's border may continue outside it
+    for axis, sl in enumerate(brain_slices):
+        start, stop = inner_region[axis]
+        if (sl.start == 0 and start > 0) or (sl.stop == stop - start and stop < np_pt.shape[axis]):
+            return None
+
+    return tuple(slice(sl.start + start, sl.stop + start) for sl, (start, _) in zip(brain_slices, inner_region))
+
+
+def _smooth(np_pt, sigma, smoothing_backend):
+    if smoothing_backend == 'sitk-recursive':
+        return recursive_gaussian_filter(np_pt, sigma=(sigma, sigma, sigma))
+    return gaussian_filter(np_pt, sigma=sigma)
+
+
+def _find_biggest_blob(np_mask, top_third_start, max_runner_up_ratio=None):
+    """
+    Slices of the extent of the blob with the most voxels at z >= top_third_start, or None if there is no such blob.
+    With max_runner_up_ratio, also None if the 2nd biggest blob has more than that fraction of the biggest's voxels.
+    """
+    labeled_array, _ = label(np_mask)
+    counts = np.bincount(labeled_array[:, :, top_third_start:].flat)[1:]
+    if counts.size == 0:
+        return None
+    brain_label = np.argmax(counts) + 1
+    if max_runner_up_ratio is not None and counts.size > 1:
+        if np.partition(counts, -2)[-2] > max_runner_up_ratio * counts[brain_label - 1]:
+            return None
+    return find_objects(labeled_array, max_label=brain_label)[brain_label - 1]
+
+
+def init_worker(num_threads):
+    # Split the CPU threads among the worker processes, each possibly running multithreaded sitk filters
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def process_patient(task):
+    p_id, source_dir, full_head_neck, smoothing_backend, downsampling_factor = task
+    pet_sitk = sitk.ReadImage(f"{source_dir}/{p_id}/{p_id}_pt.nii.gz")
+    pet_np = sitk.GetArrayFromImage(pet_sitk)
+    spacing = pet_sitk.GetSpacing()
+    origin = pet_sitk.GetOrigin()
+    bb = bbox_auto(pet_np, spacing, origin, full_head_neck,
+                   smoothing_backend=smoothing_backend,
+                   downsampling_factor=downsampling_factor)
+    return {'PatientID': p_id, **dict(zip(BBOX_COLUMNS, bb))}
+
+
+def compare_bboxes(bb_df, reference_bb_df, tolerance=1e-3):
+    """
+    Per-patient maximum absolute difference in mm between the bbox coordinates, for the patients in both dataframes.
+    Prints a summary and returns the differences as a Series.
+    """
+    common_ids = bb_df.index.intersection(reference_bb_df.index)
+    abs_diffs = (bb_df.loc[common_ids, BBOX_COLUMNS] - reference_bb_df.loc[common_ids, BBOX_COLUMNS]).abs().max(axis=1)
+
+    print(f"Compared to the reference: {len(common_ids)} patients in common, "
+          f"{int((abs_diffs <= tolerance).sum())} matching within {tolerance} mm, "
+          f"max difference {abs_diffs.max() if len(common_ids) > 0 else 0.0:.3f} mm")
+    for p_id, abs_diff in abs_diffs[abs_diffs > tolerance].items():
+        print(f"  {p_id}: {abs_diff:.3f} mm")
+    return abs_diffs
+
+
 
 def main(args):
     source_dir = args.source_dir
     patient_ids = sorted(os.listdir(source_dir))
     full_head_neck = args.full_head_neck == 1
 
-    bb_df = pd.DataFrame(
-        columns=['PatientID', 'x1', 'x2', 'y1', 'y2', 'z1', 'z2'])
-
-    for p_id in tqdm(patient_ids):
-        pet_sitk = sitk.ReadImage(f"{source_dir}/{p_id}/{p_id}_pt.nii.gz")
-        pet_np = sitk.GetArrayFromImage(pet_sitk)
-        spacing = pet_sitk.GetSpacing()
-        origin = pet_sitk.GetOrigin()
-        bb = bbox_auto(pet_np, spacing, origin, full_head_neck)
-        bb_df = bb_df.append(
-            {
-                'PatientID': p_id,
-                'x1': bb[0],
-                'x2': bb[1],
-                'y1': bb[2],
-                'y2': bb[3],
-                'z1': bb[4],
-                'z2': bb[5],
-            },
-            ignore_index=True)
+    tasks = [(p_id, source_dir, full_head_neck, args.smoothing_backend, args.downsampling_factor)
+             for p_id in patient_ids]
+
+    num_threads = max(1, os.cpu_count() // args.cores)
+    with Pool(args.cores, initializer=init_worker, initargs=(num_threads,)) as pool:
+        rows = list(tqdm(pool.imap(process_patient, tasks), total=len(tasks)))
+
+    bb_df = pd.DataFrame(rows, columns=['PatientID'] + BBOX_COLUMNS)
     bb_df.to_csv(args.bbox_filepath)
 
+    if args.reference_bbox_filepath is not None:
+        reference_bb_df = pd.read_csv(args.reference_bbox_filepath).set_index('PatientID')
+        compare_bboxes(bb_df.set_index('PatientID'), reference_bb_df)
+
 
 if __name__ == '__main__':
     args = get_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,151 @@
+"""
+
+Pack each patient's PET, CT and GTV NIfTI files into a single chunked HDF5 file, to be read by the datasets with
+data_format='hdf5'.
+
+PET and CT are stored as float32 (or float16), the GTV mask as uint8. The voxel spacing, origin and, if a bbox file
+is given, the patient's bounding box are stored as file attributes. Volumes are chunked, so a sub-region can be read
+without decompressing the whole volume.
+
+"""
+
+import os, sys, argparse
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+import SimpleITK as sitk
+
+sys.path.append("../")
+from datautils.conversion import sitk2np
+from datautils.io import write_packed_subject
+
+
+# Constants
+DEFAULT_SOURCE_DIR = "../../../Datasets/HECKTOR/hecktor_train/crFHN_rs113_hecktor_nii"
+DEFAULT_PATIENT_ID_FILE = "../hecktor_meta/patient_IDs_train.txt"
+DEFAULT_TARGET_DIR = "../../../Datasets/HECKTOR/hecktor_train/crFHN_rs113_hecktor_h5"
+DEFAULT_IMAGE_DTYPE = 'float32'
+DEFAULT_CHUNK_SIZE = 32
+DEFAULT_COMPRESSION = 'gzip'
+DEFAULT_CORES = 4
+
+FILE_SUFFIXES = {'PET': '_pt', 'CT': '_ct', 'GTV': '_ct_gtvt'}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--source_dir",
+                        type=str,
+                        default=DEFAULT_SOURCE_DIR,
+                        help="Directory containing the patients' NIfTI files"
+                        )
+
+    parser.add_argument("--patient_id_file",
+                        type=str,
+                        default=DEFAULT_PATIENT_ID_FILE,
+                        help="Patient ID file"
+                        )
+
+    parser.add_argument("--target_dir",
+                        type=str,
+                        default=DEFAULT_TARGET_DIR,
+                        help="Directory to write the packed .h5 files in"
+                        )
+
+    parser.add_argument("--bbox_filepath",
+                        type=str,
+                        default=None,
+                        help="Optional CSV file with the bbox coordinates, to be stored in the file attributes"
+                        )
+
+    parser.add_argument("--image_dtype",
+                        type=str,
+                        default=DEFAULT_IMAGE_DTYPE,
+                        help="Dtype to store PET and CT in -- 'float32' or 'float16'"
+                        )
+
+    parser.add_argument("--chunk_size",
+                        type=int,
+                        default=DEFAULT_CHUNK_SIZE,
+                        help="Edge length of the cubic HDF5 chunks"
+                        )
+
+    parser.add_argument("--compression",
+                        type=str,
+                        default=DEFAULT_COMPRESSION,
+                        help="HDF5 compression filter -- 'gzip', 'lzf' or 'none'"
+                        )
+
+    parser.add_argument("--cores",
+                        type=int,
+                        default=DEFAULT_CORES,
+                        help="Number of workers for parallelization"
+                        )
+
+    args = parser.parse_args()
+    return args
+
+
+def pack_patient(task):
+    p_id, args, bbox = task
+
+    volumes_dict = {}
+    size, spacing, origin = None, None, None
+    for name, file_suffix in FILE_SUFFIXES.items():
+        file_path = f"{args.source_dir}/{p_id}{file_suffix}.nii.gz"
+        if not os.path.exists(file_path):
+            continue
+        image_sitk = sitk.ReadImage(file_path)
+        volumes_dict[name] = sitk2np(image_sitk, keep_whd_ordering=True)
+
+        # All volumes of a patient share the same grid after crop-and-resample. Take the metadata from the first one
+        if size is None:
+            size, spacing, origin = image_sitk.GetSize(), image_sitk.GetSpacing(), image_sitk.GetOrigin()
+        elif image_sitk.GetSize() != size or not np.allclose(image_sitk.GetSpacing(), spacing) or not np.allclose(image_sitk.GetOrigin(), origin):
+            raise ValueError(f"{p_id}{file_suffix} is not on the same grid as the patient's other volumes")
+
+    if not volumes_dict:
+        raise FileNotFoundError(f"No NIfTI files found for {p_id} in {args.source_dir}")
+
+    compression = None if args.compression == 'none' else args.compression
+    write_packed_subject(f"{args.target_dir}/{p_id}.h5",
+                         volumes_dict,
+                         spacing,
+                         origin,
+                         bbox=bbox,
+                         image_dtype=np.dtype(args.image_dtype),
+                         chunk_size=args.chunk_size,
+                         compression=compression)
+    return p_id
+
+
+def main(args):
+
+    os.makedirs(args.target_dir, exist_ok=True)
+
+    with open(args.patient_id_file, 'r') as pf:
+        patient_ids = [p_id for p_id in pf.read().split('\n') if p_id != '']
+
+    bb_df = None
+    if args.bbox_filepath is not None:
+        bb_df = pd.read_csv(args.bbox_filepath).set_index('PatientID')
+
+    tasks = []
+    for p_id in patient_ids:
+        bbox = None
+        if bb_df is not None and p_id in bb_df.index:
+            bbox = bb_df.loc[p_id, ['x1', 'x2', 'y1', 'y2', 'z1', 'z2']].to_numpy(dtype=np.float64)
+        tasks.append((p_id, args, bbox))
+
+    with Pool(args.cores) as p:
+        for _ in tqdm(p.imap_unordered(pack_patient, tasks), total=len(tasks)):
+            pass
+
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
@@ -0,0 +1,127 @@
+"""
+
+Precompute the sampling probability maps of the 'gtv-petfg-weighted-random' patch sampling method for all patients,
+and write them in compressed form -- the candidate focal points and their cumulative weights -- one file per patient.
+PatchSampler3D loads these when given the output directory as sampling_maps_dir.
+
+The maps are computed from the unaugmented, preprocessed volumes. They must be regenerated if the preprocessing,
+patch size, volume size or padding change.
+
+"""
+
+import os, sys, argparse
+
+import numpy as np
+from tqdm import tqdm
+
+sys.path.append("../")
+from datasets.hecktor_petct_dataset import HECKTORPETCTDataset
+from datautils.preprocessing import Preprocessor
+from datautils.patch_sampling import get_gtv_petfg_sampling_prob_map, get_sampling_map_index, get_valid_indx_range
+
+
+# Constants
+DEFAULT_DATA_DIR = "../../../Datasets/HECKTOR/hecktor_train/crFHN_rs113_hecktor_nii"
+DEFAULT_PATIENT_ID_FILE = "../hecktor_meta/patient_IDs_train.txt"
+DEFAULT_OUTPUT_DIR = "../../../Datasets/HECKTOR/hecktor_train/crFHN_rs113_sampling_maps"
+DEFAULT_PATCH_SIZE = [128, 128, 32]  # (W,H,D) format
+DEFAULT_VOLUME_SIZE = [450, 450, 100]  # (W,H,D) format
+DEFAULT_PADDING = [0, 0, 0]  # (W,H,D) format
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_dir",
+                        type=str,
+                        default=DEFAULT_DATA_DIR,
+                        help="Directory containing the patients' NIfTI files"
+                        )
+
+    parser.add_argument("--patient_id_file",
+                        type=str,
+                        default=DEFAULT_PATIENT_ID_FILE,
+                        help="Patient ID file"
+                        )
+
+    parser.add_argument("--output_dir",
+                        type=str,
+                        default=DEFAULT_OUTPUT_DIR,
+                        help="Directory to write the sampling maps in"
+                        )
+
+    parser.add_argument("--patch_size",
+                        type=int,
+                        nargs=3,
+                        default=DEFAULT_PATCH_SIZE,
+                        help="Patch size -- (W,H,D) format"
+                        )
+
+    parser.add_argument("--volume_size",
+                        type=int,
+                        nargs=3,
+                        default=DEFAULT_VOLUME_SIZE,
+                        help="Volume size -- (W,H,D) format"
+                        )
+
+    parser.add_argument("--padding",
+                        type=int,
+                        nargs=3,
+                        default=DEFAULT_PADDING,
+                        help="One-sided padding used by the patch sampler -- (W,H,D) format"
+                        )
+
+    parser.add_argument("--PET_landmarks_path",
+                        type=str,
+                        default=None,
+                        help="If given, PET is normalized using histogram mapping with these landmarks instead of clipping"
+                        )
+
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.PET_landmarks_path is not None:
+        preprocessor = Preprocessor(normalization_method={'PET': 'histogram-mapping', 'CT': 'clip-and-rescale'},
+                                    histogram_landmarks_path={'PET': args.PET_landmarks_path, 'CT': None})
+    else:
+        preprocessor = Preprocessor()
+
+    # All patients from the ID file, unaugmented
+    dataset = HECKTORPETCTDataset(args.data_dir,
+                                  args.patient_id_file,
+                                  mode='all',
+                                  preprocessor=preprocessor,
+                                  input_representation='separate-volumes',
+                                  augment_data=False)
+
+    # Convert to (D,H,W) ordering, as used internally by the patch sampler
+    patch_size = list(reversed(args.patch_size))
+    volume_size = [args.volume_size[i] + args.padding[i] for i in range(3)]
+    volume_size = list(reversed(volume_size))
+    valid_indx_range = get_valid_indx_range(patch_size, volume_size)
+
+    for idx in tqdm(range(len(dataset))):
+        subject_dict = dataset[idx]
+        p_id = subject_dict['patient-id']
+
+        PET_volume = subject_dict['PET'][0].numpy()
+        gtv_labelmap = subject_dict['target-labelmap'].numpy()
+        sampling_prob_map = get_gtv_petfg_sampling_prob_map(PET_volume, gtv_labelmap, patch_size)
+        focal_point_candidates, cumulative_weights = get_sampling_map_index(sampling_prob_map, valid_indx_range)
+
+        np.savez(f"{args.output_dir}/{p_id}_sampling_map.npz",
+                 focal_point_candidates=focal_point_candidates,
+                 cumulative_weights=cumulative_weights,
+                 patch_size=np.array(patch_size),
+                 volume_size=np.array(volume_size))
+
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
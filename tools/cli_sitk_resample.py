@@ -3,10 +3,13 @@
 Resamples all images from the given HECKTOR subset (train or test) to a given voxel spacing and 
 writes them in new directory.
 
+If a bbox file is given, each patient's images are cropped to their bounding box within the same
+resampling call -- only the bbox region is interpolated and written. Patients are processed in parallel.
+
 """
 
-import os
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
 import argparse
 from pathlib import Path
@@ -23,6 +26,7 @@ SITK_INTERPOLATOR_DICT = {'nearest': sitk.sitkNearestNeighbor,
 
 DEFAULT_IMG_VOXEL_VALUE = -1000
 DEFAULT_GTV_VOXEL_VALUE = 0
+DEFAULT_CORES = 1
 
 
 # ------------------------------------------------
@@ -49,11 +53,27 @@ def get_args():
                         help="New voxel spacing format - W H D"
                         )
 
+    parser.add_argument("--bbox_filepath",
+                        type=str,
+                        default=None,
+                        help="Optional CSV file with the bbox coordinates. If given, the outputs cover only the bbox"
+                        )
+
+    parser.add_argument("--cores",
+                        type=int,
+                        default=DEFAULT_CORES,
+                        help="Number of patients processed in parallel. The CPU threads are split evenly among them"
+                        )
+
     args = parser.parse_args()
     return args
 
 
-def resample_sitk_image(sitk_image, new_spacing, sitk_interpolator, default_fill_value):
+def resample_sitk_image(sitk_image, new_spacing, sitk_interpolator, default_fill_value, bbox=None):
+    """
+    Resample to the new spacing. If a bbox (x1,x2,y1,y2,z1,z2) in mm is given, the output grid starts at (x1,y1,z1)
+    and covers only the bbox -- same grid as hktr_resampling_utils.resample_and_crop() -- otherwise the full image.
+    """
     # Get original image's info
     orig_image_info = {'size': sitk_image.GetSize(), 
                        'spacing': sitk_image.GetSpacing(), 
@@ -66,8 +86,14 @@ def resample_sitk_image(sitk_image, new_spacing, sitk_interpolator, default_fill
     orig_size = np.array(orig_image_info['size'])
     orig_spacing = np.array(orig_image_info['spacing'])
 
-    new_size = orig_size * (orig_spacing / new_spacing)
-    new_size = np.ceil(new_size).astype(np.int)
+    if bbox is None:
+        new_origin = orig_image_info['origin']
+        new_size = orig_size * (orig_spacing / new_spacing)
+        new_size = np.ceil(new_size).astype(int)
+    else:
+        new_origin = (bbox[0], bbox[2], bbox[4])
+        new_size = np.ceil([bbox[1] - bbox[0], bbox[3] - bbox[2], bbox[5] - bbox[4]]) / np.array(new_spacing)
+        new_size = new_size.astype(int)
     new_size = [int(s) for s in new_size]
 
     # Apply resampling
@@ -75,7 +101,7 @@ def resample_sitk_image(sitk_image, new_spacing, sitk_interpolator, default_fill
                                          new_size,
                                          sitk.Transform(),
                                          sitk_interpolator,
-                                         orig_image_info['origin'],
+                                         [float(o) for o in new_origin],
                                          new_spacing,
                                          orig_image_info['direction'],
                                          default_fill_value,
@@ -84,6 +110,35 @@ def resample_sitk_image(sitk_image, new_spacing, sitk_interpolator, default_fill
     return sitk_image_resampled
 
 
+def init_worker(num_threads):
+    # Split the CPU threads among the worker processes, each running multithreaded sitk filters
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def process_patient(task):
+    p_id, source_dir, target_dir, new_spacing, bbox = task
+    source_patient_dir = source_dir / Path(p_id)
+    target_patient_dir = Path(f"{target_dir}/{p_id}")
+    target_patient_dir.mkdir(parents=True, exist_ok=True)
+
+    # CT, PET and GTV mask
+    for file_suffix, interpolator, fill_value in [('_ct', 'linear', DEFAULT_IMG_VOXEL_VALUE),
+                                                  ('_pt', 'linear', DEFAULT_IMG_VOXEL_VALUE),
+                                                  ('_ct_gtvt', 'nearest', DEFAULT_GTV_VOXEL_VALUE)]:
+        image_sitk = sitk.ReadImage(f"{source_patient_dir}/{p_id}{file_suffix}.nii.gz")
+        resampled_sitk = resample_sitk_image(image_sitk,
+                                             new_spacing,
+                                             sitk_interpolator=SITK_INTERPOLATOR_DICT[interpolator],
+                                             default_fill_value=fill_value,
+                                             bbox=bbox)
+
+        # Write into target directory
+        resampled_path = target_patient_dir / Path(f"{p_id}{file_suffix}.nrrd")
+        sitk.WriteImage(resampled_sitk, str(resampled_path), useCompression=True)
+
+    return p_id
+
+
 def main(args):
 
     new_spacing = [float(s) for s in args.new_spacing]
@@ -95,43 +150,25 @@ def main(args):
 
     print("Total patients found:", len(patient_ids))
 
-    for p_id in tqdm(patient_ids):
-        source_patient_dir = source_dir / Path(p_id)
-
-        # CT
-        ct_sitk = sitk.ReadImage(f"{source_patient_dir}/{p_id}_ct.nii.gz")
-        ct_resampled_sitk = resample_sitk_image(ct_sitk, 
-                                                new_spacing, 
-                                                sitk_interpolator=SITK_INTERPOLATOR_DICT['linear'], 
-                                                default_fill_value=DEFAULT_IMG_VOXEL_VALUE)
-        
-        # PET
-        pet_sitk = sitk.ReadImage(f"{source_patient_dir}/{p_id}_pt.nii.gz")
-        pet_resampled_sitk = resample_sitk_image(pet_sitk, 
-                                                 new_spacing, 
-                                                 sitk_interpolator=SITK_INTERPOLATOR_DICT['linear'], 
-                                                 default_fill_value=DEFAULT_IMG_VOXEL_VALUE)
-
-        # GTV mask
-        gtv_sitk = sitk.ReadImage(f"{source_patient_dir}/{p_id}_ct_gtvt.nii.gz")
-        gtv_resampled_sitk = resample_sitk_image(gtv_sitk, 
-                                                 new_spacing, 
-                                                 sitk_interpolator=SITK_INTERPOLATOR_DICT['nearest'], 
-                                                 default_fill_value=DEFAULT_GTV_VOXEL_VALUE)
+    bb_df = None
+    if args.bbox_filepath is not None:
+        bb_df = pd.read_csv(args.bbox_filepath).set_index('PatientID')
+
+    tasks = []
+    for p_id in patient_ids:
+        bbox = None
+        if bb_df is not None:
+            if p_id not in bb_df.index:
+                print(f"No bbox found for {p_id}. Skipping")
+                continue
+            bbox = tuple(bb_df.loc[p_id, ['x1', 'x2', 'y1', 'y2', 'z1', 'z2']].astype(float))
+        tasks.append((p_id, source_dir, target_dir, new_spacing, bbox))
+
+    num_threads = max(1, mp.cpu_count() // args.cores)
+    with mp.Pool(args.cores, initializer=init_worker, initargs=(num_threads,)) as pool:
+        for _ in tqdm(pool.imap_unordered(process_patient, tasks), total=len(tasks)):
+            pass
 
-        # Write into target directory
-        target_patient_dir = Path(f"{target_dir}/{p_id}")
-        target_patient_dir.mkdir(parents=True, exist_ok=True)
-
-        ct_resampled_path = target_patient_dir / Path(f"{p_id}_ct.nrrd")
-        sitk.WriteImage(ct_resampled_sitk, str(ct_resampled_path), useCompression=True)
-
-        pet_resampled_path = target_patient_dir / Path(f"{p_id}_pt.nrrd")
-        sitk.WriteImage(pet_resampled_sitk, str(pet_resampled_path), useCompression=True)
-        
-        gtv_resampled_path = target_patient_dir / Path(f"{p_id}_ct_gtvt.nrrd")
-        sitk.WriteImage(gtv_resampled_sitk, str(gtv_resampled_path), useCompression=True)
-        
 
 
 # ------------------------------------------------
@@ -1,4 +1,8 @@
+import os
 import argparse
+import hashlib
+from multiprocessing import Pool
+
 import numpy as np
 from tqdm import tqdm
 import SimpleITK as sitk
@@ -9,6 +13,8 @@ DEFAULT_PATIENT_ID_FILE = "../hecktor_meta/patient_IDs_train.txt"
 DEFAULT_OUTPUT_DIR = "../hecktor_meta/full_head_neck_crop"
 DEFAULT_MODALITY = "PET"
 DEFAULT_CROSSVAL_CENTRE = "CHUM"
+DEFAULT_CORES = 8
+ALL_CROSSVAL_CENTRES = ["CHGJ", "CHMR", "CHUM", "CHUS", "None"]
 
 # Histogram related constants
 DEFAULT_QUANTILES_CUTOFF_SUV = (0, 0.999)
@@ -18,7 +24,7 @@ STANDARD_INTENSITY_RANGE = (0, 1)
 
 
 class StandardHistogramTrainer():
-    def __init__(self, modality='PET', quantiles_cutoff=None, images_paths=None):
+    def __init__(self, modality='PET', quantiles_cutoff=None, images_paths=None, cores=1, cache_dir=None):
         self.standard_scale = STANDARD_INTENSITY_RANGE
 
         self.modality = modality
@@ -30,31 +36,65 @@ class StandardHistogramTrainer():
 
         self.images_paths = images_paths
 
-    def train(self):
+        self.cores = cores
+        self.cache_dir = cache_dir  # Per-image percentile vectors are cached here, if given
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def train(self, percentiles_database=None):
+        """
+        Args:
+            percentiles_database: Optional ndarray of shape (num_images, num_percentiles). Computed from images_paths if not given
+        """
+        if percentiles_database is None:
+            percentiles_database = self.compute_percentiles_database()
+
+        percentiles_database = np.vstack(percentiles_database)
+        mapping = self._get_average_mapping(percentiles_database)
+        return mapping
+
+    def compute_percentiles_database(self):
+        """
+        Percentile vectors of all images in images_paths, computed in parallel worker processes.
+        """
+        with Pool(self.cores) as p:
+            percentiles_database = list(tqdm(p.imap(self._get_image_percentile_values, self.images_paths), total=len(self.images_paths)))
+        return np.vstack(percentiles_database)
+
+    def _get_image_percentile_values(self, image_file_path):
         percentiles_cutoff = 100 * np.array(self.quantiles_cutoff)
-        percentiles_database = []
         percentiles = self._get_percentiles(percentiles_cutoff)
 
-        for image_file_path in tqdm(self.images_paths):
-            image_sitk = sitk.ReadImage(image_file_path)
-            image_np = sitk.GetArrayFromImage(image_sitk)
+        if self.cache_dir is not None:
+            cache_path = self._get_cache_path(image_file_path, percentiles)
+            if os.path.exists(cache_path):
+                return np.loadtxt(cache_path)
 
-            # If CT, then make the background HU same as air HU (i.e. -1000)
-            if self.modality == 'CT':
-                image_np = np.clip(image_np, -1000, image_np.max())
+        image_sitk = sitk.ReadImage(image_file_path)
+        image_np = sitk.GetArrayFromImage(image_sitk)
 
-            # If PET, then make invalid (negative) SUVs equal to 0
-            if self.modality == 'PET':
-                image_np = np.clip(image_np, 0, image_np.max())
+        # If CT, then make the background HU same as air HU (i.e. -1000)
+        if self.modality == 'CT':
+            image_np = np.clip(image_np, -1000, image_np.max())
 
+        # If PET, then make invalid (negative) SUVs equal to 0
+        if self.modality == 'PET':
+            image_np = np.clip(image_np, 0, image_np.max())
 
-            # Get percentile values and store them
-            percentile_values = np.percentile(image_np, percentiles)
-            percentiles_database.append(percentile_values)
+        # Get percentile values -- All of them in a single pass
+        percentile_values = np.percentile(image_np, percentiles)
 
-        percentiles_database = np.vstack(percentiles_database)
-        mapping = self._get_average_mapping(percentiles_database)
-        return mapping
+        if self.cache_dir is not None:
+            np.savetxt(cache_path, percentile_values)
+        return percentile_values
+
+    def _get_cache_path(self, image_file_path, percentiles):
+        # Keyed by the image file, its modification time and size, the modality and the percentiles
+        file_stat = os.stat(image_file_path)
+        key = (os.path.abspath(image_file_path), file_stat.st_mtime_ns, file_stat.st_size, self.modality, tuple(percentiles))
+        key_hash = hashlib.md5(repr(key).encode()).hexdigest()[:16]
+        file_name = os.path.basename(image_file_path).split('.')[0]
+        return f"{self.cache_dir}/{file_name}_{key_hash}-percentiles.txt"
 
     def _get_percentiles(self, percentiles_cutoff):
         quartiles = np.arange(25, 100, 25).tolist()
@@ -104,7 +144,17 @@ def get_args():
                         type=str,
                         required=True,
                         default=DEFAULT_CROSSVAL_CENTRE,
-                        help="CHGJ, CHMR, CHUM, CHUS, None"
+                        help="CHGJ, CHMR, CHUM, CHUS, None, or 'all' to get the landmarks of every split in one run"
+                        )
+    parser.add_argument("--cores",
+                        type=int,
+                        default=DEFAULT_CORES,
+                        help="Number of worker processes computing the per-image percentiles"
+                        )
+    parser.add_argument("--cache_dir",
+                        type=str,
+                        default=None,
+                        help="Directory to cache the per-image percentiles in, to reuse them across runs. Default: no caching"
                         )
 
     args = parser.parse_args()
@@ -119,20 +169,27 @@ def main(args):
     with open(args.patient_id_file, 'r') as pf:
         patient_ids = [p_id for p_id in pf.read().split("\n") if p_id != ""]
 
-    if args.crossval_centre != "None":
-        patient_ids = [p_id for p_id in patient_ids if args.crossval_centre not in p_id]
+    if args.crossval_centre == "all":
+        crossval_centres = ALL_CROSSVAL_CENTRES
+    else:
+        crossval_centres = [args.crossval_centre]
 
-    if args.modality == 'PET':
-        patient_PET_paths = [f"{args.data_dir}/{p_id}_pt.nii.gz" for p_id in patient_ids]
-        histogram_trainer = StandardHistogramTrainer(modality='PET', images_paths=patient_PET_paths)
-        PET_landmarks = histogram_trainer.train()
-        np.savetxt(f"{args.output_dir}/crossval_{args.crossval_centre}-histogram_landmarks_PET.txt", PET_landmarks)
+    # Percentiles are computed once for all the patients that any of the requested splits needs
+    required_patient_ids = [p_id for p_id in patient_ids if any(centre == "None" or centre not in p_id for centre in crossval_centres)]
 
+    if args.modality == 'PET':
+        images_paths = [f"{args.data_dir}/{p_id}_pt.nii.gz" for p_id in required_patient_ids]
     elif args.modality == 'CT':
-        patient_CT_paths = [f"{args.data_dir}/{p_id}_ct.nii.gz" for p_id in patient_ids]
-        histogram_trainer = StandardHistogramTrainer(modality='CT', images_paths=patient_CT_paths)
-        CT_landmarks = histogram_trainer.train()
-        np.savetxt(f"{args.output_dir}/crossval_{args.crossval_centre}-histogram_landmarks_CT.txt", CT_landmarks)
+        images_paths = [f"{args.data_dir}/{p_id}_ct.nii.gz" for p_id in required_patient_ids]
+
+    histogram_trainer = StandardHistogramTrainer(modality=args.modality, images_paths=images_paths, cores=args.cores, cache_dir=args.cache_dir)
+    percentiles_database = histogram_trainer.compute_percentiles_database()
+
+    # Derive the landmarks of each split from the shared percentiles table
+    for crossval_centre in crossval_centres:
+        split_rows = [i for i, p_id in enumerate(required_patient_ids) if crossval_centre == "None" or crossval_centre not in p_id]
+        landmarks = histogram_trainer.train(percentiles_database[split_rows])
+        np.savetxt(f"{args.output_dir}/crossval_{crossval_centre}-histogram_landmarks_{args.modality}.txt", landmarks)
 
 
 if __name__ == '__main__':
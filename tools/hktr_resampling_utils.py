@@ -2,23 +2,41 @@ import os
 
 import numpy as np
 from scipy.ndimage import affine_transform
-from scipy.interpolate import RegularGridInterpolator
 import SimpleITK as sitk
 
 
+# Input voxels kept on each side of the sampled region by resample_np_volume(), for spline orders above 1.
+# The spline prefilter's boundary effect decays by a factor of at most ~0.43 (order 5) per voxel
+SPLINE_PREFILTER_MARGIN = 20
+
+RESAMPLING_BACKENDS = ('scipy', 'sitk')
+
+# sitk interpolators matching the scipy spline orders
+SITK_INTERPOLATORS = {0: sitk.sitkNearestNeighbor,
+                      1: sitk.sitkLinear,
+                      2: sitk.sitkBSpline2,
+                      3: sitk.sitkBSpline3,
+                      4: sitk.sitkBSpline4,
+                      5: sitk.sitkBSpline5}
+
+
 class Resampler():
     def __init__(self,
                  bb_df,
                  output_folder,
                  order,
                  resampling=None,
-                 logger=None):
+                 logger=None,
+                 backend='scipy',
+                 num_threads=None):
         super().__init__()
         self.bb_df = bb_df
         self.output_folder = output_folder
         self.resampling = resampling
         self.order = order
         self.logger = logger
+        self.backend = backend
+        self.num_threads = num_threads
 
     def __call__(self, f, resampling=None):
         if resampling is None:
@@ -33,29 +51,134 @@ class Resampler():
         # if output_file.endswith(".nii.gz"):
         #     output_file = output_file.replace(".nii.gz", ".nrrd")
         
-        bb = (self.bb_df.loc[patient_name, 'x1'], self.bb_df.loc[patient_name,
-                                                                 'y1'],
-              self.bb_df.loc[patient_name, 'z1'], self.bb_df.loc[patient_name,
-                                                                 'x2'],
-              self.bb_df.loc[patient_name, 'y2'], self.bb_df.loc[patient_name,
-                                                                 'z2'])
+        bb = self.get_bounding_box(patient_name)
         print('Resampling patient {}'.format(patient_name))
 
         resample_and_crop(f,
                           output_file,
                           bb,
                           resampling=resampling,
-                          order=self.order)
+                          order=self.order,
+                          backend=self.backend,
+                          num_threads=self.num_threads)
+
+    def get_bounding_box(self, patient_name):
+        bb = (self.bb_df.loc[patient_name, 'x1'], self.bb_df.loc[patient_name,
+                                                                 'y1'],
+              self.bb_df.loc[patient_name, 'z1'], self.bb_df.loc[patient_name,
+                                                                 'x2'],
+              self.bb_df.loc[patient_name, 'y2'], self.bb_df.loc[patient_name,
+                                                                 'z2'])
+        return bb
 
 
 def resample_and_crop(input_file,
                       output_file,
                       bounding_box,
                       resampling=(1.0, 1.0, 1.0),
-                      order=3):
-    np_volume, pixel_spacing, origin = get_np_volume_from_sitk(
-        sitk.ReadImage(input_file))
-    resampling = np.asarray(resampling)
+                      order=3,
+                      backend='scipy',
+                      num_threads=None):
+    """
+    Crop to the bounding box (x1,y1,z1,x2,y2,z2) in mm and resample. GTV masks use nearest neighbour interpolation,
+    the images splines of the given order.
+
+    The 'scipy' backend is single-threaded. The 'sitk' backend uses sitk's resampling filter, which is multithreaded --
+    num_threads sets its thread count, or None for sitk's global default. The two backends resample on the same grid
+    but handle the points outside the source image differently: scipy mirrors the image, sitk fills in the image
+    minimum (0 for the masks).
+    """
+    resample_and_crop_levels(input_file,
+                             [output_file],
+                             bounding_box,
+                             [resampling],
+                             order=order,
+                             backend=backend,
+                             num_threads=num_threads)
+
+
+def resample_and_crop_levels(input_file,
+                             output_files,
+                             bounding_box,
+                             resamplings,
+                             order=3,
+                             backend='scipy',
+                             num_threads=None):
+    """
+    resample_and_crop() to several spacings, reading the input file once. Writes one output file per spacing.
+
+    The levels are computed from the finest to the coarsest. All levels' grids start at the bbox corner, so if a
+    level's spacing is an integer multiple of a finer level's along each axis, its grid points are a subset of the finer
+    grid's. That level is then taken by striding over the finer level -- the same values as resampling the input again.
+    """
+    if backend not in RESAMPLING_BACKENDS:
+        raise ValueError(f"Unknown resampling backend '{backend}'. Expected one of {RESAMPLING_BACKENDS}")
+
+    sitk_image = sitk.ReadImage(input_file)
+    resamplings = [_get_resampling(resampling, sitk_image.GetSpacing()) for resampling in resamplings]
+    is_binary = 'gtv' in input_file or 'GTV' in input_file
+    if backend == 'scipy':
+        np_volume, pixel_spacing, origin = get_np_volume_from_sitk(sitk_image)
+
+    done_levels = []  # (resampling, sitk_volume) pairs
+    for level_indx in np.argsort([np.prod(resampling) for resampling in resamplings], kind='stable'):
+        resampling = resamplings[level_indx]
+        output_shape = (np.ceil([
+            bounding_box[3] - bounding_box[0],
+            bounding_box[4] - bounding_box[1],
+            bounding_box[5] - bounding_box[2],
+        ]) / resampling).astype(int)
+
+        # Coarsest finer level to stride over, if any
+        sitk_volume = None
+        for finer_resampling, finer_sitk_volume in reversed(done_levels):
+            strides = get_grid_strides(finer_resampling, resampling)
+            if strides is not None:
+                sitk_volume = finer_sitk_volume[::strides[0], ::strides[1], ::strides[2]]
+                sitk_volume = sitk_volume[:output_shape[0], :output_shape[1], :output_shape[2]]
+                break
+
+        if sitk_volume is None and backend == 'sitk':
+            sitk_volume = resample_sitk_volume(sitk_image,
+                                               resampling,
+                                               bounding_box,
+                                               order=0 if is_binary else order,
+                                               num_threads=num_threads)
+        elif sitk_volume is None:
+            if is_binary:
+                resampled_volume = resample_np_binary_volume(np_volume, origin, pixel_spacing,
+                                                             resampling, bounding_box)
+            else:
+                resampled_volume = resample_np_volume(np_volume,
+                                                      origin,
+                                                      pixel_spacing,
+                                                      resampling,
+                                                      bounding_box,
+                                                      order=order)
+            resampled_origin = np.asarray([bounding_box[0], bounding_box[1], bounding_box[2]])
+            sitk_volume = get_sitk_volume_from_np(resampled_volume, resampling, resampled_origin)
+
+        # writer = sitk.ImageFileWriter()
+        # writer.SetFileName(output_file)
+        # writer.SetImageIO("NiftiImageIO")
+        # writer.Execute(sitk_volume)
+        sitk.WriteImage(sitk_volume, output_files[level_indx])
+        done_levels.append((resampling, sitk_volume))
+
+
+def get_grid_strides(fine_resampling, coarse_resampling, tolerance=1e-6):
+    """
+    Per-axis integer ratios of the coarse to the fine spacing, or None if any ratio isn't an integer.
+    """
+    ratios = np.asarray(coarse_resampling, dtype=float) / np.asarray(fine_resampling, dtype=float)
+    strides = np.round(ratios)
+    if np.any(strides < 1) or np.any(np.abs(ratios - strides) > tolerance):
+        return None
+    return [int(stride) for stride in strides]
+
+
+def _get_resampling(resampling, pixel_spacing):
+    resampling = np.asarray(resampling, dtype=float)
     # If one value of resampling is -1 replace it with the original value
     for i in range(len(resampling)):
         if resampling[i] == -1:
@@ -63,25 +186,7 @@ def resample_and_crop(input_file,
         elif resampling[i] < 0:
             raise ValueError(
                 'Resampling value cannot be negative, except for -1')
-
-    if 'gtv' in input_file or 'GTV' in input_file:
-        np_volume = resample_np_binary_volume(np_volume, origin, pixel_spacing,
-                                              resampling, bounding_box)
-    else:
-        np_volume = resample_np_volume(np_volume,
-                                       origin,
-                                       pixel_spacing,
-                                       resampling,
-                                       bounding_box,
-                                       order=order)
-
-    origin = np.asarray([bounding_box[0], bounding_box[1], bounding_box[2]])
-    sitk_volume = get_sitk_volume_from_np(np_volume, resampling, origin)
-    # writer = sitk.ImageFileWriter()
-    # writer.SetFileName(output_file)
-    # writer.SetImageIO("NiftiImageIO")
-    # writer.Execute(sitk_volume)
-    sitk.WriteImage(sitk_volume, output_file)
+    return resampling
 
 
 def resample_np_volume(np_volume,
@@ -90,7 +195,12 @@ def resample_np_volume(np_volume,
                        resampling_px_spacing,
                        bounding_box,
                        order=3):
-
+    """
+    Spline resampling within the bounding box. The input is first cut to the region the output samples from, plus a
+    margin, so that the spline prefilter doesn't run over the full uncropped volume. The prefilter's influence decays
+    geometrically with the distance, and past SPLINE_PREFILTER_MARGIN voxels it is below float precision. An axis is
+    cut only where the sampled region lies inside the volume, so the mirror boundary handling is kept as it is.
+    """
     zooming_matrix = np.identity(3)
     zooming_matrix[0, 0] = resampling_px_spacing[0] / current_pixel_spacing[0]
     zooming_matrix[1, 1] = resampling_px_spacing[1] / current_pixel_spacing[1]
@@ -105,52 +215,133 @@ def resample_np_volume(np_volume,
         bounding_box[4] - bounding_box[1],
         bounding_box[5] - bounding_box[2],
     ]) / resampling_px_spacing
+    output_shape = output_shape.astype(int)
+
+    # Crop the input to the sampled region plus the margin, and shift the offset accordingly
+    margin = SPLINE_PREFILTER_MARGIN if order > 1 else 1
+    crop_slices, offset = list(), list(offset)
+    for axis in range(3):
+        first_coord = offset[axis]
+        last_coord = offset[axis] + zooming_matrix[axis, axis] * (output_shape[axis] - 1)
+        crop_start = int(np.floor(first_coord)) - margin
+        crop_end = int(np.ceil(last_coord)) + margin + 1
+        crop_start = crop_start if crop_start > 0 else 0
+        crop_end = crop_end if crop_end < np_volume.shape[axis] else np_volume.shape[axis]
+        if crop_end - crop_start < 2:  # Sampled region entirely outside the volume -- Keep the full axis
+            crop_start, crop_end = 0, np_volume.shape[axis]
+        crop_slices.append(slice(crop_start, crop_end))
+        offset[axis] -= crop_start
+    np_volume = np_volume[tuple(crop_slices)]
 
     np_volume = affine_transform(np_volume,
                                  zooming_matrix,
                                  offset=offset,
                                  mode='mirror',
                                  order=order,
-                                 output_shape=output_shape.astype(int))
+                                 output_shape=output_shape)
 
     return np_volume
 
 
+def resample_sitk_volume(sitk_image,
+                         resampling_px_spacing,
+                         bounding_box,
+                         order=3,
+                         num_threads=None):
+    """
+    sitk counterpart of resample_np_volume() and, for order 0, resample_np_binary_volume(). Same output grid: it starts
+    at the bbox's corner (x1,y1,z1) and has ceil(bbox extent) / spacing voxels along each axis.
+    Points outside the source image get the image's minimum value. Integer images are interpolated in float and rounded
+    back to their pixel type.
+    """
+    if order not in SITK_INTERPOLATORS:
+        raise ValueError(f"Spline order {order} not supported by the sitk backend")
+
+    output_shape = (np.ceil([
+        bounding_box[3] - bounding_box[0],
+        bounding_box[4] - bounding_box[1],
+        bounding_box[5] - bounding_box[2],
+    ]) / resampling_px_spacing).astype(int)
+
+    pixel_id = sitk_image.GetPixelID()
+    is_integer = sitk_image.GetPixelIDTypeAsString().endswith('integer')
+
+    min_max_filter = sitk.MinimumMaximumImageFilter()
+    min_max_filter.Execute(sitk_image)
+
+    resample_filter = sitk.ResampleImageFilter()
+    resample_filter.SetSize([int(s) for s in output_shape])
+    resample_filter.SetOutputOrigin([float(c) for c in bounding_box[:3]])
+    resample_filter.SetOutputSpacing([float(s) for s in resampling_px_spacing])
+    resample_filter.SetOutputDirection(sitk_image.GetDirection())
+    resample_filter.SetInterpolator(SITK_INTERPOLATORS[order])
+    resample_filter.SetDefaultPixelValue(min_max_filter.GetMinimum())
+    if order > 0 and is_integer:
+        resample_filter.SetOutputPixelType(sitk.sitkFloat32)
+    if num_threads is not None:
+        resample_filter.SetNumberOfThreads(num_threads)
+    sitk_volume = resample_filter.Execute(sitk_image)
+
+    if sitk_volume.GetPixelID() != pixel_id:
+        sitk_volume = sitk.Cast(sitk.Round(sitk_volume), pixel_id)
+
+    return sitk_volume
+
+
 def grid_from_spacing(start, spacing, n):
     return np.asarray([start + k * spacing for k in range(n)])
 
 
 def resample_np_binary_volume(np_volume, origin, current_pixel_spacing,
                               resampling_px_spacing, bounding_box):
-
-    x_old = grid_from_spacing(origin[0], current_pixel_spacing[0],
-                              np_volume.shape[0])
-    y_old = grid_from_spacing(origin[1], current_pixel_spacing[1],
-                              np_volume.shape[1])
-    z_old = grid_from_spacing(origin[2], current_pixel_spacing[2],
-                              np_volume.shape[2])
-
+    """
+    Nearest neighbour resampling, for the GTV masks.
+    The output grid is separable, so the nearest source index is computed per axis and the values are gathered with
+    broadcast fancy indexing. Same result as scipy's RegularGridInterpolator(method='nearest', fill_value=0) on the
+    full meshgrid of output points, without building that meshgrid.
+    """
     output_shape = (np.ceil([
         bounding_box[3] - bounding_box[0],
         bounding_box[4] - bounding_box[1],
         bounding_box[5] - bounding_box[2],
     ]) / resampling_px_spacing).astype(int)
 
-    x_new = grid_from_spacing(bounding_box[0], resampling_px_spacing[0],
-                              output_shape[0])
-    y_new = grid_from_spacing(bounding_box[1], resampling_px_spacing[1],
-                              output_shape[1])
-    z_new = grid_from_spacing(bounding_box[2], resampling_px_spacing[2],
-                              output_shape[2])
-    interpolator = RegularGridInterpolator((x_old, y_old, z_old),
-                                           np_volume,
-                                           method='nearest',
-                                           bounds_error=False,
-                                           fill_value=0)
-    x, y, z = np.meshgrid(x_new, y_new, z_new, indexing='ij')
-    pts = np.array(list(zip(x.flatten(), y.flatten(), z.flatten())))
-
-    return interpolator(pts).reshape(output_shape)
+    source_indxs = []
+    out_of_bounds = []
+    for axis in range(3):
+        grid_old = grid_from_spacing(origin[axis], current_pixel_spacing[axis],
+                                     np_volume.shape[axis])
+        grid_new = grid_from_spacing(bounding_box[axis], resampling_px_spacing[axis],
+                                     output_shape[axis])
+        indxs, axis_out_of_bounds = _nearest_grid_indices(grid_old, grid_new)
+        source_indxs.append(indxs)
+        out_of_bounds.append(axis_out_of_bounds)
+
+    # Like RegularGridInterpolator, interpolate in floating point
+    if not np.issubdtype(np_volume.dtype, np.inexact):
+        np_volume = np_volume.astype(float)
+
+    resampled_volume = np_volume[np.ix_(*source_indxs)]
+
+    # Points outside the source grid along any axis get the fill value 0
+    resampled_volume[out_of_bounds[0], :, :] = 0
+    resampled_volume[:, out_of_bounds[1], :] = 0
+    resampled_volume[:, :, out_of_bounds[2]] = 0
+
+    return resampled_volume
+
+
+def _nearest_grid_indices(grid, x):
+    """
+    Index of the nearest grid point for each value in x, with ties going to the lower index,
+    and whether x lies outside the grid -- as in RegularGridInterpolator's nearest method.
+    """
+    i = np.searchsorted(grid, x) - 1
+    i = np.clip(i, 0, grid.size - 2)
+    norm_distances = (x - grid[i]) / (grid[i + 1] - grid[i])
+    nearest_indxs = np.where(norm_distances <= .5, i, i + 1)
+    out_of_bounds = (x < grid[0]) | (x > grid[-1])
+    return nearest_indxs, out_of_bounds
 
 
 def get_sitk_volume_from_np(np_image, pixel_spacing, image_position_patient):